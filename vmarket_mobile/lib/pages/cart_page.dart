@@ -71,6 +71,7 @@ class _CartPageState extends State<CartPage> {
                             child: product['get_thumbnail'] != null
                                 ? CachedNetworkImage(
                                     imageUrl: ApiConstants.mediaBaseUrl + product['get_thumbnail'],
+                                    httpHeaders: ApiConstants.imageHeaders,
                                     fit: BoxFit.cover,
                                     placeholder: (context, url) => const Center(
                                       child: CircularProgressIndicator(),
@@ -173,6 +173,7 @@ class _CategoryPageState extends State<CategoryPage> {
                                       child: category['image'] != null && category['image'].isNotEmpty
                                           ? CachedNetworkImage(
                                               imageUrl: '${ApiConstants.mediaBaseUrl}${category['image']}',
+                                              httpHeaders: ApiConstants.imageHeaders,
                                               placeholder: (context, url) => const Center(
                                                 child: SizedBox(
                                                   height: 24,
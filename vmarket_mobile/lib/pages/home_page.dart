@@ -248,6 +248,7 @@ class _HomePageState extends State<HomePage> with WidgetsBindingObserver {
                   child: imageUrl != null
                       ? CachedNetworkImage(
                           imageUrl: imageUrl,
+                          httpHeaders: ApiConstants.imageHeaders,
                           fit: BoxFit.cover,
                           width: double.infinity,
                           placeholder: (context, url) => Container(
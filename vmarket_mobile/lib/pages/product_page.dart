@@ -64,6 +64,7 @@ class _ProductPageState extends State<ProductPage> {  @override
                   child: product['get_image'] != null && product['get_image'].isNotEmpty
                       ? CachedNetworkImage(
                           imageUrl: ApiConstants.mediaBaseUrl + product['get_image'],
+                          httpHeaders: ApiConstants.imageHeaders,
                           fit: BoxFit.cover,
                           placeholder: (context, url) => const Center(
                             child: CircularProgressIndicator(),
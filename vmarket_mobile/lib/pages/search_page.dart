@@ -181,6 +181,7 @@ class _SearchPageState extends State<SearchPage> {
                           child: imageUrl != null
                               ? CachedNetworkImage(
                                   imageUrl: imageUrl,
+                                  httpHeaders: ApiConstants.imageHeaders,
                                   fit: BoxFit.cover,
                                   width: double.infinity,
                                   placeholder: (context, url) => Container(
@@ -48,6 +48,23 @@ class CartProvider with ChangeNotifier {
       rethrow;
     }
   }
+
+  Future<void> syncCart(Map<int, int> quantities, {String mode = 'replace'}) async {
+    try {
+      _isLoading = true;
+      notifyListeners();
+
+      _cartItems = await _apiService.syncCart(quantities, mode: mode);
+
+      _isLoading = false;
+      notifyListeners();
+    } catch (e) {
+      _isLoading = false;
+      notifyListeners();
+      rethrow;
+    }
+  }
+
   void clear() {
     _cartItems = null;
     notifyListeners();
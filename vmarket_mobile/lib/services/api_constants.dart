@@ -1,6 +1,8 @@
 class ApiConstants {
   static const String baseUrl = 'http://10.0.2.2:8800/api/v1';  // For Android Emulator
   static const String mediaBaseUrl = 'http://10.0.2.2:8800';  // For Android Emulator image URLs
+  // Lets the server send WebP, which is smaller than the JPEG originals
+  static const Map<String, String> imageHeaders = {'Accept': 'image/webp,image/*'};
   
   // Auth endpoints
   static const String login = '/token/login/';
@@ -23,6 +25,7 @@ class ApiConstants {
   
   // Cart and Order endpoints
   static const String cart = '/cart/';
+  static const String cartSync = '/cart/sync/';
   static const String orders = '/orders/';
   static const String checkout = '/checkout/';
 }
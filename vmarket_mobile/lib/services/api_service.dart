@@ -75,6 +75,23 @@ class ApiService {
   }
 
   // Product Methods
+  // Pass the `next` URL of the previous page to keep scrolling. `filters` are
+  // category, min_price, max_price, q and sort (newest, price, -price, popular);
+  // the first page also has the category and price `facets` counts
+  Future<Map<String, dynamic>> getProductsPage({String? next, Map<String, String>? filters}) async {
+    final url = Uri.parse(ApiConstants.baseUrl + ApiConstants.products);
+    final response = await http.get(
+      next != null ? Uri.parse(next) : url.replace(queryParameters: filters),
+      headers: await _getHeaders(),
+    );
+
+    if (response.statusCode == 200) {
+      return jsonDecode(response.body);
+    } else {
+      throw Exception('Failed to load products');
+    }
+  }
+
   Future<List<dynamic>> getProducts() async {
     final response = await http.get(
       Uri.parse(ApiConstants.baseUrl + ApiConstants.products),
@@ -82,7 +99,7 @@ class ApiService {
     );
 
     if (response.statusCode == 200) {
-      return jsonDecode(response.body);
+      return jsonDecode(response.body)['results'];
     } else {
       throw Exception('Failed to load products');
     }
@@ -130,6 +147,26 @@ class ApiService {
     }
   }
 
+  // Sends a cart built offline in one request, mode is 'replace' or 'add'
+  Future<List<dynamic>> syncCart(Map<int, int> quantities, {String mode = 'replace'}) async {
+    final response = await http.post(
+      Uri.parse(ApiConstants.baseUrl + ApiConstants.cartSync),
+      headers: await _getHeaders(),
+      body: jsonEncode({
+        'mode': mode,
+        'items': quantities.entries
+            .map((entry) => {'product_id': entry.key, 'quantity': entry.value})
+            .toList(),
+      }),
+    );
+
+    if (response.statusCode == 200) {
+      return jsonDecode(response.body);
+    } else {
+      throw Exception('Failed to sync cart');
+    }
+  }
+
   // Search Method
   Future<List<dynamic>> searchProducts(String query) async {
     final response = await http.post(
@@ -141,7 +178,7 @@ class ApiService {
     );
 
     if (response.statusCode == 200) {
-      return jsonDecode(response.body);
+      return jsonDecode(response.body)['results'];
     } else {
       throw Exception('Failed to search products');
     }
@@ -168,7 +205,7 @@ class ApiService {
     );
 
     if (response.statusCode == 200) {
-      return jsonDecode(response.body);
+      return jsonDecode(response.body)['results'];
     } else {
       throw Exception('Failed to load category products');
     }
@@ -196,7 +233,7 @@ class ApiService {
     );
 
     if (response.statusCode == 200) {
-      return jsonDecode(response.body);
+      return jsonDecode(response.body)['results'];
     } else {
       throw Exception('Failed to load orders');
     }
@@ -4,15 +4,17 @@ from django.core.exceptions import ValidationError
 from django.http import Http404
 from django.db import transaction
 from django.shortcuts import get_object_or_404
-from django.core.mail import send_mail
 from django.conf import settings
 from django.utils.crypto import get_random_string
 
-from rest_framework import status, authentication, permissions
+from rest_framework import status, permissions
 from rest_framework.decorators import api_view, authentication_classes, permission_classes
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
+from .authentication import CachedTokenAuthentication
+from .mail import queue_mail
+from .views import with_items
 from .models import Address, UserSettings, Order, EmailVerification, UserProfile
 from .serializers import (
     AddressSerializer, 
@@ -23,7 +25,7 @@ from .serializers import (
 )
 
 class UserProfileView(APIView):
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
     
     def get(self, request, format=None):
@@ -55,7 +57,7 @@ class UserProfileView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 class ChangePasswordView(APIView):
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
     
     def post(self, request, format=None):
@@ -86,7 +88,7 @@ class ChangePasswordView(APIView):
             return Response({'new_password': list(e)}, status=status.HTTP_400_BAD_REQUEST)
 
 class AddressViewSet(APIView):
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
     
     def get(self, request, format=None):
@@ -104,7 +106,7 @@ class AddressViewSet(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 class AddressDetailView(APIView):
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
     
     def get_object(self, pk):
@@ -135,7 +137,7 @@ class AddressDetailView(APIView):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 class SetDefaultAddressView(APIView):
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
     
     def post(self, request, pk, format=None):
@@ -154,7 +156,7 @@ class SetDefaultAddressView(APIView):
             raise Http404
 
 class UserSettingsView(APIView):
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
     
     def get(self, request, format=None):
@@ -203,12 +205,11 @@ class EmailVerificationView(APIView):
         
         # Send verification email
         verification_url = f"{settings.FRONTEND_URL}/verify-email/{token}"
-        send_mail(
+        queue_mail(
             'Email Verification for VMarket',
             f'Please click on the link below to verify your email address:\n\n{verification_url}',
             settings.DEFAULT_FROM_EMAIL,
             [email],
-            fail_silently=False,
         )
         
         return Response({'success': 'Verification email sent'})
@@ -241,12 +242,12 @@ class EmailVerificationView(APIView):
             )
 
 class OrderDetailView(APIView):
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
     
     def get_object(self, pk):
         try:
-            return Order.objects.get(pk=pk, user=self.request.user)
+            return with_items(Order.objects.all()).get(pk=pk, user=self.request.user)
         except Order.DoesNotExist:
             raise Http404
     
@@ -1,9 +1,86 @@
 from django.contrib import admin
-from order.models import Order, OrderItem, Address, UserSettings, UserProfile, EmailVerification
-
-admin.site.register(Order)
-admin.site.register(OrderItem)
-admin.site.register(Address)
-admin.site.register(UserSettings)
-admin.site.register(UserProfile)
-admin.site.register(EmailVerification)
\ No newline at end of file
+from order.models import Order, OrderItem, Address, UserSettings, UserProfile, EmailVerification, OutboxEmail, Stock, StockReservation
+from vmarketdjango.paginator import EstimatedCountPaginator
+
+
+class OrderItemInline(admin.TabularInline):
+    """Lines of a paid order, read-only and loaded with their products in one query"""
+    model = OrderItem
+    fields = ('product', 'price', 'quantity')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('product')
+
+
+@admin.register(Order)
+class OrderAdmin(admin.ModelAdmin):
+    list_display = ('id', 'first_name', 'last_name', 'email', 'user', 'status', 'paid_amount', 'created_at')
+    list_select_related = ('user',)
+    # Both filters are backed by the order_status_created_idx and order_created_idx indexes
+    list_filter = ('status', ('created_at', admin.DateFieldListFilter))
+    search_fields = ('=email', '=stripe_token')
+    raw_id_fields = ('user',)
+    inlines = [OrderItemInline]
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+@admin.register(OrderItem)
+class OrderItemAdmin(admin.ModelAdmin):
+    list_display = ('id', 'order', 'product', 'price', 'quantity')
+    list_select_related = ('order', 'product')
+    raw_id_fields = ('order',)
+    autocomplete_fields = ('product',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+@admin.register(Address)
+class AddressAdmin(admin.ModelAdmin):
+    list_display = ('name', 'user', 'city', 'zip_code', 'is_default')
+    list_select_related = ('user',)
+    raw_id_fields = ('user',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+@admin.register(UserSettings, UserProfile, EmailVerification)
+class UserRelatedAdmin(admin.ModelAdmin):
+    # Their __str__ reads the user
+    list_select_related = ('user',)
+    raw_id_fields = ('user',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+@admin.register(OutboxEmail)
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'status', 'attempts', 'next_attempt_at', 'sent_at')
+    list_filter = ('status',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+@admin.register(Stock)
+class StockAdmin(admin.ModelAdmin):
+    list_display = ('product', 'quantity', 'updated_at')
+    list_select_related = ('product',)
+    autocomplete_fields = ('product',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+@admin.register(StockReservation)
+class StockReservationAdmin(admin.ModelAdmin):
+    list_display = ('key', 'product', 'user', 'quantity', 'expires_at')
+    list_select_related = ('product', 'user')
+    autocomplete_fields = ('product',)
+    raw_id_fields = ('user',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
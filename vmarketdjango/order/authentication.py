@@ -0,0 +1,74 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+HITS_KEY = 'auth:token:hits'
+MISSES_KEY = 'auth:token:misses'
+
+
+def token_cache_key(key):
+    # Hashed so raw tokens never show up in cache keys
+    return 'auth:token:' + hashlib.sha256(key.encode()).hexdigest()
+
+
+def count(counter):
+    try:
+        cache.incr(counter)
+    except ValueError:
+        cache.add(counter, 1, None)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication that remembers the token and its user for
+    TOKEN_CACHE_TIMEOUT seconds instead of joining Token and User on every call.
+
+    Entries are dropped as soon as the transaction deleting a token (logout,
+    account deletion) or saving its user (password change, deactivation)
+    commits, see the receivers in order.models. Other workers only see that
+    through a shared cache, so without SHARED_CACHE this is plain
+    TokenAuthentication.
+    """
+
+    def authenticate_credentials(self, key):
+        if not settings.SHARED_CACHE:
+            return super().authenticate_credentials(key)
+
+        cache_key = token_cache_key(key)
+        token = cache.get(cache_key)
+
+        if token is None:
+            count(MISSES_KEY)
+            user, token = super().authenticate_credentials(key)
+            cache.set(cache_key, token, settings.TOKEN_CACHE_TIMEOUT)
+        else:
+            count(HITS_KEY)
+
+        return token.user, token
+
+
+def forget_token(key):
+    cache.delete(token_cache_key(key))
+
+
+def forget_user(user_id):
+    """Drop the cached tokens of a user"""
+    keys = Token.objects.filter(user_id=user_id).values_list('key', flat=True)
+    cache.delete_many([token_cache_key(key) for key in keys])
+
+
+def stats(reset=False):
+    """Hit and miss counts since the counters were last reset"""
+    counts = cache.get_many([HITS_KEY, MISSES_KEY])
+    hits, misses = counts.get(HITS_KEY, 0), counts.get(MISSES_KEY, 0)
+    if reset:
+        cache.delete_many([HITS_KEY, MISSES_KEY])
+
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / total if total else None,
+    }
@@ -0,0 +1,246 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils.module_loading import import_string
+
+from .models import CartItem
+
+
+class BaseCartStore:
+    """Where carts live until checkout turns them into an Order.
+
+    Quantities are keyed by product id. Implementations must apply ``add``
+    atomically so concurrent requests never lose an update.
+    """
+
+    def items(self, user_id):
+        """Return ``{product_id: quantity}``"""
+        raise NotImplementedError
+
+    def add(self, user_id, product_id, quantity):
+        """Add ``quantity`` (negative to remove some) and return the new quantity"""
+        raise NotImplementedError
+
+    def remove(self, user_id, product_id):
+        """Drop a product, return whether it was in the cart"""
+        raise NotImplementedError
+
+    def clear(self, user_id):
+        raise NotImplementedError
+
+    def set_many(self, user_id, quantities, replace=False):
+        """Set absolute quantities, dropping products set to 0 or less.
+
+        With ``replace`` the cart ends up holding exactly ``quantities``.
+        Returns the resulting cart like ``items``.
+        """
+        raise NotImplementedError
+
+    def add_many(self, user_id, deltas):
+        """Apply ``add`` for each product and return the resulting cart"""
+        for product_id, quantity in deltas.items():
+            self.add(user_id, product_id, quantity)
+        return self.items(user_id)
+
+
+class CacheCartStore(BaseCartStore):
+    """Cart kept in the cache framework, expiring CART_TTL seconds after the last change.
+
+    Every quantity is its own counter updated with ``cache.incr``. The
+    products of a cart are listed in numbered slots, which are allocated
+    with ``incr`` too, so no update ever reads and rewrites a shared value.
+    A product leaving the cart empties its slot, and the next new product
+    claims it back with ``cache.add``. Every write gives all the keys of the
+    cart a fresh TTL, so a slot never expires before its quantity or the
+    other way round.
+
+    Only backends whose ``incr`` and ``add`` are atomic, like Redis and
+    Memcached, keep concurrent updates apart, see ATOMIC_CACHE.
+    """
+
+    def __init__(self, cache=cache):
+        self.cache = cache
+
+    def key(self, user_id, *parts):
+        return ':'.join(['cart', str(user_id), *map(str, parts)])
+
+    def slots(self, user_id):
+        count = self.cache.get(self.key(user_id, 'slots'), 0)
+        return [self.key(user_id, 'slot', i) for i in range(1, count + 1)]
+
+    def items(self, user_id):
+        product_ids = set(self.cache.get_many(self.slots(user_id)).values())
+        quantity_keys = {self.key(user_id, 'qty', product_id): product_id for product_id in product_ids}
+
+        return {
+            quantity_keys[key]: quantity
+            for key, quantity in self.cache.get_many(quantity_keys).items()
+            if quantity > 0
+        }
+
+    def track(self, user_id, product_ids, ttl):
+        """Create the quantity counters of products new to the cart and give them slots"""
+        quantity_keys = {self.key(user_id, 'qty', product_id): product_id for product_id in product_ids}
+        existing = self.cache.get_many(quantity_keys)
+        new = [
+            product_id for key, product_id in quantity_keys.items()
+            if key not in existing and self.cache.add(key, 0, ttl)
+        ]
+        if not new:
+            return
+
+        # Empty slots first, add() lets only one product claim each of them
+        slots = self.slots(user_id)
+        taken = self.cache.get_many(slots)
+        for slot in slots:
+            if not new:
+                return
+            if slot not in taken and self.cache.add(slot, new[-1], ttl):
+                new.pop()
+
+        slots_key = self.key(user_id, 'slots')
+        self.cache.add(slots_key, 0, ttl)
+        last = self.cache.incr(slots_key, len(new))
+        self.cache.set_many({
+            self.key(user_id, 'slot', slot): product_id
+            for slot, product_id in zip(range(last - len(new) + 1, last + 1), new)
+        }, ttl)
+
+    def untrack(self, user_id, product_ids):
+        """Empty the slots of products leaving the cart, then drop their quantities"""
+        product_ids = set(product_ids)
+        slots = self.cache.get_many(self.slots(user_id))
+        self.cache.delete_many([slot for slot, product_id in slots.items() if product_id in product_ids])
+        self.cache.delete_many([self.key(user_id, 'qty', product_id) for product_id in product_ids])
+
+    def refresh(self, user_id, ttl):
+        """Restart the TTL of the slot counter, every slot and every quantity"""
+        slots = self.slots(user_id)
+        product_ids = set(self.cache.get_many(slots).values())
+        keys = [self.key(user_id, 'slots'), *slots, *(self.key(user_id, 'qty', product_id) for product_id in product_ids)]
+        for key in keys:
+            self.cache.touch(key, ttl)
+
+    def add(self, user_id, product_id, quantity):
+        ttl = settings.CART_TTL
+
+        self.track(user_id, [product_id], ttl)
+        new_quantity = self.cache.incr(self.key(user_id, 'qty', product_id), quantity)
+        if new_quantity <= 0:
+            self.untrack(user_id, [product_id])
+            new_quantity = 0
+
+        self.refresh(user_id, ttl)
+        return new_quantity
+
+    def add_many(self, user_id, deltas):
+        # One pass over the slots and one refresh for the whole batch, rather
+        # than both for every product
+        ttl = settings.CART_TTL
+
+        self.track(user_id, deltas, ttl)
+        emptied = [
+            product_id for product_id, quantity in deltas.items()
+            if self.cache.incr(self.key(user_id, 'qty', product_id), quantity) <= 0
+        ]
+        if emptied:
+            self.untrack(user_id, emptied)
+
+        self.refresh(user_id, ttl)
+        return self.items(user_id)
+
+    def remove(self, user_id, product_id):
+        in_cart = self.cache.get(self.key(user_id, 'qty', product_id)) is not None
+        self.untrack(user_id, [product_id])
+        return in_cart
+
+    def set_many(self, user_id, quantities, replace=False):
+        ttl = settings.CART_TTL
+        keep = {product_id: quantity for product_id, quantity in quantities.items() if quantity > 0}
+        drop = set(quantities) - set(keep)
+        if replace:
+            drop |= set(self.items(user_id)) - set(keep)
+
+        self.track(user_id, keep, ttl)
+        self.cache.set_many({self.key(user_id, 'qty', product_id): quantity for product_id, quantity in keep.items()}, ttl)
+        if drop:
+            self.untrack(user_id, drop)
+        self.refresh(user_id, ttl)
+        return self.items(user_id)
+
+    def clear(self, user_id):
+        slots = self.slots(user_id)
+        product_ids = self.cache.get_many(slots).values()
+        self.cache.delete_many(
+            slots
+            + [self.key(user_id, 'slots')]
+            + [self.key(user_id, 'qty', product_id) for product_id in product_ids]
+        )
+
+
+class DatabaseCartStore(BaseCartStore):
+    """Fallback for deployments without a usable cache, kept in its own
+    CartItem table rather than in half-empty orders"""
+
+    def items(self, user_id):
+        return dict(CartItem.objects.filter(user_id=user_id).values_list('product_id', 'quantity'))
+
+    def add(self, user_id, product_id, quantity):
+        items = CartItem.objects.filter(user_id=user_id, product_id=product_id)
+        with transaction.atomic():
+            if not items.update(quantity=F('quantity') + quantity):
+                try:
+                    with transaction.atomic():
+                        CartItem.objects.create(user_id=user_id, product_id=product_id, quantity=quantity)
+                except IntegrityError:
+                    # Another request created the row first
+                    items.update(quantity=F('quantity') + quantity)
+
+            new_quantity = items.values_list('quantity', flat=True).first() or 0
+            if new_quantity <= 0:
+                items.delete()
+                return 0
+        return new_quantity
+
+    def remove(self, user_id, product_id):
+        deleted, _ = CartItem.objects.filter(user_id=user_id, product_id=product_id).delete()
+        return bool(deleted)
+
+    def clear(self, user_id):
+        CartItem.objects.filter(user_id=user_id).delete()
+
+    def set_many(self, user_id, quantities, replace=False):
+        keep = {product_id: quantity for product_id, quantity in quantities.items() if quantity > 0}
+        items = CartItem.objects.filter(user_id=user_id)
+
+        with transaction.atomic():
+            if replace:
+                items.exclude(product_id__in=keep).delete()
+            else:
+                items.filter(product_id__in=set(quantities) - set(keep)).delete()
+
+            CartItem.objects.bulk_create(
+                [CartItem(user_id=user_id, product_id=product_id, quantity=quantity) for product_id, quantity in keep.items()],
+                update_conflicts=True,
+                unique_fields=['user', 'product'],
+                update_fields=['quantity', 'updated_at'],
+            )
+            return self.items(user_id)
+
+    def add_many(self, user_id, deltas):
+        with transaction.atomic():
+            current = dict(
+                CartItem.objects
+                .select_for_update()
+                .filter(user_id=user_id, product_id__in=deltas)
+                .values_list('product_id', 'quantity')
+            )
+            return self.set_many(user_id, {
+                product_id: current.get(product_id, 0) + quantity
+                for product_id, quantity in deltas.items()
+            })
+
+
+def get_cart_store():
+    return import_string(settings.CART_STORE)()
@@ -0,0 +1,124 @@
+"""A stand-in for the Stripe charges API, for tests and load benchmarks.
+
+Point ``STRIPE_API_BASE`` at it. Charges succeed after an optional delay,
+except for the ``tok_chargeDeclined`` source, and repeated idempotency
+keys return the original response with ``Idempotent-Replayed: true`` like
+the real API does. Refunds are recorded in ``refunds`` by charge id and
+show on the charge fetched from ``/v1/charges/<id>``.
+"""
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+DECLINED_SOURCE = 'tok_chargeDeclined'
+
+
+class FakePaymentHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        charge_id = self.path.removeprefix('/v1/charges/')
+        with self.server.lock:
+            charge = self.server.charge_objects.get(charge_id)
+            if charge is None:
+                return self.respond(404, {'error': {'message': f'No such charge: {charge_id}'}})
+            self.respond(200, charge)
+
+    def do_POST(self):
+        if self.path not in ('/v1/charges', '/v1/refunds'):
+            return self.respond(404, {'error': {'message': 'Unknown endpoint'}})
+
+        length = int(self.headers.get('Content-Length', 0))
+        data = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        key = self.headers.get('Idempotency-Key')
+        with self.server.lock:
+            if key and key in self.server.charges:
+                return self.respond(*self.server.charges[key], replayed=True)
+            status, body = self.charge(data) if self.path == '/v1/charges' else self.refund(data)
+            if key:
+                # A copy, the replay stays the response as it was sent
+                self.server.charges[key] = (status, dict(body))
+        self.respond(status, body)
+
+    def charge(self, data):
+        if data.get('source') == DECLINED_SOURCE:
+            return 402, {'error': {'type': 'card_error', 'message': 'Your card was declined.'}}
+
+        charge = {
+            'id': f'ch_fake_{next(self.server.counter)}',
+            'object': 'charge',
+            'amount': int(data.get('amount', 0)),
+            'currency': data.get('currency', '').lower(),
+            'description': data.get('description', ''),
+            'paid': True,
+            'refunded': False,
+            'status': 'succeeded',
+        }
+        self.server.charge_objects[charge['id']] = charge
+        return 200, charge
+
+    def refund(self, data):
+        charge = self.server.charge_objects.get(data.get('charge'))
+        if charge is not None:
+            charge['refunded'] = True
+        self.server.refunds.append(data.get('charge'))
+        return 200, {
+            'id': f're_fake_{next(self.server.counter)}',
+            'object': 'refund',
+            'charge': data.get('charge'),
+            'status': 'succeeded',
+        }
+
+    def respond(self, status, body, replayed=False):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        if replayed:
+            self.send_header('Idempotent-Replayed', 'true')
+        self.end_headers()
+        try:
+            self.wfile.write(payload)
+        except ConnectionError:
+            # The client timed out and hung up, like it would on the real API
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class FakePaymentServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, verbose=False):
+        super().__init__((host, port), FakePaymentHandler)
+        self.latency = latency
+        self.verbose = verbose
+        self.charges = {}
+        self.charge_objects = {}
+        self.refunds = []
+        self.lock = threading.Lock()
+        self.counter = itertools.count(1)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,123 @@
+"""Stock reservation for checkout.
+
+Checkout reserves the units of its order before charging the card and
+confirms the reservation once the order is saved, or releases it when
+the charge fails. Reserving is one conditional ``UPDATE`` per product,
+``quantity = quantity - n WHERE quantity >= n``, so the database checks
+and decrements in a single statement and a hot product's row is locked
+for the length of that statement's transaction, never across the call
+to the payment provider. Reservations of checkouts that never finish
+expire after STOCK_RESERVATION_TTL seconds and are put back in bulk by
+``release_expired``. A checkout confirming after its reservation was put
+back takes the units again the same way, or fails if they sold meanwhile.
+"""
+import uuid
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.utils import timezone
+
+from .models import Stock, StockReservation
+
+
+class OutOfStock(Exception):
+    def __init__(self, product_id, available):
+        super().__init__(f'Only {available} left of product {product_id}')
+        self.product_id = product_id
+        self.available = available
+
+
+def reserve(quantities, user=None, ttl=None):
+    """Take ``{product_id: quantity}`` out of stock and return the reservation key.
+
+    Products without a Stock row are not tracked and always succeed.
+    Raises OutOfStock, having reserved nothing, when a product runs short.
+    """
+    key = uuid.uuid4().hex
+    quantities = {product_id: quantity for product_id, quantity in quantities.items() if quantity > 0}
+    tracked = dict(Stock.objects.filter(product_id__in=quantities).values_list('product_id', 'quantity'))
+
+    # Fail before writing anything when the stock is already known to be short
+    for product_id in tracked:
+        if tracked[product_id] < quantities[product_id]:
+            raise OutOfStock(product_id, tracked[product_id])
+    if not tracked:
+        return key
+
+    expires_at = timezone.now() + timedelta(seconds=settings.STOCK_RESERVATION_TTL if ttl is None else ttl)
+    with transaction.atomic():
+        take({product_id: quantities[product_id] for product_id in tracked})
+        StockReservation.objects.bulk_create(
+            StockReservation(key=key, product_id=product_id, user=user, quantity=quantities[product_id], expires_at=expires_at)
+            for product_id in tracked
+        )
+    return key
+
+
+def take(quantities):
+    """Decrement the stock of tracked products, raises OutOfStock on the first one short"""
+    # Always in the same order, so two carts sharing products can't deadlock
+    for product_id in sorted(quantities):
+        quantity = quantities[product_id]
+        if not Stock.objects.filter(product_id=product_id, quantity__gte=quantity).update(quantity=F('quantity') - quantity):
+            raise OutOfStock(product_id, Stock.objects.get(product_id=product_id).quantity)
+
+
+def confirm(key, quantities):
+    """The order of ``{product_id: quantity}`` is saved, its units are sold for good.
+
+    Call inside the transaction saving it. The reservation is locked first,
+    so release_expired skips it from then on. Units it no longer holds,
+    because it expired and was released, are taken again; OutOfStock is
+    raised if they sold meanwhile. Returns how many reservations were confirmed.
+    """
+    reserved = list(StockReservation.objects.select_for_update().filter(key=key).values_list('pk', 'product_id'))
+    if reserved:
+        StockReservation.objects.filter(pk__in=[pk for pk, _ in reserved]).delete()
+
+    confirmed = {product_id for _, product_id in reserved}
+    missing = {product_id: quantity for product_id, quantity in quantities.items() if quantity > 0 and product_id not in confirmed}
+    if missing:
+        tracked = Stock.objects.filter(product_id__in=missing).values_list('product_id', flat=True)
+        take({product_id: missing[product_id] for product_id in tracked})
+    return len(reserved)
+
+
+def restock(reservations):
+    """Delete ``reservations`` and put their units back with one UPDATE"""
+    reservations = list(reservations.select_for_update(skip_locked=True).values_list('pk', 'product_id', 'quantity'))
+    if not reservations:
+        return 0
+
+    totals = Counter()
+    for _, product_id, quantity in reservations:
+        totals[product_id] += quantity
+
+    Stock.objects.filter(product_id__in=totals).update(quantity=F('quantity') + Case(
+        *[When(product_id=product_id, then=Value(quantity)) for product_id, quantity in totals.items()],
+        output_field=IntegerField(),
+    ))
+    StockReservation.objects.filter(pk__in=[pk for pk, _, _ in reservations]).delete()
+    return len(reservations)
+
+
+@transaction.atomic
+def release(key):
+    """The checkout failed, put its units back"""
+    return restock(StockReservation.objects.filter(key=key))
+
+
+def release_expired(batch_size=1000):
+    """Put back the units of expired reservations, return how many were released"""
+    released = 0
+    while True:
+        with transaction.atomic():
+            expired = StockReservation.objects.filter(expires_at__lte=timezone.now()).order_by('pk')
+            count = restock(expired[:batch_size])
+        released += count
+        if count < batch_size:
+            return released
+
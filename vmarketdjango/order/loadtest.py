@@ -0,0 +1,181 @@
+"""In-process load driver for the /api/v1/ routes of the product and order apps.
+
+Requests go through ``django.test.Client``, so runs need no server and
+are repeatable on a seeded dataset (see order.seed). Every endpoint has a
+query budget: the most SQL queries a single request may run. Budgets do
+not depend on the amount of data, so an N+1 regression goes over them.
+They leave room for one token lookup, for when the token cache is cold.
+"""
+import contextlib
+import statistics
+import time
+from collections import Counter, namedtuple
+
+from django.db import connections
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+
+from product.models import Product
+
+from .fake_payments import FakePaymentServer
+from .models import Address, Order
+from .seed import seeded_users
+
+Endpoint = namedtuple('Endpoint', 'name method path budget data status', defaults=[None, 200])
+
+# Routes that are left out on purpose
+SKIPPED = {
+    'checkout/': 'charges through the Stripe SDK, checkout/async/ covers the same code against the fake server',
+    'reports/sales/': 'staff only, the load test user is a customer',
+    'users/set_password/': 'would change the password of the load test user',
+    'users/delete/': 'would delete the load test user',
+    'addresses/<pk>/ DELETE': 'would delete the address the other address routes use',
+    'email/verify/ GET': 'confirming uses up the token, repeated requests would only measure the 400 page',
+}
+
+
+def get_fixture():
+    """Objects the endpoint paths point at, taken from the seeded dataset"""
+    user = seeded_users().first()
+    if user is None:
+        return None
+
+    product = Product.objects.select_related('category').filter(category__slug__startswith='bench-').order_by('pk').first()
+    return {
+        'user': user,
+        'token': Token.objects.get(user=user).key,
+        'product': product,
+        'category': product.category,
+        'order': Order.objects.filter(user=user).order_by('pk').first(),
+        'address': Address.objects.filter(user=user).order_by('pk').first(),
+        'cart': list(Product.objects.filter(category__slug__startswith='bench-').order_by('pk').values_list('pk', flat=True)[:20]),
+    }
+
+
+def get_endpoints(fixture):
+    product, category = fixture['product'], fixture['category']
+    order, address = fixture['order'], fixture['address']
+    word = product.name.split()[0].lower()
+
+    return [
+        Endpoint('latest products', 'get', '/api/v1/latest-products/', 2),
+        Endpoint('products', 'get', '/api/v1/products/', 3),
+        Endpoint('filtered products', 'get', f'/api/v1/products/?category={category.slug}&min_price=1&sort=price&q={word}', 3),
+        Endpoint('popular products', 'get', '/api/v1/products/?sort=popular', 3),
+        Endpoint('product by id', 'get', f'/api/v1/products/{product.pk}/', 3),
+        Endpoint('categories', 'get', '/api/v1/categories/', 2),
+        Endpoint('category products', 'get', f'/api/v1/categories/{category.pk}/products/', 4),
+        Endpoint('search', 'get', f'/api/v1/products/search/?query={word}', 4),
+        Endpoint('product detail', 'get', f'/api/v1/products/{category.slug}/{product.slug}/', 2),
+        Endpoint('category detail', 'get', f'/api/v1/products/{category.slug}/', 3),
+        Endpoint('category page', 'get', f'/api/v1/categories/{category.slug}/products/', 3),
+        Endpoint('cart', 'get', '/api/v1/cart/', 1),
+        Endpoint('cart add', 'post', '/api/v1/cart/', 3, {'product_id': product.pk, 'quantity': 1}, status=201),
+        Endpoint('cart remove', 'delete', f'/api/v1/cart/?product_id={product.pk}', 1, status=204),
+        Endpoint('cart sync', 'post', '/api/v1/cart/sync/', 3, {
+            'items': [{'product_id': pk, 'quantity': 1} for pk in fixture['cart']],
+        }),
+        Endpoint('checkout', 'post', '/api/v1/checkout/async/', 17, {
+            'first_name': 'Bench',
+            'last_name': 'User',
+            'email': fixture['user'].email,
+            'address': '1 Main Street',
+            'zipcode': '10000',
+            'place': 'Berlin',
+            'phone': '+10000000000',
+            'stripe_token': 'tok_visa',
+            'items': [{'product': product.pk, 'quantity': 1, 'price': str(product.price)}],
+        }, status=201),
+        Endpoint('orders', 'get', '/api/v1/orders/', 4),
+        Endpoint('orders summary', 'get', '/api/v1/orders/?summary=1', 3),
+        Endpoint('order detail', 'get', f'/api/v1/orders/{order.pk}/', 3),
+        Endpoint('profile', 'get', '/api/v1/users/me/', 1),
+        Endpoint('user settings', 'get', '/api/v1/users/settings/', 1),
+        Endpoint('email verification', 'post', '/api/v1/email/verify/', 8, {'email': fixture['user'].email}),
+        Endpoint('addresses', 'get', '/api/v1/addresses/', 2),
+        Endpoint('address create', 'post', '/api/v1/addresses/', 3, {
+            'name': 'Load test',
+            'address_line1': '2 Side Street',
+            'city': 'Berlin',
+            'state': 'State',
+            'zip_code': '10000',
+            'phone': '+10000000000',
+        }, status=201),
+        Endpoint('address detail', 'get', f'/api/v1/addresses/{address.pk}/', 2),
+        Endpoint('address update', 'put', f'/api/v1/addresses/{address.pk}/', 5, {
+            'name': address.name,
+            'address_line1': address.address_line1,
+            'city': address.city,
+            'state': address.state,
+            'zip_code': address.zip_code,
+            'phone': address.phone,
+        }),
+        Endpoint('address set default', 'post', f'/api/v1/addresses/{address.pk}/set_default/', 7),
+    ]
+
+
+def request(client, endpoint):
+    """Send one request and return ``(status, milliseconds, queries)``"""
+    with contextlib.ExitStack() as stack:
+        captures = [stack.enter_context(CaptureQueriesContext(connection)) for connection in connections.all()]
+        start = time.perf_counter()
+        response = getattr(client, endpoint.method)(endpoint.path, endpoint.data, content_type='application/json')
+        elapsed = (time.perf_counter() - start) * 1000
+    return response.status_code, elapsed, sum(len(capture) for capture in captures)
+
+
+def run(endpoints, token, rounds=1):
+    """Send every endpoint ``rounds`` times, in order, and collect per endpoint results"""
+    client = Client(HTTP_AUTHORIZATION=f'Token {token}')
+    results = {endpoint.name: {'timings': [], 'queries': [], 'statuses': Counter()} for endpoint in endpoints}
+
+    with FakePaymentServer() as server, override_settings(STRIPE_API_BASE=server.url):
+        for _ in range(rounds):
+            for endpoint in endpoints:
+                status, elapsed, queries = request(client, endpoint)
+                result = results[endpoint.name]
+                result['timings'].append(elapsed)
+                result['queries'].append(queries)
+                result['statuses'][status] += 1
+
+    return results
+
+
+def percentile(timings, percent):
+    timings = sorted(timings)
+    return timings[max(0, int(round(len(timings) * percent / 100)) - 1)]
+
+
+def summarize(endpoint, result):
+    timings = result['timings']
+    return {
+        'endpoint': endpoint.name,
+        'requests': len(timings),
+        'rps': len(timings) / (sum(timings) / 1000),
+        'p50': statistics.median(timings),
+        'p95': percentile(timings, 95),
+        'p99': percentile(timings, 99),
+        'queries': max(result['queries']),
+        'budget': endpoint.budget,
+        'statuses': dict(result['statuses']),
+    }
+
+
+def over_budget(endpoints, results):
+    """Endpoints whose worst request ran more queries than allowed"""
+    return [
+        (endpoint.name, max(results[endpoint.name]['queries']), endpoint.budget)
+        for endpoint in endpoints
+        if max(results[endpoint.name]['queries']) > endpoint.budget
+    ]
+
+
+def unexpected_statuses(endpoints, results):
+    """Endpoints that answered anything but their expected status, whose
+    query counts would be those of an error page"""
+    return [
+        (endpoint.name, dict(results[endpoint.name]['statuses']), endpoint.status)
+        for endpoint in endpoints
+        if set(results[endpoint.name]['statuses']) != {endpoint.status}
+    ]
@@ -0,0 +1,114 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db import transaction
+from django.utils import timezone
+
+from .models import OutboxEmail
+
+
+def queue_message(message):
+    """Store an EmailMessage in the outbox instead of talking to SMTP"""
+    return OutboxEmail.objects.create(
+        subject=message.subject,
+        body=message.body,
+        from_email=message.from_email or settings.DEFAULT_FROM_EMAIL,
+        to=list(message.to),
+        cc=list(message.cc),
+        bcc=list(message.bcc),
+        reply_to=list(message.reply_to),
+        headers=dict(message.extra_headers),
+        alternatives=[list(alternative) for alternative in getattr(message, 'alternatives', [])],
+    )
+
+
+def queue_mail(subject, message, from_email, recipient_list, html_message=None):
+    """Drop-in for django.core.mail.send_mail that returns immediately"""
+    email = EmailMultiAlternatives(subject, message, from_email, recipient_list)
+    if html_message:
+        email.attach_alternative(html_message, 'text/html')
+    return queue_message(email)
+
+
+class OutboxBackend(BaseEmailBackend):
+    """Email backend that writes to the outbox, so djoser's activation and
+    password reset emails leave the request path too"""
+
+    def send_messages(self, email_messages):
+        for message in email_messages:
+            queue_message(message)
+        return len(email_messages)
+
+
+def build_message(email, connection):
+    message = EmailMultiAlternatives(
+        subject=email.subject,
+        body=email.body,
+        from_email=email.from_email,
+        to=email.to,
+        cc=email.cc,
+        bcc=email.bcc,
+        reply_to=email.reply_to,
+        headers=email.headers,
+        connection=connection,
+    )
+    for content, mimetype in email.alternatives:
+        message.attach_alternative(content, mimetype)
+    return message
+
+
+def claim_batch(batch_size, lease):
+    """Reserve due emails for ``lease`` so a concurrent dispatcher skips them"""
+    now = timezone.now()
+    with transaction.atomic():
+        due = (
+            OutboxEmail.objects
+            .filter(status=OutboxEmail.PENDING, next_attempt_at__lte=now)
+            .select_for_update(skip_locked=True)
+            .order_by('next_attempt_at')
+        )
+        ids = list(due.values_list('pk', flat=True)[:batch_size])
+        OutboxEmail.objects.filter(pk__in=ids).update(next_attempt_at=now + lease)
+    return list(OutboxEmail.objects.filter(pk__in=ids).order_by('pk'))
+
+
+def retry_delay(attempts):
+    """Exponential backoff: base delay, then twice that, four times, ..."""
+    return timedelta(seconds=settings.OUTBOX_RETRY_DELAY * 2 ** (attempts - 1))
+
+
+def dispatch_batch(batch_size=100, lease=timedelta(minutes=5)):
+    """Deliver one batch of due emails over a single reused connection.
+
+    Returns ``(sent, failed)`` counts.
+    """
+    emails = claim_batch(batch_size, lease)
+    if not emails:
+        return 0, 0
+
+    sent_ids = []
+    failed = 0
+    connection = get_connection(settings.OUTBOX_DELIVERY_BACKEND)
+    try:
+        connection.open()
+        for email in emails:
+            try:
+                build_message(email, connection).send()
+            except Exception as e:
+                failed += 1
+                email.attempts += 1
+                email.last_error = str(e)
+                if email.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+                    email.status = OutboxEmail.FAILED
+                else:
+                    email.next_attempt_at = timezone.now() + retry_delay(email.attempts)
+                email.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt_at'])
+            else:
+                sent_ids.append(email.pk)
+    finally:
+        connection.close()
+        OutboxEmail.objects.filter(pk__in=sent_ids).update(status=OutboxEmail.SENT, sent_at=timezone.now())
+
+    return len(sent_ids), failed
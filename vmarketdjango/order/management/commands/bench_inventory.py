@@ -0,0 +1,103 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection, transaction
+
+from order import inventory
+from order.loadtest import percentile
+from order.models import Stock
+from order.seed import PREFIX
+from product.models import Category, Product
+
+
+class Command(BaseCommand):
+    help = 'Run many simultaneous checkouts of one product and compare stock reservation strategies'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--checkouts', type=int, default=500)
+        parser.add_argument('--stock', type=int, default=400, help='Units on sale, fewer than checkouts to sell out')
+        parser.add_argument('--concurrency', type=int, default=50)
+        parser.add_argument('--latency', type=float, default=0.05, help='Seconds the payment takes')
+        parser.add_argument('--strategy', choices=['reserve', 'locked', 'both'], default='both')
+
+    def handle(self, *args, **options):
+        strategies = ['reserve', 'locked'] if options['strategy'] == 'both' else [options['strategy']]
+
+        self.stdout.write(
+            f"{'strategy':<9} {'sold':>6} {'refused':>8} {'errors':>7} {'left':>6} {'oversold':>9} "
+            f"{'secs':>7} {'checkouts/s':>12} {'p50 ms':>8} {'p99 ms':>8}"
+        )
+        for strategy in strategies:
+            product = self.create_product(options['stock'])
+            try:
+                result = self.run(getattr(self, strategy), product.pk, options)
+                left = Stock.objects.get(product=product).quantity
+            finally:
+                product.category.delete()
+
+            outcomes, timings, seconds = result
+            sold = outcomes.count('sold')
+            self.stdout.write(
+                f"{strategy:<9} {sold:>6} {outcomes.count('refused'):>8} {outcomes.count('error'):>7} {left:>6} "
+                f"{max(0, sold + left - options['stock']):>9} {seconds:>7.2f} {len(outcomes) / seconds:>12.1f} "
+                f"{percentile(timings, 50) * 1000:>8.1f} {percentile(timings, 99) * 1000:>8.1f}"
+            )
+
+    def create_product(self, stock):
+        category, _ = Category.objects.get_or_create(slug=f'{PREFIX}-inventory', defaults={'name': 'Bench inventory'})
+        product = Product.objects.create(category=category, name='Hot product', slug='hot-product', price=10)
+        Stock.objects.create(product=product, quantity=stock)
+        return product
+
+    def run(self, checkout, product_id, options):
+        todo = iter(range(options['checkouts']))
+        lock = threading.Lock()
+        results = []
+
+        def worker():
+            try:
+                while True:
+                    with lock:
+                        if next(todo, None) is None:
+                            return
+                    start = time.perf_counter()
+                    try:
+                        outcome = checkout(product_id, options['latency'])
+                    except DatabaseError:
+                        outcome = 'error'
+                    results.append((outcome, time.perf_counter() - start))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(options['concurrency'])]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.perf_counter() - start
+
+        return [outcome for outcome, _ in results], [timing for _, timing in results], seconds
+
+    def reserve(self, product_id, latency):
+        """order.inventory: conditional UPDATE, the payment runs with no lock held"""
+        try:
+            key = inventory.reserve({product_id: 1})
+        except inventory.OutOfStock:
+            return 'refused'
+        time.sleep(latency)
+        with transaction.atomic():
+            inventory.confirm(key, {product_id: 1})
+        return 'sold'
+
+    def locked(self, product_id, latency):
+        """Read, check and save the stock row under SELECT FOR UPDATE until the order is paid"""
+        with transaction.atomic():
+            stock = Stock.objects.select_for_update().get(product_id=product_id)
+            if stock.quantity < 1:
+                return 'refused'
+            time.sleep(latency)
+            stock.quantity -= 1
+            stock.save(update_fields=['quantity'])
+        return 'sold'
@@ -0,0 +1,39 @@
+import asyncio
+import time
+
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from order import payments
+from order.fake_payments import FakePaymentServer
+
+
+class Command(BaseCommand):
+    help = 'Measure how many charges one process keeps in flight against the fake payment server'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--charges', type=int, default=200)
+        parser.add_argument('--latency', type=float, default=0.25, help='Seconds the fake provider takes per charge')
+
+    def handle(self, *args, **options):
+        with FakePaymentServer(latency=options['latency']) as server, override_settings(STRIPE_API_BASE=server.url):
+            sequential = asyncio.run(self.run(options['charges'] // 10 or 1, concurrent=False))
+            concurrent = asyncio.run(self.run(options['charges'], concurrent=True))
+
+        for label, (count, seconds) in (('one at a time', sequential), ('concurrent', concurrent)):
+            self.stdout.write(f'{label:<14} {count:6} charges in {seconds:7.2f}s   {count / seconds:8.1f} charges/sec')
+
+    async def run(self, count, concurrent):
+        def charge(i):
+            return payments.create_charge(1000, 'usd', 'tok_visa', 'Benchmark charge', f'bench-{concurrent}-{i}')
+
+        start = time.perf_counter()
+        if concurrent:
+            await asyncio.gather(*(charge(i) for i in range(count)))
+        else:
+            for i in range(count):
+                await charge(i)
+        elapsed = time.perf_counter() - start
+
+        await payments.get_client().aclose()
+        return count, elapsed
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from order.fake_payments import FakePaymentServer
+
+
+class Command(BaseCommand):
+    help = 'Run a local stand-in for the Stripe charges API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=12111)
+        parser.add_argument('--latency', type=float, default=0, help='Seconds every charge takes')
+        parser.add_argument('--verbose-requests', action='store_true')
+
+    def handle(self, *args, **options):
+        server = FakePaymentServer(options['host'], options['port'], options['latency'], options['verbose_requests'])
+        self.stdout.write(f'Fake payment server on {server.url}, set STRIPE_API_BASE={server.url}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
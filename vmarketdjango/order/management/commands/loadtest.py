@@ -0,0 +1,50 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from order import loadtest
+
+
+class Command(BaseCommand):
+    help = 'Drive every product and order API route and check per endpoint SQL query budgets'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rounds', type=int, default=50, help='Requests per endpoint')
+        parser.add_argument('--json', metavar='PATH', help='Also write the results to a JSON file')
+
+    def handle(self, *args, **options):
+        fixture = loadtest.get_fixture()
+        if fixture is None:
+            raise CommandError('No seeded data, run manage.py seed_data first')
+
+        endpoints = loadtest.get_endpoints(fixture)
+        results = loadtest.run(endpoints, fixture['token'], rounds=options['rounds'])
+        rows = [loadtest.summarize(endpoint, results[endpoint.name]) for endpoint in endpoints]
+
+        self.stdout.write(
+            f"{'endpoint':<20} {'reqs':>5} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>8}  status"
+        )
+        for row in rows:
+            self.stdout.write(
+                f"{row['endpoint']:<20} {row['requests']:>5} {row['rps']:>8.1f} {row['p50']:>8.2f} "
+                f"{row['p95']:>8.2f} {row['p99']:>8.2f} {row['queries']:>4}/{row['budget']:<3}  "
+                + ' '.join(f'{status}x{count}' for status, count in sorted(row['statuses'].items()))
+            )
+        for route, reason in loadtest.SKIPPED.items():
+            self.stdout.write(f'skipped {route}: {reason}')
+
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump(rows, f, indent=2)
+
+        unexpected = loadtest.unexpected_statuses(endpoints, results)
+        if unexpected:
+            raise CommandError('Unexpected status: ' + ', '.join(
+                f'{name} answered {statuses} instead of {expected}' for name, statuses, expected in unexpected
+            ))
+        failures = loadtest.over_budget(endpoints, results)
+        if failures:
+            raise CommandError('Over query budget: ' + ', '.join(
+                f'{name} ran {queries} queries (budget {budget})' for name, queries, budget in failures
+            ))
+        self.stdout.write(self.style.SUCCESS('All endpoints within their query budgets'))
@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from order import rollups
+
+
+class Command(BaseCommand):
+    help = 'Recompute the sales rollups from the order history, in chunks of orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Orders aggregated per transaction')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        last = rollups.reset()
+        chunk_size = options['chunk_size']
+
+        total = 0
+        for first in range(1, last + 1, chunk_size):
+            total += rollups.rebuild_chunk(first, first + chunk_size)
+            self.stdout.write(f'{min(first + chunk_size - 1, last)}/{last} order ids, {total} orders')
+        rollups.finish()
+
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt the rollups from {total} orders in {time.perf_counter() - start:.1f}s'))
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from order.inventory import release_expired
+
+
+class Command(BaseCommand):
+    help = 'Put the stock of expired checkout reservations back on sale'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--loop', action='store_true', help='Keep releasing instead of exiting once nothing has expired')
+        parser.add_argument('--interval', type=float, default=60, help='Seconds to wait between runs with --loop')
+
+    def handle(self, *args, **options):
+        while True:
+            released = release_expired(options['batch_size'])
+            self.stdout.write(f'Released {released} expired reservations')
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from order import seed
+
+
+class Command(BaseCommand):
+    help = 'Seed a reproducible dataset of categories, products, users, orders and addresses for load tests'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--categories', type=int, default=10)
+        parser.add_argument('--products', type=int, default=50, help='Products per category')
+        parser.add_argument('--users', type=int, default=20)
+        parser.add_argument('--orders', type=int, default=5, help='Orders per user')
+        parser.add_argument('--addresses', type=int, default=2, help='Addresses per user')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--replace', action='store_true', help='Delete a previously seeded dataset first')
+
+    def handle(self, *args, **options):
+        if seed.seeded_users().exists():
+            if not options['replace']:
+                raise CommandError('A seeded dataset already exists, pass --replace to recreate it')
+            seed.clear()
+
+        counts = seed.seed(
+            categories=options['categories'],
+            products=options['products'],
+            users=options['users'],
+            orders=options['orders'],
+            addresses=options['addresses'],
+            seed=options['seed'],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            'Seeded ' + ', '.join(f'{count} {name}' for name, count in counts.items())
+        ))
+        self.stdout.write(f'Every seeded user has the password "{seed.PASSWORD}"')
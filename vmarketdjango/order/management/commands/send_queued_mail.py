@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from order.mail import dispatch_batch
+
+
+class Command(BaseCommand):
+    help = 'Deliver queued outbox emails in batches over one reused connection'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--loop', action='store_true', help='Keep polling the outbox instead of exiting once it is drained')
+        parser.add_argument('--interval', type=float, default=5, help='Seconds to wait between polls with --loop')
+
+    def handle(self, *args, **options):
+        total_sent = total_failed = 0
+        while True:
+            try:
+                sent, failed = dispatch_batch(options['batch_size'])
+            except Exception as e:
+                # The mail server is down, the batch is retried once its lease expires
+                self.stderr.write(f'Delivery failed: {e}')
+                sent = failed = 0
+                if not options['loop']:
+                    break
+
+            total_sent += sent
+            total_failed += failed
+            if sent or failed:
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+        self.stdout.write(f'Sent {total_sent} emails, {total_failed} failed and will be retried')
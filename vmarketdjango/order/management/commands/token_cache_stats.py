@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from order.authentication import stats
+
+
+class Command(BaseCommand):
+    help = 'Show how often API tokens were resolved from the cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Zero the counters after reading them')
+
+    def handle(self, *args, **options):
+        counts = stats(reset=options['reset'])
+        hit_rate = counts['hit_rate']
+        self.stdout.write(
+            f"{counts['hits']} hits, {counts['misses']} misses, "
+            f"hit rate {'n/a' if hit_rate is None else f'{hit_rate:.1%}'}"
+        )
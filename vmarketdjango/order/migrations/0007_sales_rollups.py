@@ -0,0 +1,68 @@
+# Generated by Django 4.1.6 on 2026-10-18 15:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0006_unique_slugs'),
+        ('order', '0006_order_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(unique=True)),
+                ('orders', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+            ],
+            options={
+                'verbose_name_plural': 'Daily sales',
+            },
+        ),
+        migrations.CreateModel(
+            name='StatusCount',
+            fields=[
+                ('status', models.CharField(max_length=20, primary_key=True, serialize=False)),
+                ('orders', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ProductSales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('units', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='product.product')),
+            ],
+            options={
+                'verbose_name_plural': 'Product sales',
+            },
+        ),
+        migrations.CreateModel(
+            name='CategorySales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('units', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='product.category')),
+            ],
+            options={
+                'verbose_name_plural': 'Category sales',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='productsales',
+            constraint=models.UniqueConstraint(fields=('day', 'product'), name='product_sales_day_product_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='categorysales',
+            constraint=models.UniqueConstraint(fields=('day', 'category'), name='category_sales_day_category_uniq'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.1.6 on 2026-10-18 15:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('order', '0007_sales_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupRebuild',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('next_order_id', models.PositiveIntegerField()),
+                ('last_order_id', models.PositiveIntegerField()),
+            ],
+        ),
+    ]
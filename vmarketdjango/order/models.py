@@ -1,11 +1,16 @@
 from django.contrib.auth.models import User
-from django.db import models
-from django.db.models.signals import post_save
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.utils import timezone
 from datetime import timedelta
 
-from product.models import Product
+from rest_framework.authtoken.models import Token
+
+from product.models import Category, Product
+
+from . import rollups
+from .authentication import forget_token, forget_user
 
 class Order(models.Model):
     user = models.ForeignKey(User, related_name='orders', on_delete=models.CASCADE)
@@ -30,10 +35,21 @@ class Order(models.Model):
 
     class Meta:
         ordering = ['-created_at',]
+        indexes = [
+            models.Index(fields=['-created_at'], name='order_created_idx'),
+            models.Index(fields=['status', '-created_at'], name='order_status_created_idx'),
+        ]
 
     def __str__(self):
         return self.first_name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        order = super().from_db(db, field_names, values)
+        # Lets update_status_rollups see what the status was before a save
+        order._loaded_status = order.__dict__.get('status')
+        return order
+
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, related_name='items', on_delete=models.CASCADE)
     product = models.ForeignKey(Product, related_name='items', on_delete=models.CASCADE)
@@ -43,6 +59,103 @@ class OrderItem(models.Model):
     def __str__(self):
         return '%s' %self.id
 
+class CartItem(models.Model):
+    """Cart line of the database cart store, see order.cart"""
+    user = models.ForeignKey(User, related_name='cart_items', on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, related_name='cart_items', on_delete=models.CASCADE)
+    quantity = models.IntegerField(default=1)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'product'], name='cart_item_user_product_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product_id} for {self.user_id}"
+
+class Stock(models.Model):
+    """Units of a product left to sell, see order.inventory. Products without one are not tracked"""
+    product = models.OneToOneField(Product, related_name='stock', primary_key=True, on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.product_id}: {self.quantity}'
+
+class StockReservation(models.Model):
+    """Units taken from Stock by a checkout that has not finished yet"""
+    key = models.CharField(max_length=32, db_index=True)
+    product = models.ForeignKey(Product, related_name='reservations', on_delete=models.CASCADE)
+    user = models.ForeignKey(User, related_name='stock_reservations', null=True, on_delete=models.SET_NULL)
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f'{self.key}: {self.quantity} x {self.product_id}'
+
+class DailySales(models.Model):
+    """Orders and revenue per day, maintained by order.rollups"""
+    day = models.DateField(unique=True)
+    orders = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        verbose_name_plural = 'Daily sales'
+
+    def __str__(self):
+        return f'{self.day}: {self.revenue}'
+
+class ProductSales(models.Model):
+    """Units and revenue per product and day, maintained by order.rollups"""
+    day = models.DateField()
+    product = models.ForeignKey(Product, related_name='+', on_delete=models.CASCADE)
+    units = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        verbose_name_plural = 'Product sales'
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'product'], name='product_sales_day_product_uniq'),
+        ]
+
+    def __str__(self):
+        return f'{self.day}: {self.units} x {self.product_id}'
+
+class CategorySales(models.Model):
+    """Units and revenue per category and day, maintained by order.rollups"""
+    day = models.DateField()
+    category = models.ForeignKey(Category, related_name='+', on_delete=models.CASCADE)
+    units = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        verbose_name_plural = 'Category sales'
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'category'], name='category_sales_day_category_uniq'),
+        ]
+
+    def __str__(self):
+        return f'{self.day}: {self.units} x {self.category_id}'
+
+class StatusCount(models.Model):
+    """Number of orders in each status, maintained by order.rollups"""
+    status = models.CharField(max_length=20, primary_key=True)
+    orders = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.status}: {self.orders}'
+
+class RollupRebuild(models.Model):
+    """Progress of a rollup rebuild, at most one row. Orders with
+    ``next_order_id <= id <= last_order_id`` are not counted yet, so
+    status changes leave them to the rebuild"""
+    next_order_id = models.PositiveIntegerField()
+    last_order_id = models.PositiveIntegerField()
+
+    def __str__(self):
+        return f'{self.next_order_id}/{self.last_order_id}'
+
 class Address(models.Model):
     user = models.ForeignKey(User, related_name='addresses', on_delete=models.CASCADE)
     name = models.CharField(max_length=255)
@@ -125,6 +238,42 @@ class EmailVerification(models.Model):
     def __str__(self):
         return f"Email verification for {self.user.email}"
 
+class OutboxEmail(models.Model):
+    """An email waiting to be delivered by the send_queued_mail command"""
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField(blank=True)
+    from_email = models.CharField(max_length=255)
+    to = models.JSONField(default=list)
+    cc = models.JSONField(default=list, blank=True)
+    bcc = models.JSONField(default=list, blank=True)
+    reply_to = models.JSONField(default=list, blank=True)
+    headers = models.JSONField(default=dict, blank=True)
+    alternatives = models.JSONField(default=list, blank=True)
+    status = models.CharField(max_length=10, default=PENDING,
+                            choices=[
+                                (PENDING, 'Pending'),
+                                (SENT, 'Sent'),
+                                (FAILED, 'Failed'),
+                            ])
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['next_attempt_at']
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='outbox_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} to {', '.join(self.to)}"
+
 # Signal handlers for UserProfile creation
 
 @receiver(post_save, sender=User)
@@ -142,4 +291,27 @@ def save_user_profile(sender, instance, **kwargs):
         # Create profile if it doesn't exist
         UserProfile.objects.create(user=instance)
 
+@receiver(post_save, sender=User)
+def forget_cached_tokens(sender, instance, **kwargs):
+    """A saved user may have a new password or be deactivated, re-check its tokens.
+
+    After commit, so a rollback keeps the cache and no request re-caches the old row.
+    """
+    user_id = instance.pk
+    transaction.on_commit(lambda: forget_user(user_id))
+
+@receiver(post_delete, sender=Token)
+def forget_deleted_token(sender, instance, **kwargs):
+    """Logout and account deletion delete the token, stop accepting it once committed"""
+    key = instance.key
+    transaction.on_commit(lambda: forget_token(key))
 
+@receiver(post_save, sender=Order)
+def update_status_rollups(sender, instance, created, raw=False, **kwargs):
+    """Move a saved order between the status rollups. New orders are
+    recorded by checkout together with their items"""
+    previous = getattr(instance, '_loaded_status', None)
+    instance._loaded_status = instance.status
+    if raw or created or previous is None or previous == instance.status:
+        return
+    rollups.status_changed(instance, previous)
@@ -0,0 +1,6 @@
+from rest_framework.pagination import PageNumberPagination
+
+class OrderPagination(PageNumberPagination):
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
@@ -0,0 +1,203 @@
+"""Sales rollups: orders and revenue per day, units and revenue per
+product and per category and day, and the number of orders per status.
+
+Checkout adds every new order with ``record_order`` in the transaction
+that saves it, and saving an order with another status moves it with
+``status_changed``. Cancelled orders count in the status rollup only.
+Every update is one additive upsert per table, so concurrent checkouts
+never overwrite each other's counts. Bulk updates, deletes and orders
+written outside checkout are picked up by ``manage.py rebuild_rollups``,
+which records its progress in RollupRebuild: status changes of orders it
+has yet to reach are left to it, so they are not counted twice.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import connections, router, transaction
+from django.db.models import Case, Count, DecimalField, F, IntegerField, Sum, Value, When
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+CANCELLED = 'cancelled'
+BATCH_SIZE = 500
+
+
+def increment(model, keys, rows):
+    """Add the counters in ``rows``, dicts of field values, to the rows of
+    ``model`` matching their ``keys``, creating the rows that are missing"""
+    if not rows:
+        return
+
+    connection = connections[router.db_for_write(model)]
+    meta = model._meta
+    fields = [meta.get_field(name) for name in rows[0]]
+    counters = [field for field in fields if field.name not in keys and field.attname not in keys]
+    quote = connection.ops.quote_name
+    table = quote(meta.db_table)
+
+    if connection.vendor not in ('sqlite', 'postgresql', 'mysql'):
+        for row in rows:
+            lookup = {name: row[name] for name in keys}
+            updates = {field.attname: F(field.attname) + row[field.name] for field in counters}
+            if not model.objects.filter(**lookup).update(**updates):
+                model.objects.create(**row)
+        return
+
+    placeholders = '(%s)' % ', '.join(['%s'] * len(fields))
+    if connection.vendor == 'mysql':
+        conflict = ' ON DUPLICATE KEY UPDATE ' + ', '.join(
+            f'{quote(field.column)} = {quote(field.column)} + VALUES({quote(field.column)})' for field in counters
+        )
+    else:
+        conflict = ' ON CONFLICT (%s) DO UPDATE SET %s' % (
+            ', '.join(quote(meta.get_field(name).column) for name in keys),
+            ', '.join(f'{quote(field.column)} = {table}.{quote(field.column)} + excluded.{quote(field.column)}' for field in counters),
+        )
+
+    with connection.cursor() as cursor:
+        # Batches keep rebuilds under the bound parameter limits
+        for i in range(0, len(rows), BATCH_SIZE):
+            batch = rows[i:i + BATCH_SIZE]
+            sql = 'INSERT INTO %s (%s) VALUES %s%s' % (
+                table,
+                ', '.join(quote(field.column) for field in fields),
+                ', '.join([placeholders] * len(batch)),
+                conflict,
+            )
+            cursor.execute(sql, [field.get_db_prep_save(row[field.name], connection) for row in batch for field in fields])
+
+
+def add_units_sold(units):
+    """Add ``{product_id: units}`` to Product.units_sold, one UPDATE per batch"""
+    from product.models import Product
+
+    # Sorted, so concurrent checkouts lock the product rows in the same order
+    units = sorted((product_id, count) for product_id, count in units.items() if count)
+    for i in range(0, len(units), BATCH_SIZE):
+        batch = units[i:i + BATCH_SIZE]
+        Product.objects.filter(pk__in=[product_id for product_id, _ in batch]).update(units_sold=F('units_sold') + Case(
+            *[When(pk=product_id, then=Value(count)) for product_id, count in batch],
+            output_field=IntegerField(),
+        ))
+
+
+def add_sales(day, orders, revenue, lines, sign=1):
+    """Add (or with ``sign=-1`` take back) orders and their
+    ``(product_id, category_id, quantity, price)`` lines"""
+    from .models import CategorySales, DailySales, ProductSales
+
+    products = defaultdict(lambda: [0, Decimal(0)])
+    categories = defaultdict(lambda: [0, Decimal(0)])
+    for product_id, category_id, quantity, price in lines:
+        for totals in (products[product_id], categories[category_id]):
+            totals[0] += quantity
+            totals[1] += quantity * price
+
+    increment(DailySales, ['day'], [{'day': day, 'orders': sign * orders, 'revenue': sign * revenue}])
+    increment(ProductSales, ['day', 'product'], [
+        {'day': day, 'product': product_id, 'units': sign * units, 'revenue': sign * amount}
+        for product_id, (units, amount) in sorted(products.items())
+    ])
+    increment(CategorySales, ['day', 'category'], [
+        {'day': day, 'category': category_id, 'units': sign * units, 'revenue': sign * amount}
+        for category_id, (units, amount) in sorted(categories.items())
+    ])
+    add_units_sold({product_id: sign * units for product_id, (units, _) in products.items()})
+
+
+def record_order(order, items):
+    """Count a new order, ``items`` are its OrderItems with their products"""
+    from .models import StatusCount
+
+    if order.status != CANCELLED:
+        lines = [(item.product.pk, item.product.category_id, item.quantity, item.price) for item in items]
+        add_sales(timezone.localdate(order.created_at), 1, order.paid_amount or 0, lines)
+    increment(StatusCount, ['status'], [{'status': order.status, 'orders': 1}])
+
+
+def rebuild_pending(order_id):
+    """Whether a running rebuild has yet to count the order"""
+    from .models import RollupRebuild
+
+    return RollupRebuild.objects.filter(next_order_id__lte=order_id, last_order_id__gte=order_id).exists()
+
+
+def status_changed(order, previous):
+    from .models import StatusCount
+
+    if rebuild_pending(order.pk):
+        return
+
+    increment(StatusCount, ['status'], [
+        {'status': previous, 'orders': -1},
+        {'status': order.status, 'orders': 1},
+    ])
+
+    if (previous == CANCELLED) != (order.status == CANCELLED):
+        lines = order.items.values_list('product_id', 'product__category_id', 'quantity', 'price')
+        sign = -1 if order.status == CANCELLED else 1
+        add_sales(timezone.localdate(order.created_at), 1, order.paid_amount or 0, lines, sign)
+
+
+@transaction.atomic
+def reset():
+    """Empty every rollup and return the highest order id they have to be rebuilt up to.
+
+    Orders placed from now on are counted by checkout as usual. Call
+    ``rebuild_chunk`` for every id up to that one, in order, then ``finish``.
+    """
+    from product.models import Product
+    from .models import CategorySales, DailySales, Order, ProductSales, RollupRebuild, StatusCount
+
+    for model in (DailySales, ProductSales, CategorySales, StatusCount):
+        model.objects.all().delete()
+    Product.objects.exclude(units_sold=0).update(units_sold=0)
+    last = Order.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+    RollupRebuild.objects.all().delete()
+    RollupRebuild.objects.create(next_order_id=1, last_order_id=last)
+    return last
+
+
+def finish():
+    """Mark the rebuild done, status changes are counted for every order again"""
+    from .models import RollupRebuild
+
+    RollupRebuild.objects.all().delete()
+
+
+@transaction.atomic
+def rebuild_chunk(start, stop):
+    """Add the orders with ``start <= id < stop`` to the rollups, aggregated
+    by the database. Returns how many orders there were"""
+    from .models import CategorySales, DailySales, Order, OrderItem, ProductSales, RollupRebuild, StatusCount
+
+    orders = Order.objects.filter(pk__gte=start, pk__lt=stop).order_by()
+    # A status change of these orders either commits before they are read,
+    # or waits and then finds them counted
+    list(orders.select_for_update().values_list('pk', flat=True))
+    sales = orders.exclude(status=CANCELLED)
+    items = OrderItem.objects.filter(order__in=sales).order_by().annotate(day=TruncDate('order__created_at'))
+    line_totals = {'units': Sum('quantity'), 'revenue': Sum(F('price') * F('quantity'), output_field=DecimalField())}
+
+    days = sales.annotate(day=TruncDate('created_at')).values('day').annotate(orders=Count('pk'), revenue=Sum('paid_amount'))
+    products = list(items.values('day', 'product_id').annotate(**line_totals))
+    categories = items.values('day', category_id=F('product__category_id')).annotate(**line_totals)
+    statuses = list(orders.values('status').annotate(orders=Count('pk')))
+
+    increment(DailySales, ['day'], [
+        {'day': row['day'], 'orders': row['orders'], 'revenue': row['revenue'] or 0} for row in days
+    ])
+    increment(ProductSales, ['day', 'product'], [
+        {'day': row['day'], 'product': row['product_id'], 'units': row['units'], 'revenue': row['revenue']} for row in products
+    ])
+    increment(CategorySales, ['day', 'category'], [
+        {'day': row['day'], 'category': row['category_id'], 'units': row['units'], 'revenue': row['revenue']} for row in categories
+    ])
+    increment(StatusCount, ['status'], [{'status': row['status'], 'orders': row['orders']} for row in statuses])
+
+    units_sold = defaultdict(int)
+    for row in products:
+        units_sold[row['product_id']] += row['units']
+    add_units_sold(units_sold)
+    RollupRebuild.objects.update(next_order_id=stop)
+    return sum(row['orders'] for row in statuses)
@@ -0,0 +1,145 @@
+"""Deterministic sample data for load tests and benchmarks.
+
+Everything is created with bulk inserts and marked with a ``bench``
+prefix (category slugs, usernames) so a seeded dataset can be found and
+replaced again. The same ``seed`` always produces the same rows.
+"""
+import random
+from decimal import Decimal
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+from rest_framework.authtoken.models import Token
+
+from product import search
+from product.cache import bump_catalog_version
+from product.models import Category, Product
+
+from .models import Address, Order, OrderItem, Stock, UserProfile, UserSettings
+
+PREFIX = 'bench'
+PASSWORD = 'bench-password'
+
+WORDS = (
+    'phone laptop wireless charger cable gaming mouse keyboard monitor speaker '
+    'camera lens tripod headphones bluetooth smart watch tablet case glass '
+    'steel leather cotton black white silver pro mini max ultra compact portable'
+).split()
+
+CITIES = ['Berlin', 'Lisbon', 'Oslo', 'Prague', 'Vienna', 'Warsaw']
+
+
+def seeded_users():
+    return User.objects.filter(username__startswith=f'{PREFIX}-user-').order_by('pk')
+
+
+def clear():
+    """Delete a previously seeded dataset"""
+    with transaction.atomic():
+        seeded_users().delete()
+        Category.objects.filter(slug__startswith=f'{PREFIX}-').delete()
+
+
+@transaction.atomic
+def seed(categories=10, products=50, users=20, orders=5, addresses=2, seed=42):
+    """Create ``categories`` with ``products`` each, and ``users`` with
+    ``orders`` and ``addresses`` each. Returns the created row counts."""
+    rng = random.Random(seed)
+
+    category_objs = Category.objects.bulk_create(
+        Category(name=f'Bench {c}', slug=f'{PREFIX}-{c}') for c in range(categories)
+    )
+    product_objs = Product.objects.bulk_create(
+        (
+            Product(
+                category=category,
+                name=' '.join(rng.choices(WORDS, k=3)).title(),
+                slug=f'{PREFIX}-{p}',
+                description=' '.join(rng.choices(WORDS, k=30)),
+                price=Decimal(rng.randint(100, 100000)) / 100,
+            )
+            for category in category_objs
+            for p in range(products)
+        ),
+        batch_size=2000,
+    )
+    Stock.objects.bulk_create(
+        (Stock(product=product, quantity=rng.randint(1000, 100000)) for product in product_objs),
+        batch_size=2000,
+    )
+
+    # Hashing is slow on purpose, every seeded user shares one hash
+    password = make_password(PASSWORD)
+    user_objs = User.objects.bulk_create(
+        User(
+            username=f'{PREFIX}-user-{u}',
+            email=f'{PREFIX}-user-{u}@example.com',
+            first_name='Bench',
+            last_name=f'User {u}',
+            password=password,
+        )
+        for u in range(users)
+    )
+    # bulk_create skips the signals that normally create these
+    UserProfile.objects.bulk_create(UserProfile(user=user) for user in user_objs)
+    UserSettings.objects.bulk_create(UserSettings(user=user) for user in user_objs)
+    Token.objects.bulk_create(Token(user=user, key=Token.generate_key()) for user in user_objs)
+
+    Address.objects.bulk_create(
+        Address(
+            user=user,
+            name=f'Address {a}',
+            address_line1=f'{rng.randint(1, 200)} Main Street',
+            city=rng.choice(CITIES),
+            state='State',
+            zip_code=f'{rng.randint(10000, 99999)}',
+            phone='+10000000000',
+            is_default=a == 0,
+        )
+        for user in user_objs
+        for a in range(addresses)
+    )
+
+    order_lines = []
+    for user in user_objs:
+        for o in range(orders):
+            lines = [(product, rng.randint(1, 3)) for product in rng.sample(product_objs, min(len(product_objs), rng.randint(1, 5)))]
+            order = Order(
+                user=user,
+                first_name=user.first_name,
+                last_name=user.last_name,
+                email=user.email,
+                address='1 Main Street',
+                zipcode='10000',
+                place=rng.choice(CITIES),
+                phone='+10000000000',
+                paid_amount=sum(product.price * quantity for product, quantity in lines),
+                stripe_token=f'tok_{PREFIX}_{user.pk}_{o}',
+                status=rng.choice(['pending', 'processing', 'shipped', 'delivered']),
+            )
+            order_lines.append((order, lines))
+
+    Order.objects.bulk_create([order for order, _ in order_lines], batch_size=2000)
+    items = OrderItem.objects.bulk_create(
+        (
+            OrderItem(order=order, product=product, price=product.price, quantity=quantity)
+            for order, lines in order_lines
+            for product, quantity in lines
+        ),
+        batch_size=2000,
+    )
+
+    if search.is_available():
+        search.rebuild(Product.objects.order_by().values_list('id', 'name', 'description').iterator(chunk_size=2000))
+    transaction.on_commit(bump_catalog_version)
+
+    return {
+        'categories': len(category_objs),
+        'products': len(product_objs),
+        'stock': len(product_objs),
+        'users': len(user_objs),
+        'orders': len(order_lines),
+        'order items': len(items),
+        'addresses': users * addresses,
+    }
@@ -1,11 +1,16 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
+from django.db import transaction
 
+from . import rollups
 from .models import Order, OrderItem, Address, UserSettings
 
+from product import recommendations
+from product.models import Product
 from product.serializers import ProductSerializer
+from vmarketdjango.metrics import TimedSerializerMixin
 
-class CartItemSerializer(serializers.ModelSerializer):
+class CartItemSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     product = ProductSerializer()
     
     class Meta:
@@ -29,7 +34,7 @@ class MyOrderItemSerializer(serializers.ModelSerializer):
             "quantity",
         )
 
-class MyOrderSerializer(serializers.ModelSerializer):
+class MyOrderSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     items = MyOrderItemSerializer(many=True)
 
     class Meta:
@@ -50,7 +55,48 @@ class MyOrderSerializer(serializers.ModelSerializer):
             "status"
         )
 
+class OrderSummarySerializer(TimedSerializerMixin, serializers.Serializer):
+    """Order history row built from the aggregate values() query of OrdersList"""
+    id = serializers.IntegerField()
+    created_at = serializers.DateTimeField()
+    status = serializers.CharField()
+    paid_amount = serializers.DecimalField(max_digits=9, decimal_places=2)
+    total = serializers.DecimalField(max_digits=12, decimal_places=2)
+    item_count = serializers.IntegerField()
+
+class DailySalesSerializer(TimedSerializerMixin, serializers.Serializer):
+    """Row of DailySales read with values()"""
+    day = serializers.DateField()
+    orders = serializers.IntegerField()
+    revenue = serializers.DecimalField(max_digits=14, decimal_places=2)
+
+class CategorySalesSerializer(TimedSerializerMixin, serializers.Serializer):
+    """Category totals summed from the CategorySales rows of a date range"""
+    id = serializers.IntegerField(source='category_id')
+    name = serializers.CharField()
+    units = serializers.IntegerField()
+    revenue = serializers.DecimalField(max_digits=14, decimal_places=2)
+
+class ProductSalesSerializer(CategorySalesSerializer):
+    """Product totals summed from the ProductSales rows of a date range"""
+    id = serializers.IntegerField(source='product_id')
+
+class ProductPrimaryKeyField(serializers.PrimaryKeyRelatedField):
+    """Accept a product pk without looking it up.
+
+    OrderSerializer resolves the products of every line in a single query.
+    """
+    def to_internal_value(self, data):
+        if isinstance(data, bool):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        try:
+            return int(data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+
 class OrderItemSerializer(serializers.ModelSerializer):    
+    product = ProductPrimaryKeyField(queryset=Product.objects.all())
+
     class Meta:
         model = OrderItem
         fields = (
@@ -59,7 +105,7 @@ class OrderItemSerializer(serializers.ModelSerializer):
             "quantity",
         )
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     items = OrderItemSerializer(many=True)
 
     class Meta:
@@ -77,16 +123,29 @@ class OrderSerializer(serializers.ModelSerializer):
             "items",
         )
     
+    def validate_items(self, items):
+        products = Product.objects.in_bulk({item['product'] for item in items})
+
+        for item in items:
+            if item['product'] not in products:
+                raise serializers.ValidationError(f'Invalid pk "{item["product"]}" - object does not exist.')
+            item['product'] = products[item['product']]
+
+        return items
+
     def create(self, validated_data):
         items_data = validated_data.pop('items')
-        order = Order.objects.create(**validated_data)
 
-        for item_data in items_data:
-            OrderItem.objects.create(order=order, **item_data)
+        # Checkout saves inside its own transaction, a savepoint would only add queries
+        with transaction.atomic(savepoint=False):
+            order = Order.objects.create(**validated_data)
+            items = OrderItem.objects.bulk_create([OrderItem(order=order, **item_data) for item_data in items_data])
+            rollups.record_order(order, items)
+            recommendations.record_order(item.product.pk for item in items)
             
         return order
 
-class AddressSerializer(serializers.ModelSerializer):
+class AddressSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Address
         fields = (
@@ -109,7 +168,7 @@ class AddressSerializer(serializers.ModelSerializer):
         validated_data['user'] = user
         return super().create(validated_data)
 
-class UserSettingsSerializer(serializers.ModelSerializer):
+class UserSettingsSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = UserSettings
         fields = (
@@ -126,7 +185,7 @@ class UserSettingsSerializer(serializers.ModelSerializer):
         )
         read_only_fields = ('id', 'created_at', 'updated_at')
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = (
@@ -138,7 +197,7 @@ class UserSerializer(serializers.ModelSerializer):
         )
         read_only_fields = ('id', 'username', 'email')
 
-class UserProfileSerializer(serializers.ModelSerializer):
+class UserProfileSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     name = serializers.SerializerMethodField()
     phone = serializers.CharField(source='profile.phone', required=False, allow_blank=True, allow_null=True)
     
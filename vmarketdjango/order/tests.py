@@ -1,3 +1,798 @@
-from django.test import TestCase
+import asyncio
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+import stripe
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.admin import site
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.management import call_command
+from django.db import DatabaseError, connection, transaction
+from django.conf import settings
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework.views import APIView
+
+from order import authentication, inventory, loadtest, rollups, seed
+from order.cart import CacheCartStore, get_cart_store
+from order.fake_payments import DECLINED_SOURCE, FakePaymentServer
+from order.mail import dispatch_batch
+from order.models import CartItem, Order, OrderItem, OutboxEmail, ProductSales, Stock, StockReservation
+from order.serializers import OrderSerializer
+from product.models import Category, Product
+from product.serializers import ProductSerializer
+from vmarketdjango import metrics, routers
+from vmarketdjango.paginator import EstimatedCountPaginator
+
+
+class BrokenBackend(BaseEmailBackend):
+    def send_messages(self, email_messages):
+        raise ConnectionRefusedError('SMTP server is down')
+
+
+@override_settings(
+    EMAIL_BACKEND='order.mail.OutboxBackend',
+    OUTBOX_DELIVERY_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+)
+class OutboxTests(TestCase):
+    def test_send_mail_only_queues(self):
+        mail.send_mail('Hello', 'Body', 'shop@example.com', ['customer@example.com'])
+
+        self.assertEqual(len(mail.outbox), 0)
+        email = OutboxEmail.objects.get()
+        self.assertEqual(email.status, OutboxEmail.PENDING)
+        self.assertEqual(email.to, ['customer@example.com'])
+
+    def test_verification_email_is_queued(self):
+        user = User.objects.create_user('customer', 'customer@example.com', 'secret-password')
+        client = APIClient()
+        client.force_authenticate(user)
+
+        response = client.post('/api/v1/email/verify/', {'email': 'customer@example.com'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertIn(user.email_verification.token, OutboxEmail.objects.get().body)
+
+    def test_dispatcher_drains_outbox_in_batches(self):
+        for i in range(5):
+            mail.send_mail(f'Hello {i}', 'Body', 'shop@example.com', [f'customer{i}@example.com'])
+
+        call_command('send_queued_mail', batch_size=2, stdout=StringIO())
+
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertFalse(OutboxEmail.objects.exclude(status=OutboxEmail.SENT).exists())
+
+    @override_settings(OUTBOX_DELIVERY_BACKEND='order.tests.BrokenBackend', OUTBOX_MAX_ATTEMPTS=2, OUTBOX_RETRY_DELAY=60)
+    def test_failures_back_off_then_give_up(self):
+        mail.send_mail('Hello', 'Body', 'shop@example.com', ['customer@example.com'])
+
+        self.assertEqual(dispatch_batch(), (0, 1))
+        email = OutboxEmail.objects.get()
+        self.assertEqual(email.status, OutboxEmail.PENDING)
+        self.assertEqual(email.attempts, 1)
+        self.assertGreater(email.next_attempt_at, timezone.now() + timedelta(seconds=50))
+        self.assertIn('SMTP server is down', email.last_error)
+
+        # Not due yet
+        self.assertEqual(dispatch_batch(), (0, 0))
+
+        OutboxEmail.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(dispatch_batch(), (0, 1))
+        self.assertEqual(OutboxEmail.objects.get().status, OutboxEmail.FAILED)
+
+
+@override_settings(CART_STORE='order.cart.DatabaseCartStore')
+class CartSyncTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('customer', 'customer@example.com', 'secret-password')
+        category = Category.objects.create(name='Category', slug='category')
+        cls.products = Product.objects.bulk_create(
+            Product(category=category, name=f'Product {p}', slug=f'product-{p}', price=p + 1)
+            for p in range(50)
+        )
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def sync(self, items, mode='replace'):
+        response = self.client.post('/api/v1/cart/sync/', {'items': items, 'mode': mode}, format='json')
+        self.assertEqual(response.status_code, 200)
+        return {line['id']: line['quantity'] for line in response.data}
+
+    def test_replace_syncs_whole_cart_in_a_few_queries(self):
+        CartItem.objects.create(user=self.user, product=self.products[0], quantity=7)
+        items = [{'product_id': product.pk, 'quantity': 2} for product in self.products[1:]]
+
+        with self.assertNumQueries(7):
+            cart = self.sync(items + [{'product_id': 0, 'quantity': 1}])
+
+        self.assertEqual(cart, {product.pk: 2 for product in self.products[1:]})
+        self.assertEqual(CartItem.objects.filter(user=self.user).count(), 49)
+
+    def test_add_applies_deltas(self):
+        first, second, third = self.products[:3]
+        self.sync([{'product_id': first.pk, 'quantity': 1}, {'product_id': second.pk, 'quantity': 2}])
+
+        cart = self.sync([
+            {'product_id': first.pk, 'quantity': 2},
+            {'product_id': first.pk, 'quantity': 1},
+            {'product_id': second.pk, 'quantity': -2},
+            {'product_id': third.pk},
+        ], mode='add')
+
+        self.assertEqual(cart, {first.pk: 4, third.pk: 1})
+
+
+class InventoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Category', slug='category')
+        cls.hot, cls.other, cls.untracked = Product.objects.bulk_create(
+            Product(category=category, name=f'Product {p}', slug=f'product-{p}', price=10) for p in range(3)
+        )
+        Stock.objects.bulk_create([Stock(product=cls.hot, quantity=3), Stock(product=cls.other, quantity=5)])
+
+    def stock(self):
+        return dict(Stock.objects.values_list('product_id', 'quantity'))
+
+    def test_reserve_and_confirm(self):
+        key = inventory.reserve({self.hot.pk: 2, self.other.pk: 1, self.untracked.pk: 9})
+        self.assertEqual(self.stock(), {self.hot.pk: 1, self.other.pk: 4})
+
+        self.assertEqual(inventory.confirm(key, {self.hot.pk: 2, self.other.pk: 1, self.untracked.pk: 9}), 2)
+        self.assertFalse(StockReservation.objects.exists())
+        self.assertEqual(self.stock(), {self.hot.pk: 1, self.other.pk: 4})
+
+    def test_short_stock_reserves_nothing(self):
+        with self.assertRaises(inventory.OutOfStock) as raised:
+            inventory.reserve({self.hot.pk: 4, self.other.pk: 1})
+
+        self.assertEqual((raised.exception.product_id, raised.exception.available), (self.hot.pk, 3))
+        self.assertEqual(self.stock(), {self.hot.pk: 3, self.other.pk: 5})
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_release_puts_stock_back(self):
+        key = inventory.reserve({self.hot.pk: 3})
+        with self.assertRaises(inventory.OutOfStock):
+            inventory.reserve({self.hot.pk: 1})
+
+        self.assertEqual(inventory.release(key), 1)
+        self.assertEqual(self.stock()[self.hot.pk], 3)
+
+    def test_expired_reservations_are_released_in_bulk(self):
+        for _ in range(3):
+            inventory.reserve({self.hot.pk: 1, self.other.pk: 1}, ttl=-1)
+        kept = inventory.reserve({self.other.pk: 2})
+
+        with self.assertNumQueries(5):
+            self.assertEqual(inventory.release_expired(batch_size=10), 6)
+
+        self.assertEqual(self.stock(), {self.hot.pk: 3, self.other.pk: 3})
+        self.assertEqual(list(StockReservation.objects.values_list('key', flat=True)), [kept])
+
+    def test_confirm_after_release_takes_the_stock_again(self):
+        key = inventory.reserve({self.hot.pk: 2, self.other.pk: 1}, ttl=-1)
+        self.assertEqual(inventory.release_expired(), 2)
+        self.assertEqual(self.stock(), {self.hot.pk: 3, self.other.pk: 5})
+
+        self.assertEqual(inventory.confirm(key, {self.hot.pk: 2, self.other.pk: 1, self.untracked.pk: 1}), 0)
+        self.assertEqual(self.stock(), {self.hot.pk: 1, self.other.pk: 4})
+
+    def test_confirm_after_release_and_sell_out_fails(self):
+        key = inventory.reserve({self.hot.pk: 2}, ttl=-1)
+        inventory.release_expired()
+        inventory.confirm(inventory.reserve({self.hot.pk: 2}), {self.hot.pk: 2})
+
+        with self.assertRaises(inventory.OutOfStock) as raised, transaction.atomic():
+            inventory.confirm(key, {self.hot.pk: 2})
+        self.assertEqual(raised.exception.available, 1)
+        self.assertEqual(self.stock()[self.hot.pk], 1)
+
+
+class CheckoutTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('customer', 'customer@example.com', 'secret-password')
+        category = Category.objects.create(name='Category', slug='category')
+        cls.products = Product.objects.bulk_create(
+            Product(category=category, name=f'Product {p}', slug=f'product-{p}', price=2) for p in range(20)
+        )
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def data(self, products):
+        return {
+            'first_name': 'First', 'last_name': 'Last', 'email': 'customer@example.com', 'address': '1 Main Street',
+            'zipcode': '10000', 'place': 'Berlin', 'phone': '+10000000000', 'stripe_token': 'tok_visa',
+            'items': [{'product': product.pk, 'quantity': 1, 'price': '2.00'} for product in products],
+        }
+
+    def checkout(self, products):
+        with mock.patch('stripe.Charge.create', return_value=mock.Mock(id='ch_1')), CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/v1/checkout/', self.data(products), format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_the_cart(self):
+        self.assertEqual(self.checkout(self.products[:2]), self.checkout(self.products))
+
+        order = Order.objects.latest('pk')
+        self.assertEqual((order.items.count(), order.paid_amount), (20, 40))
+
+    def failed_save(self, refund):
+        Stock.objects.create(product=self.products[0], quantity=5)
+        with mock.patch('stripe.Charge.create', return_value=mock.Mock(id='ch_1')), \
+                mock.patch('stripe.Refund.create', side_effect=refund) as refunded, \
+                mock.patch('order.views.save_order', side_effect=RuntimeError('database went away')), \
+                self.assertLogs('vmarket.checkout', 'ERROR') as logs:
+            response = self.client.post('/api/v1/checkout/', self.data(self.products[:1]), format='json')
+
+        self.assertEqual(response.status_code, 500)
+        refunded.assert_called_once_with(charge='ch_1', idempotency_key='refund-ch_1')
+        self.assertEqual(Stock.objects.get(product=self.products[0]).quantity, 5)
+        self.assertFalse(StockReservation.objects.exists())
+        return logs.output
+
+    def test_failed_save_refunds_the_charge(self):
+        self.failed_save(refund=None)
+
+    def test_failed_refund_is_logged(self):
+        output = self.failed_save(refund=stripe.error.APIConnectionError('Stripe is down'))
+
+        self.assertIn('Refunding charge ch_1 failed, it needs a manual refund', output[-1])
+
+    def test_unknown_products_are_rejected(self):
+        serializer = OrderSerializer(data={**self.data(self.products[:1]), 'items': [{'product': 0, 'quantity': 1, 'price': '2.00'}]})
+
+        self.assertFalse(serializer.is_valid())
+        self.assertEqual(serializer.errors['items'], ['Invalid pk "0" - object does not exist.'])
+
+    def test_order_and_items_are_saved_together(self):
+        serializer = OrderSerializer(data=self.data(self.products[:3]))
+        serializer.is_valid(raise_exception=True)
+
+        with mock.patch.object(OrderItem.objects, 'bulk_create', side_effect=DatabaseError), self.assertRaises(DatabaseError):
+            with transaction.atomic():
+                serializer.save(user=self.user, paid_amount=6)
+        self.assertFalse(Order.objects.exists())
+
+
+class OrderHistoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('customer', 'customer@example.com', 'secret-password')
+        category = Category.objects.create(name='Category', slug='category')
+        cls.products = Product.objects.bulk_create(
+            Product(category=category, name=f'Product {p}', slug=f'product-{p}', price=p + 1) for p in range(5)
+        )
+        for o in range(25):
+            order = Order.objects.create(user=cls.user, first_name=f'Order {o}', stripe_token='tok', paid_amount=o)
+            OrderItem.objects.bulk_create(
+                OrderItem(order=order, product=product, price=product.price, quantity=o + 1)
+                for product in cls.products[:o % 5 + 1]
+            )
+        cls.other = Order.objects.create(user=User.objects.create_user('other'), first_name='Other', stripe_token='tok')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get(self, url, queries, **params):
+        with self.assertNumQueries(queries):
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_pages_load_items_in_a_fixed_number_of_queries(self):
+        page = self.get('/api/v1/orders/', 3)
+        self.assertEqual((page['count'], len(page['results'])), (25, 20))
+
+        last = self.get('/api/v1/orders/', 3, page=2)
+        self.assertEqual(len(last['results']), 5)
+        orders = page['results'] + last['results']
+        self.assertNotIn(self.other.pk, [order['id'] for order in orders])
+        self.assertEqual(sum(len(order['items']) for order in orders), 75)
+
+    def test_summary_is_one_aggregate_query(self):
+        rows = self.get('/api/v1/orders/', 2, summary=1, page_size=100)['results']
+
+        self.assertEqual(len(rows), 25)
+        self.assertNotIn('items', rows[0])
+        # The seventh order has seven of each of the first two products
+        row = next(row for row in rows if row['paid_amount'] == '6.00')
+        self.assertEqual((row['item_count'], row['total']), (14, '21.00'))
+
+    def test_other_users_orders_are_hidden(self):
+        self.assertEqual(self.client.get(f'/api/v1/orders/{self.other.pk}/').status_code, 404)
+
+
+class AdminTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'secret-password')
+        category = Category.objects.create(name='Category', slug='category')
+        products = Product.objects.bulk_create(
+            Product(category=category, name=f'Product {p}', slug=f'product-{p}', price=1) for p in range(30)
+        )
+        for o in range(30):
+            order = Order.objects.create(user=cls.admin, first_name=f'Customer {o}', stripe_token='tok')
+            OrderItem.objects.bulk_create(OrderItem(order=order, product=product, price=1) for product in products)
+        cls.order = order
+        Stock.objects.bulk_create(Stock(product=product, quantity=100) for product in products)
+        for _ in range(30):
+            inventory.reserve({product.pk: 1 for product in products[:3]}, cls.admin)
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def test_pages_do_not_query_per_row(self):
+        pages = {
+            '/admin/order/order/': 5,
+            '/admin/order/orderitem/': 5,
+            '/admin/product/product/': 5,
+            '/admin/order/stock/': 5,
+            '/admin/order/stockreservation/': 5,
+            f'/admin/order/order/{self.order.pk}/change/': 8,
+        }
+        for url, queries in pages.items():
+            with self.subTest(url=url), self.assertNumQueries(queries):
+                self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_large_tables_are_not_counted(self):
+        for model in (Order, OrderItem, OutboxEmail, Stock, StockReservation):
+            with self.subTest(model=model.__name__):
+                model_admin = site._registry[model]
+                self.assertIs(model_admin.paginator, EstimatedCountPaginator)
+                self.assertFalse(model_admin.show_full_result_count)
+
+
+class RollupTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('staff', 'staff@example.com', 'secret-password', is_staff=True)
+        cls.phones = Category.objects.create(name='Phones', slug='phones')
+        cls.cases = Category.objects.create(name='Cases', slug='cases')
+        cls.phone = Product.objects.create(category=cls.phones, name='Phone', slug='phone', price=100)
+        cls.case = Product.objects.create(category=cls.cases, name='Case', slug='case', price=10)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def place_order(self, *lines):
+        serializer = OrderSerializer(data={
+            'first_name': 'Ada', 'last_name': 'Lovelace', 'email': 'ada@example.com', 'address': '1 Main Street',
+            'zipcode': '10000', 'place': 'Berlin', 'phone': '+10000000000', 'stripe_token': 'tok_visa',
+            'items': [{'product': product.pk, 'quantity': quantity, 'price': product.price} for product, quantity in lines],
+        })
+        serializer.is_valid(raise_exception=True)
+        return serializer.save(user=self.user, paid_amount=sum(product.price * quantity for product, quantity in lines))
+
+    def report(self):
+        response = self.client.get('/api/v1/reports/sales/')
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_checkout_and_status_changes_update_rollups(self):
+        self.place_order((self.phone, 1), (self.case, 2))
+        order = self.place_order((self.case, 3))
+
+        report = self.report()
+        self.assertEqual((report['orders'], report['revenue'], report['statuses']), (2, '150.00', {'pending': 2}))
+        self.assertEqual([(row['name'], row['units']) for row in report['top_products']], [('Case', 5), ('Phone', 1)])
+
+        order = Order.objects.get(pk=order.pk)
+        order.status = 'cancelled'
+        order.save()
+
+        report = self.report()
+        self.assertEqual((report['orders'], report['revenue']), (1, '120.00'))
+        self.assertEqual(report['statuses'], {'pending': 1, 'cancelled': 1})
+        self.assertEqual([(row['name'], row['units']) for row in report['categories']], [('Phones', 1), ('Cases', 2)])
+        self.assertEqual(sorted(Product.objects.values_list('name', 'units_sold')), [('Case', 2), ('Phone', 1)])
+
+    def test_rebuild_matches_incremental_rollups(self):
+        for quantity in range(1, 8):
+            self.place_order((self.phone, quantity), (self.case, 1))
+        before = self.report()
+        units = sorted(ProductSales.objects.values_list('product_id', 'units'))
+
+        last = rollups.reset()
+        self.assertEqual(sum(rollups.rebuild_chunk(start, start + 3) for start in range(1, last + 1, 3)), 7)
+        rollups.finish()
+
+        self.assertEqual(self.report(), before)
+        self.assertEqual(sorted(ProductSales.objects.values_list('product_id', 'units')), units)
+        self.assertEqual(sorted(Product.objects.values_list('units_sold', flat=True)), [7, 28])
+
+    def test_status_changes_during_a_rebuild_are_counted_once(self):
+        orders = [self.place_order((self.phone, 1)) for _ in range(4)]
+
+        last = rollups.reset()
+        rollups.rebuild_chunk(1, orders[2].pk)
+        for order in (orders[0], orders[3]):
+            order = Order.objects.get(pk=order.pk)
+            order.status = 'cancelled'
+            order.save()
+        rollups.rebuild_chunk(orders[2].pk, last + 1)
+        rollups.finish()
+
+        report = self.report()
+        self.assertEqual((report['orders'], report['statuses']), (2, {'pending': 2, 'cancelled': 2}))
+        self.assertEqual(Product.objects.get(pk=self.phone.pk).units_sold, 2)
+
+        # Once finished, status changes count again
+        order = Order.objects.get(pk=orders[1].pk)
+        order.status = 'cancelled'
+        order.save()
+        self.assertEqual(self.report()['statuses'], {'pending': 1, 'cancelled': 3})
+
+    def test_report_is_staff_only(self):
+        self.client.force_authenticate(User.objects.create_user('customer'))
+        self.assertEqual(self.client.get('/api/v1/reports/sales/').status_code, 403)
+
+
+@override_settings(CART_STORE='order.cart.CacheCartStore', SHARED_CACHE=True, CART_TTL=100)
+class CacheCartStoreTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.store = get_cart_store()
+
+    def test_every_key_lives_as_long_as_the_last_write(self):
+        with mock.patch('time.time', return_value=1000):
+            self.store.add(1, 10, 2)
+        with mock.patch('time.time', return_value=1090):
+            self.store.add(1, 20, 1)
+
+        # Past the first write's TTL, product 10 keeps its slot and quantity
+        with mock.patch('time.time', return_value=1150):
+            self.assertEqual(self.store.items(1), {10: 2, 20: 1})
+        with mock.patch('time.time', return_value=1200):
+            self.assertEqual(self.store.items(1), {})
+
+    def test_set_many_refreshes_untouched_items(self):
+        with mock.patch('time.time', return_value=1000):
+            self.store.add(1, 10, 2)
+        with mock.patch('time.time', return_value=1090):
+            self.store.set_many(1, {20: 3})
+        with mock.patch('time.time', return_value=1150):
+            self.assertEqual(self.store.items(1), {10: 2, 20: 3})
+
+    def test_products_leaving_the_cart_free_their_slots(self):
+        self.store.add(1, 10, 2)
+        self.store.add(1, 20, 1)
+        self.assertTrue(self.store.remove(1, 10))
+        self.assertFalse(self.store.remove(1, 10))
+        self.store.add(1, 20, -1)
+
+        self.store.set_many(1, {30: 1, 40: 1})
+        self.store.add_many(1, {30: -1, 50: 1, 60: 1})
+        self.store.add(1, 70, 1)
+        self.assertEqual(self.store.items(1), {40: 1, 50: 1, 60: 1, 70: 1})
+        self.assertEqual(cache.get('cart:1:slots'), 4)
+
+    def test_add_many_updates_the_cart_in_one_pass(self):
+        store = CacheCartStore(mock.Mock(wraps=cache))
+        store.add(1, 0, 5)
+        store.cache.reset_mock()
+
+        cart = store.add_many(1, {**{product_id: 1 for product_id in range(50)}, 0: -5})
+        self.assertEqual(cart, {product_id: 1 for product_id in range(1, 50)})
+        # Creating, incrementing and touching each counter, a slot each and
+        # a touch for it, where add() per product took nearly 3000 calls
+        self.assertLessEqual(len(store.cache.method_calls), 5 * 50)
+
+
+@override_settings(CART_STORE='order.cart.CacheCartStore', SHARED_CACHE=True)
+class CachedTokenAuthenticationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('customer', 'customer@example.com', 'secret-password')
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def test_token_is_resolved_from_cache(self):
+        self.assertEqual(self.client.get('/api/v1/cart/').status_code, 200)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get('/api/v1/cart/').status_code, 200)
+
+        self.assertEqual(authentication.stats(), {'hits': 1, 'misses': 1, 'hit_rate': 0.5})
+
+    def test_logout_invalidates_token(self):
+        self.client.get('/api/v1/cart/')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.post('/api/v1/token/logout/').status_code, 204)
+        self.assertEqual(self.client.get('/api/v1/cart/').status_code, 401)
+
+    def test_deleted_token_stops_authenticating(self):
+        self.client.get('/api/v1/cart/')
+        cache_key = authentication.token_cache_key(self.token.key)
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.token.delete()
+            # Still cached until the deletion commits
+            self.assertIsNotNone(cache.get(cache_key))
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(self.client.get('/api/v1/cart/').status_code, 401)
+
+    @override_settings(SHARED_CACHE=False)
+    def test_local_cache_is_not_used(self):
+        self.assertEqual(self.client.get('/api/v1/cart/').status_code, 200)
+
+        self.assertIsNone(cache.get(authentication.token_cache_key(self.token.key)))
+        self.token.delete()
+        self.assertEqual(self.client.get('/api/v1/cart/').status_code, 401)
+
+    def test_password_change_refreshes_cached_user(self):
+        self.client.get('/api/v1/cart/')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/v1/users/set_password/', {
+                'current_password': 'secret-password',
+                'new_password': 'another-Secret-42',
+                're_new_password': 'another-Secret-42',
+            })
+        self.assertEqual(response.status_code, 204)
+        self.assertIsNone(cache.get(authentication.token_cache_key(self.token.key)))
+
+    def test_inactive_user_is_rejected_after_save(self):
+        self.client.get('/api/v1/cart/')
+
+        self.user.is_active = False
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+        self.assertEqual(self.client.get('/api/v1/cart/').status_code, 401)
+
+
+class AsyncCheckoutTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('customer', 'customer@example.com', 'secret-password')
+        cls.token = Token.objects.create(user=cls.user)
+        category = Category.objects.create(name='Category', slug='category')
+        cls.product = Product.objects.create(category=category, name='Product', slug='product', price=10)
+        Stock.objects.create(product=cls.product, quantity=5)
+
+    def setUp(self):
+        self.server = FakePaymentServer()
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+        overrides = override_settings(STRIPE_API_BASE=self.server.url, PAYMENT_MAX_RETRIES=0)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def checkout(self, source='tok_visa', quantity=2):
+        return self.client.post('/api/v1/checkout/async/', {
+            'first_name': 'First',
+            'last_name': 'Last',
+            'email': 'customer@example.com',
+            'address': '1 Main Street',
+            'zipcode': '10000',
+            'place': 'Berlin',
+            'phone': '+10000000000',
+            'stripe_token': source,
+            'items': [{'product': self.product.pk, 'quantity': quantity, 'price': '10.00'}],
+        }, format='json')
+
+    def stock(self):
+        return Stock.objects.get(product=self.product).quantity
+
+    def test_paid_order_is_saved(self):
+        response = self.checkout()
+
+        self.assertEqual(response.status_code, 201)
+        order = Order.objects.get()
+        self.assertEqual((order.user, order.paid_amount), (self.user, 20))
+        self.assertEqual(self.stock(), 3)
+        self.assertFalse(StockReservation.objects.exists())
+        self.assertEqual(self.server.refunds, [])
+
+    def test_declined_card_releases_the_stock(self):
+        response = self.checkout(source=DECLINED_SOURCE)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'Your card was declined.'})
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(self.stock(), 5)
+        self.assertFalse(StockReservation.objects.exists())
+
+    @override_settings(PAYMENT_TIMEOUT=0.1)
+    def test_payment_timeout_releases_the_stock(self):
+        self.server.latency = 0.5
+
+        response = self.checkout()
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'Payment provider is unreachable'})
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(self.stock(), 5)
+
+    def test_failed_save_refunds_the_charge(self):
+        with mock.patch('order.views.save_order', side_effect=RuntimeError('database went away')), \
+                self.assertLogs('vmarket.checkout', 'ERROR'):
+            response = self.checkout()
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(self.server.refunds, ['ch_fake_1'])
+        self.assertEqual(self.stock(), 5)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_retry_after_a_refund_is_refused(self):
+        with mock.patch('order.views.save_order', side_effect=RuntimeError('database went away')), \
+                self.assertLogs('vmarket.checkout', 'ERROR'):
+            self.checkout()
+
+        response = self.checkout()
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'This payment was refunded, pay again with a new card'})
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(self.stock(), 5)
+        self.assertFalse(StockReservation.objects.exists())
+
+
+class MetricsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('customer', 'customer@example.com', 'secret-password')
+        category = Category.objects.create(name='Category', slug='category')
+        Product.objects.bulk_create(
+            Product(category=category, name=f'Product {p}', slug=f'product-{p}', price=10) for p in range(3)
+        )
+
+    def scrape(self, **headers):
+        return self.client.get('/api/v1/metrics/', **headers)
+
+    def test_scraping_needs_a_token_or_an_allowed_address(self):
+        # The test client connects from 127.0.0.1, which is not trusted by default
+        self.assertEqual(self.scrape().status_code, 403)
+
+        with override_settings(METRICS_TOKEN='scrape-me'):
+            self.assertEqual(self.scrape().status_code, 403)
+            self.assertEqual(self.scrape(HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            self.assertEqual(self.scrape(HTTP_AUTHORIZATION='Bearer scrape-me').status_code, 200)
+
+        with override_settings(METRICS_ALLOWED_IPS=['127.0.0.1']):
+            self.assertEqual(self.scrape().status_code, 200)
+
+    @override_settings(METRICS_ALLOWED_IPS=['127.0.0.1'])
+    def test_requests_are_counted_by_route(self):
+        self.client.force_login(self.user)
+        response = self.client.get('/api/v1/categories/category/products/')
+
+        self.assertIn('serialize;dur=', response['Server-Timing'])
+        self.assertIn(
+            'vmarket_request_duration_seconds_count{method="GET",route="/api/v1/categories/<slug:category_slug>/products/",status="2xx"}',
+            self.scrape().content.decode(),
+        )
+
+    def test_nested_serializers_are_timed_once(self):
+        timings = metrics.RequestTimings()
+        token = metrics._timings.set(timings)
+        self.addCleanup(metrics._timings.reset, token)
+
+        serializer = ProductSerializer(Product.objects.all(), many=True)
+        self.assertIsInstance(serializer, metrics.TimedListSerializer)
+
+        with mock.patch('time.perf_counter', side_effect=[10.0, 10.25]):
+            with metrics.serializer_timer():
+                self.assertEqual(len(serializer.data), 3)
+        self.assertEqual(timings.serialize, 0.25)
+        self.assertFalse(timings.serializing)
+
+        serializer.data
+        self.assertGreater(timings.serialize, 0.25)
+
+    def test_async_requests_are_timed(self):
+        async def view(request):
+            products = await sync_to_async(list)(Product.objects.all())
+            return HttpResponse(len(products))
+
+        middleware = metrics.MetricsMiddleware(view)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+
+        response = async_to_sync(middleware)(RequestFactory().get('/'))
+        self.assertEqual(response.content, b'3')
+        self.assertIn('desc="1 queries"', response['Server-Timing'])
+
+
+class ReplicaRouterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        # Declared but never connected to, replica_is_up() is patched
+        patcher = mock.patch.dict(settings.DATABASES, {routers.REPLICA: {}})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('vmarketdjango.routers.replica_is_up', return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def reads_from(self, scopes):
+        with routers.replica_reads(scopes):
+            return routers.ReplicaRouter().db_for_read(Product) or 'default'
+
+    @override_settings(SHARED_CACHE=True)
+    def test_writers_are_pinned_to_the_primary(self):
+        self.assertEqual(self.reads_from(['catalog']), routers.REPLICA)
+
+        routers.pin_to_primary('catalog')
+        self.assertEqual(self.reads_from(['catalog']), 'default')
+        self.assertEqual(self.reads_from(['user:1']), routers.REPLICA)
+
+    @override_settings(SHARED_CACHE=False)
+    def test_replica_needs_a_shared_cache(self):
+        self.assertEqual(self.reads_from(['catalog']), 'default')
+
+    @override_settings(SHARED_CACHE=True)
+    def test_unhandled_errors_leave_the_replica(self):
+        class FailingView(routers.ReplicaReadMixin, APIView):
+            permission_classes = []
+
+            def get(self, request):
+                raise RuntimeError('boom')
+
+        with self.assertRaises(RuntimeError):
+            FailingView.as_view()(APIRequestFactory().get('/'))
+        self.assertEqual(routers.ReplicaRouter().db_for_read(Product), None)
+
+    @override_settings(SHARED_CACHE=True)
+    def test_async_writers_are_pinned_to_the_primary(self):
+        user = User.objects.create_user('customer', 'customer@example.com', 'secret-password')
+
+        async def view(request):
+            return HttpResponse(status=201)
+
+        middleware = routers.PrimaryAfterWriteMiddleware(view)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+
+        request = RequestFactory().post('/')
+        request.user = user
+        self.assertEqual(async_to_sync(middleware)(request).status_code, 201)
+        self.assertEqual(self.reads_from([routers.user_scope(user)]), 'default')
+
+    def test_migrations_only_run_on_the_primary(self):
+        router = routers.ReplicaRouter()
+
+        self.assertTrue(router.allow_migrate('default', 'order'))
+        self.assertFalse(router.allow_migrate(routers.REPLICA, 'order'))
+
+
+# Budgets are for deployments with a shared cache, the only test process stands in for one
+@override_settings(SHARED_CACHE=True, CART_STORE='order.cart.CacheCartStore')
+class QueryBudgetTests(TransactionTestCase):
+    """Every API route stays within its query budget, on a cold and a warm cache.
+
+    A TransactionTestCase, so atomic blocks don't add savepoints to the counts.
+    """
+
+    def setUp(self):
+        cache.clear()
+        seed.seed(categories=3, products=10, users=2, orders=3, addresses=2)
+
+    def test_endpoints_within_query_budgets(self):
+        fixture = loadtest.get_fixture()
+        endpoints = loadtest.get_endpoints(fixture)
+
+        results = loadtest.run(endpoints, fixture['token'], rounds=2)
+
+        self.assertEqual(loadtest.over_budget(endpoints, results), [])
+        # Budgets only mean something for the real response, not an error page
+        self.assertEqual(loadtest.unexpected_statuses(endpoints, results), [])
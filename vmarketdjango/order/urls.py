@@ -7,14 +7,17 @@ from order.account_deletion import AccountDeletionView
 urlpatterns = [
     # Cart and orders
     path('cart/', views.CartView.as_view()),
+    path('cart/sync/', views.CartSyncView.as_view()),
     path('checkout/', views.checkout),
+    path('checkout/async/', views.checkout_async),
     path('orders/', views.OrdersList.as_view()),
     path('orders/<int:pk>/', account_views.OrderDetailView.as_view()),
+    path('reports/sales/', views.SalesReport.as_view()),
     
     # User profile and settings
     path('users/me/', account_views.UserProfileView.as_view()),
     path('users/set_password/', account_views.ChangePasswordView.as_view()),
-    path('users/settings/', account_views.UserSettingsView.as_view()),
+    # users/settings/ is routed in vmarketdjango.urls, before djoser's users/<id>/
     path('users/delete/', AccountDeletionView.as_view()),
     
     # Email verification
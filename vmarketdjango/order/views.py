@@ -1,29 +1,53 @@
+import json
+import logging
+from datetime import timedelta
+from decimal import Decimal
+
 import stripe
+from asgiref.sync import sync_to_async
 
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.http import Http404
+from django.db import transaction
+from django.db.models import DecimalField, F, Prefetch, Sum
+from django.db.models.functions import Coalesce
+from django.http import Http404, JsonResponse
 from django.shortcuts import render
+from django.utils import timezone
+from django.utils.dateparse import parse_date
 
-from rest_framework import status, authentication, permissions
+from rest_framework import status, exceptions, generics, permissions
 from rest_framework.decorators import api_view, authentication_classes, permission_classes
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
-from .models import Order, OrderItem
-from .serializers import OrderSerializer, MyOrderSerializer, CartItemSerializer
+from . import inventory, payments
+from .authentication import CachedTokenAuthentication
+from .cart import get_cart_store
+from .models import CategorySales, DailySales, Order, OrderItem, ProductSales, StatusCount
+from .pagination import OrderPagination
+from .serializers import OrderSerializer, MyOrderSerializer, OrderSummarySerializer, CartItemSerializer, DailySalesSerializer, CategorySalesSerializer, ProductSalesSerializer
 from product.models import Product
+from product.serializers import ProductRowSerializer
+from vmarketdjango.routers import ReplicaReadMixin
+
+logger = logging.getLogger('vmarket.checkout')
 
 @api_view(['POST'])
-@authentication_classes([authentication.TokenAuthentication])
+@authentication_classes([CachedTokenAuthentication])
 @permission_classes([permissions.IsAuthenticated])
 def checkout(request):
-    serializer = OrderSerializer(data=request.data)
+    serializer = OrderSerializer(data=with_cart_items(request.data, request.user))
 
     if serializer.is_valid():
         stripe.api_key = settings.STRIPE_SECRET_KEY
         paid_amount = sum(item.get('quantity') * item.get('product').price for item in serializer.validated_data['items'])
 
+        try:
+            reservation = inventory.reserve(order_quantities(serializer), request.user)
+        except inventory.OutOfStock as e:
+            return Response(out_of_stock(e), status=status.HTTP_409_CONFLICT)
+
         try:
             charge = stripe.Charge.create(
                 amount=int(paid_amount * 100),
@@ -31,26 +55,213 @@ def checkout(request):
                 description='Charge from V-Market',
                 source=serializer.validated_data['stripe_token']
             )
-
-            serializer.save(user=request.user, paid_amount=paid_amount)
-
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
         except Exception:
+            inventory.release(reservation)
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            save_order(serializer, reservation, user=request.user, paid_amount=paid_amount)
+        except inventory.OutOfStock as e:
+            # The reservation expired during the payment and its units sold meanwhile
+            inventory.release(reservation)
+            refund_stripe_charge(charge)
+            return Response(out_of_stock(e), status=status.HTTP_409_CONFLICT)
+        except Exception:
+            logger.exception('Saving the order paid by charge %s failed', charge.id)
+            inventory.release(reservation)
+            refund_stripe_charge(charge)
+            return Response(
+                {'detail': 'The order could not be saved, the payment is refunded'},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            )
+        get_cart_store().clear(request.user.pk)
+
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
     
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-class OrdersList(APIView):
-    authentication_classes = [authentication.TokenAuthentication]
+def refund_stripe_charge(charge):
+    """Refund a charge whose order was not saved, a failed refund is logged for manual follow-up"""
+    try:
+        stripe.Refund.create(charge=charge.id, idempotency_key=f'refund-{charge.id}')
+    except stripe.error.StripeError:
+        logger.exception('Refunding charge %s failed, it needs a manual refund', charge.id)
+
+def with_cart_items(data, user):
+    """Take the order lines from the user's server-side cart when the client sent none"""
+    if data.get('items'):
+        return data
+
+    quantities = get_cart_store().items(user.pk)
+    prices = dict(Product.objects.filter(pk__in=quantities).values_list('id', 'price'))
+
+    data = {key: data.get(key) for key in data}
+    data['items'] = [
+        {'product': product_id, 'quantity': quantity, 'price': prices[product_id]}
+        for product_id, quantity in quantities.items()
+        if product_id in prices
+    ]
+    return data
+
+def order_quantities(serializer):
+    """``{product_id: quantity}`` of a validated order, lines of the same product added up"""
+    quantities = {}
+    for item in serializer.validated_data['items']:
+        quantities[item['product'].pk] = quantities.get(item['product'].pk, 0) + item['quantity']
+    return quantities
+
+def out_of_stock(error):
+    return {'detail': 'Not enough stock', 'product': error.product_id, 'available': error.available}
+
+@transaction.atomic
+def save_order(serializer, reservation, **kwargs):
+    """Save the order and settle its stock reservation together.
+
+    Raises OutOfStock, saving nothing, when the reservation was released
+    and its units sold in the meantime.
+    """
+    serializer.save(**kwargs)
+    inventory.confirm(reservation, order_quantities(serializer))
+
+def serialize_cart(quantities):
+    """Cart lines with their products, loaded in a single query"""
+    rows = ProductRowSerializer.rows(Product.objects.filter(pk__in=quantities))
+    return [
+        {
+            'id': row['id'],
+            'product': ProductRowSerializer(row).data,
+            'quantity': quantities[row['id']],
+            'price': str(row['price']),
+        }
+        for row in rows
+    ]
+
+def authenticate_token(request):
+    user_token = CachedTokenAuthentication().authenticate(request)
+    return user_token[0] if user_token else None
+
+async def checkout_async(request):
+    """Async twin of ``checkout`` for ASGI deployments.
+
+    The charge goes through a pooled async HTTP client, so the process keeps
+    serving other requests while the payment provider answers.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'detail': f'Method "{request.method}" not allowed.'}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    try:
+        user = await sync_to_async(authenticate_token)(request)
+    except exceptions.AuthenticationFailed as e:
+        return JsonResponse({'detail': e.detail}, status=status.HTTP_401_UNAUTHORIZED)
+    if user is None:
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=status.HTTP_401_UNAUTHORIZED)
+    # Lets PrimaryAfterWriteMiddleware pin the user once the order exists
+    request.user = user
+
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({'detail': 'JSON parse error'}, status=status.HTTP_400_BAD_REQUEST)
+
+    serializer = OrderSerializer(data=await sync_to_async(with_cart_items)(data, user))
+    if not await sync_to_async(serializer.is_valid)():
+        return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    paid_amount = sum(item.get('quantity') * item.get('product').price for item in serializer.validated_data['items'])
+    source = serializer.validated_data['stripe_token']
+
+    try:
+        reservation = await sync_to_async(inventory.reserve)(order_quantities(serializer), user)
+    except inventory.OutOfStock as e:
+        return JsonResponse(out_of_stock(e), status=status.HTTP_409_CONFLICT)
+
+    try:
+        charge = await payments.create_charge(
+            amount=int(paid_amount * 100),
+            currency='USD',
+            description='Charge from V-Market',
+            source=source,
+            idempotency_key=payments.idempotency_key(user.pk, request.headers.get('Idempotency-Key') or source),
+        )
+    except payments.PaymentError as e:
+        await sync_to_async(inventory.release)(reservation)
+        return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    if charge.get('refunded'):
+        # A retry of a checkout whose order failed, its key replays the charge refunded then
+        await sync_to_async(inventory.release)(reservation)
+        return JsonResponse(
+            {'error': 'This payment was refunded, pay again with a new card'},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    try:
+        await sync_to_async(save_order)(serializer, reservation, user=user, paid_amount=paid_amount)
+    except inventory.OutOfStock as e:
+        # The reservation expired during the payment and its units sold meanwhile
+        await sync_to_async(inventory.release)(reservation)
+        await refund(charge)
+        return JsonResponse(out_of_stock(e), status=status.HTTP_409_CONFLICT)
+    except Exception:
+        logger.exception('Saving the order paid by charge %s failed', charge['id'])
+        await sync_to_async(inventory.release)(reservation)
+        await refund(charge)
+        return JsonResponse(
+            {'detail': 'The order could not be saved, the payment is refunded'},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        )
+    await sync_to_async(get_cart_store().clear)(user.pk)
+    data = await sync_to_async(lambda: serializer.data)()
+    return JsonResponse(data, status=status.HTTP_201_CREATED)
+
+async def refund(charge):
+    """Refund a charge whose order was not saved, a failed refund is logged for manual follow-up"""
+    try:
+        await payments.refund_charge(charge['id'])
+    except payments.PaymentError:
+        logger.exception('Refunding charge %s failed, it needs a manual refund', charge['id'])
+
+# Token authenticated like the DRF views, and csrf_exempt() is not async aware yet
+checkout_async.csrf_exempt = True
+
+def with_items(orders):
+    """Load the items of all orders, with their products and categories, in one extra query"""
+    return orders.prefetch_related(
+        Prefetch('items', queryset=OrderItem.objects.select_related('product__category'))
+    )
+
+class OrdersList(ReplicaReadMixin, generics.ListAPIView):
+    """The user's orders, newest first.
+
+    ``?summary=1`` skips the items and returns totals and item counts from a
+    single aggregate query, which is all an order listing needs.
+    """
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = OrderPagination
 
-    def get(self, request, format=None):
-        orders = Order.objects.filter(user=request.user)
-        serializer = MyOrderSerializer(orders, many=True)
-        return Response(serializer.data)
+    def is_summary(self):
+        return self.request.query_params.get('summary') in ('1', 'true')
+
+    def get_queryset(self):
+        orders = Order.objects.filter(user=self.request.user)
+
+        if self.is_summary():
+            return orders.annotate(
+                item_count=Coalesce(Sum('items__quantity'), 0),
+                total=Coalesce(
+                    Sum(F('items__price') * F('items__quantity'), output_field=DecimalField()),
+                    Decimal('0'),
+                    output_field=DecimalField(),
+                ),
+            ).values('id', 'created_at', 'status', 'paid_amount', 'total', 'item_count').order_by('-created_at')
+
+        return with_items(orders)
+
+    def get_serializer_class(self):
+        return OrderSummarySerializer if self.is_summary() else MyOrderSerializer
 
 @api_view(['GET', 'POST'])
-@authentication_classes([authentication.TokenAuthentication])
+@authentication_classes([CachedTokenAuthentication])
 @permission_classes([permissions.IsAuthenticated])
 def cart(request):
     if request.method == 'GET':
@@ -96,54 +307,39 @@ def cart(request):
             )
 
 class CartView(APIView):
-    authentication_classes = [authentication.TokenAuthentication]
+    """The user's cart, kept in the cart store until checkout creates the order"""
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
 
     def get(self, request, format=None):
-        # Get the user's cart items (unpaid order items)
-        cart_items = OrderItem.objects.filter(
-            order__user=request.user,
-            order__paid_amount__isnull=True
-        ).select_related('product')
-        serializer = CartItemSerializer(cart_items, many=True)
-        return Response(serializer.data)
+        quantities = get_cart_store().items(request.user.pk)
+        return Response(serialize_cart(quantities))
 
     def post(self, request, format=None):
+        """Add ``quantity`` of a product to the cart, a negative quantity takes some out"""
         product_id = request.data.get('product_id')
-        quantity = request.data.get('quantity', 1)
 
         try:
-            product = Product.objects.get(id=product_id)
-        except Product.DoesNotExist:
+            quantity = int(request.data.get('quantity', 1))
+            product_id = int(product_id)
+        except (TypeError, ValueError):
+            return Response(
+                {'error': 'product_id and quantity must be integers'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if not Product.objects.filter(id=product_id).exists():
             return Response(
                 {'error': 'Product not found'},
                 status=status.HTTP_404_NOT_FOUND
             )
 
-        # Get or create an unpaid order for the cart
-        order, created = Order.objects.get_or_create(
-            user=request.user,
-            paid_amount__isnull=True
-        )
-
-        # Create or update the order item
-        try:
-            order_item = OrderItem.objects.get(
-                order=order,
-                product=product
-            )
-            order_item.quantity = quantity
-            order_item.save()
-        except OrderItem.DoesNotExist:
-            order_item = OrderItem.objects.create(
-                order=order,
-                product=product,
-                quantity=quantity,
-                price=product.price
-            )
+        new_quantity = get_cart_store().add(request.user.pk, product_id, quantity)
+        if not new_quantity:
+            return Response(status=status.HTTP_204_NO_CONTENT)
 
-        serializer = CartItemSerializer(order_item)
-        return Response(serializer.data, status=status.HTTP_201_CREATED)
+        line, = serialize_cart({product_id: new_quantity})
+        return Response(line, status=status.HTTP_201_CREATED)
 
     def delete(self, request, format=None):
         product_id = request.query_params.get('product_id')
@@ -154,15 +350,119 @@ class CartView(APIView):
             )
 
         try:
-            order_item = OrderItem.objects.get(
-                order__user=request.user,
-                order__paid_amount__isnull=True,
-                product_id=product_id
-            )
-            order_item.delete()
-            return Response(status=status.HTTP_204_NO_CONTENT)
-        except OrderItem.DoesNotExist:
+            removed = get_cart_store().remove(request.user.pk, int(product_id))
+        except ValueError:
+            removed = False
+
+        if not removed:
             return Response(
                 {'error': 'Item not found in cart'},
                 status=status.HTTP_404_NOT_FOUND
-            )
\ No newline at end of file
+            )
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+class CartSyncView(APIView):
+    """Reconcile a whole cart in one request, for clients that build carts offline.
+
+    POST ``{"items": [{"product_id": 1, "quantity": 2}, ...], "mode": "replace"}``.
+    ``replace`` (the default) makes the cart exactly ``items``, ``add`` applies
+    the quantities as deltas like repeated ``POST /cart/`` calls would.
+    Products that no longer exist are skipped. Returns the reconciled cart.
+    """
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+    max_items = 500
+
+    def post(self, request, format=None):
+        mode = request.data.get('mode', 'replace')
+        items = request.data.get('items')
+
+        if mode not in ('replace', 'add') or not isinstance(items, list):
+            return Response(
+                {'error': 'Send a list of items and a mode of "replace" or "add"'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if len(items) > self.max_items:
+            return Response(
+                {'error': f'A cart can be synced with at most {self.max_items} items'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        quantities = {}
+        try:
+            for item in items:
+                product_id = int(item['product_id'])
+                quantity = int(item.get('quantity', 1))
+                if mode == 'add':
+                    quantities[product_id] = quantities.get(product_id, 0) + quantity
+                else:
+                    quantities[product_id] = quantity
+        except (KeyError, TypeError, AttributeError, ValueError):
+            return Response(
+                {'error': 'product_id and quantity must be integers'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        existing = set(Product.objects.filter(pk__in=quantities).values_list('id', flat=True))
+        quantities = {product_id: quantity for product_id, quantity in quantities.items() if product_id in existing}
+
+        store = get_cart_store()
+        if mode == 'add':
+            cart = store.add_many(request.user.pk, quantities)
+        else:
+            cart = store.set_many(request.user.pk, quantities, replace=True)
+
+        return Response(serialize_cart(cart))
+
+class SalesReport(ReplicaReadMixin, APIView):
+    """Sales dashboard for staff, read from the rollups of order.rollups.
+
+    ``?start=`` and ``?end=`` (inclusive ISO dates) default to the last 30
+    days, ``?top=`` limits the product ranking. Status counts cover all time.
+    """
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, format=None):
+        try:
+            end = self.get_date('end') or timezone.localdate()
+            start = self.get_date('start') or end - timedelta(days=29)
+            top = min(max(int(request.query_params.get('top', 10)), 1), 100)
+        except ValueError:
+            return Response({'detail': 'Use ISO dates for start and end and a number for top'}, status=status.HTTP_400_BAD_REQUEST)
+
+        days = DailySales.objects.filter(day__range=(start, end)).order_by('day').values('day', 'orders', 'revenue')
+        totals = {'units': Sum('units'), 'revenue': Sum('revenue')}
+        categories = (
+            CategorySales.objects.filter(day__range=(start, end))
+            .values('category_id', name=F('category__name'))
+            .annotate(**totals)
+            .order_by('-revenue')
+        )
+        products = (
+            ProductSales.objects.filter(day__range=(start, end))
+            .values('product_id', name=F('product__name'))
+            .annotate(**totals)
+            .order_by('-units', 'product_id')[:top]
+        )
+
+        days = DailySalesSerializer(days, many=True).data
+        return Response({
+            'start': start,
+            'end': end,
+            'orders': sum(day['orders'] for day in days),
+            'revenue': str(sum((Decimal(day['revenue']) for day in days), Decimal('0.00'))),
+            'days': days,
+            'categories': CategorySalesSerializer(categories, many=True).data,
+            'top_products': ProductSalesSerializer(products, many=True).data,
+            'statuses': dict(StatusCount.objects.exclude(orders=0).values_list('status', 'orders')),
+        })
+
+    def get_date(self, name):
+        value = self.request.query_params.get(name)
+        if not value:
+            return None
+        date = parse_date(value)
+        if date is None:
+            raise ValueError(value)
+        return date
@@ -1,6 +1,30 @@
 from django.contrib import admin
 
+from product import search
 from product.models import Product, Category
+from vmarketdjango.paginator import EstimatedCountPaginator
 
-admin.site.register(Product)
-admin.site.register(Category)
\ No newline at end of file
+
+@admin.register(Category)
+class CategoryAdmin(admin.ModelAdmin):
+    list_display = ('name', 'slug')
+    search_fields = ('name', 'slug')
+    prepopulated_fields = {'slug': ('name',)}
+
+
+@admin.register(Product)
+class ProductAdmin(admin.ModelAdmin):
+    list_display = ('name', 'category', 'price', 'data_added')
+    list_select_related = ('category',)
+    list_filter = (('data_added', admin.DateFieldListFilter),)
+    # Searches, including the product autocompletes of other admins, go through the FTS index
+    search_fields = ('name',)
+    autocomplete_fields = ('category',)
+    prepopulated_fields = {'slug': ('name',)}
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_search_results(self, request, queryset, search_term):
+        if search_term and search.is_available():
+            return search.filter_matching(queryset, search_term), False
+        return super().get_search_results(request, queryset, search_term)
@@ -0,0 +1,73 @@
+import functools
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.http import parse_etags
+
+from rest_framework import status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+from vmarketdjango.routers import pin_to_primary
+
+VERSION_KEY = 'catalog:version'
+
+
+def get_catalog_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, 1, None)
+        version = cache.get(VERSION_KEY, 1)
+    return version
+
+
+def bump_catalog_version():
+    """Invalidate every cached catalog response at once by moving to a new key space"""
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.add(VERSION_KEY, 1, None)
+    # Don't refill the new key space from a replica that hasn't seen the change
+    pin_to_primary('catalog')
+
+
+def make_etag(request, data):
+    payload = JSONRenderer().render(data)
+    digest = hashlib.sha1(request.accepted_renderer.format.encode() + b':' + payload).hexdigest()
+    return f'"{digest}"'
+
+
+def etag_matches(request, etag):
+    if_none_match = request.headers.get('If-None-Match')
+    if not if_none_match:
+        return False
+    etags = parse_etags(if_none_match)
+    return '*' in etags or etag in etags
+
+
+def cache_catalog_response(view_method):
+    """Cache a successful catalog GET under the current catalog version.
+
+    Wraps the handler, so authentication and permissions still run first.
+    Responses carry a strong ETag and a matching If-None-Match gets an
+    empty 304 without running the view again.
+    """
+    @functools.wraps(view_method)
+    def wrapper(view, request, *args, **kwargs):
+        key = f'catalog:{get_catalog_version()}:{request.accepted_renderer.format}:{request.build_absolute_uri()}'
+        entry = cache.get(key)
+
+        if entry is None:
+            response = view_method(view, request, *args, **kwargs)
+            if response.status_code != status.HTTP_200_OK:
+                return response
+            entry = {'data': response.data, 'etag': make_etag(request, response.data)}
+            cache.set(key, entry, settings.CATALOG_CACHE_TIMEOUT)
+
+        headers = {'ETag': entry['etag'], 'Cache-Control': 'no-cache'}
+        if etag_matches(request, entry['etag']):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(entry['data'], headers=headers)
+
+    return wrapper
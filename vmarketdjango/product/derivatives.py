@@ -0,0 +1,125 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+
+from vmarketdjango import media
+
+DEFAULT_SIZES = {
+    'card': (300, 200),
+    'detail': (600, 400),
+    'retina': (1200, 800),
+}
+
+_executor = None
+
+
+def get_sizes():
+    return getattr(settings, 'PRODUCT_THUMBNAIL_SIZES', DEFAULT_SIZES)
+
+
+def derivative_name(image_name, size_name):
+    """Storage path of one derivative, mirroring the source path so that
+    uploads with the same basename in different folders never collide"""
+    stem, _ = os.path.splitext(image_name)
+    return f'derivatives/{stem}_{size_name}.jpg'
+
+
+def render_derivatives(image_name, sizes=None):
+    """Decode the source image once and write every configured size.
+
+    Also encodes the WebP/AVIF variants media requests negotiate between,
+    of the source and of every size. Returns the derivative map stored on
+    ``Product.thumbnails``. Touches only the media files, never the
+    database, so it is safe to run in a worker process.
+    """
+    sizes = sizes or get_sizes()
+    largest = max(sizes.values())
+
+    with default_storage.open(image_name) as source:
+        img = Image.open(source)
+        # Let the JPEG decoder downscale while reading instead of decoding
+        # the full resolution image and shrinking it afterwards
+        img.draft('RGB', largest)
+        img = img.convert('RGB')
+
+    derivatives = {'source': image_name}
+    for size_name, size in sorted(sizes.items(), key=lambda item: item[1], reverse=True):
+        resized = img.copy()
+        resized.thumbnail(size)
+
+        thumb_io = BytesIO()
+        resized.save(thumb_io, 'JPEG', quality=85, optimize=True)
+
+        # Storage names are content-hashed, re-rendering the same image reuses the file
+        derivatives[size_name] = default_storage.save(derivative_name(image_name, size_name), ContentFile(thumb_io.getvalue()))
+
+    for name in [image_name, *(derivatives[size_name] for size_name in sizes)]:
+        media.build_variants(name)
+    return derivatives
+
+
+def store_derivatives(product_id, derivatives):
+    """Attach rendered derivatives to a product unless its image changed meanwhile"""
+    from product.models import Product
+
+    from product.cache import bump_catalog_version
+
+    card = derivatives.get('card', '')
+    updated = Product.objects.filter(pk=product_id, image=derivatives['source']).update(
+        thumbnail=card,
+        thumbnails=derivatives,
+    )
+    if updated:
+        transaction.on_commit(bump_catalog_version)
+    return updated
+
+
+def build_product_derivatives(product_id):
+    from product.models import Product
+
+    try:
+        product = Product.objects.only('image').get(pk=product_id)
+        if product.image:
+            store_derivatives(product_id, render_derivatives(product.image.name))
+    except Product.DoesNotExist:
+        pass
+
+
+def _run_in_worker(product_id):
+    try:
+        build_product_derivatives(product_id)
+    finally:
+        # Worker threads get their own connections, do not leak them
+        connections.close_all()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.PRODUCT_THUMBNAIL_WORKERS,
+            thread_name_prefix='thumbnails',
+        )
+    return _executor
+
+
+def schedule(product_id):
+    """Build derivatives once the current transaction commits.
+
+    With ``PRODUCT_THUMBNAIL_WORKERS = 0`` the work runs inline, which is
+    what tests and management commands want.
+    """
+    def submit():
+        if getattr(settings, 'PRODUCT_THUMBNAIL_WORKERS', 0) > 0:
+            _get_executor().submit(_run_in_worker, product_id)
+        else:
+            build_product_derivatives(product_id)
+
+    transaction.on_commit(submit)
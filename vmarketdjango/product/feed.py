@@ -0,0 +1,87 @@
+"""Gzipped JSON lines and CSV exports of the whole catalog.
+
+Everything is a generator: products are read with ``iterator()``,
+encoded one at a time and compressed as they go, so memory stays flat
+for any catalog size and the first bytes leave right away.
+"""
+import csv
+import json
+import zlib
+from urllib.parse import urljoin
+
+from django.conf import settings
+
+from product.models import Product
+
+FIELDS = ['id', 'category', 'category_name', 'name', 'slug', 'description', 'price', 'url', 'image', 'thumbnail', 'added']
+FORMATS = ('jsonl', 'csv')
+CHUNK_SIZE = 2000
+
+
+def feed_products():
+    return (
+        Product.objects
+        .select_related('category')
+        .only('id', 'name', 'slug', 'description', 'price', 'image', 'thumbnail', 'data_added', 'category__slug', 'category__name')
+        .order_by('id')
+        .iterator(chunk_size=CHUNK_SIZE)
+    )
+
+
+def feed_rows(media_base_url):
+    """One dict per product, with absolute URLs"""
+    for product in feed_products():
+        image = product.get_image()
+        thumbnail = product.get_thumbnail()
+        yield {
+            'id': product.id,
+            'category': product.category.slug,
+            'category_name': product.category.name,
+            'name': product.name,
+            'slug': product.slug,
+            'description': product.description or '',
+            'price': str(product.price),
+            'url': urljoin(settings.FRONTEND_URL, product.get_absolute_url()),
+            'image': urljoin(media_base_url, image) if image else '',
+            'thumbnail': urljoin(media_base_url, thumbnail) if thumbnail else '',
+            'added': product.data_added.isoformat(),
+        }
+
+
+def encode_jsonl(rows):
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False) + '\n'
+
+
+class _Line:
+    """File-like target that hands back what csv.writer writes"""
+
+    def write(self, value):
+        return value
+
+
+def encode_csv(rows):
+    writer = csv.DictWriter(_Line(), fieldnames=FIELDS)
+    yield writer.writeheader()
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def gzip_stream(lines, level=6):
+    """Compress an iterable of text into gzip bytes, chunk by chunk"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    first = True
+    for line in lines:
+        data = compressor.compress(line.encode())
+        if first:
+            # Push the header and first row out now instead of after the first full block
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            first = False
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream(fmt, media_base_url):
+    encode = encode_csv if fmt == 'csv' else encode_jsonl
+    return gzip_stream(encode(feed_rows(media_base_url)))
@@ -0,0 +1,148 @@
+"""Filtering, sorting and facet counts for the /products/ list.
+
+``ProductFilters`` reads ``?category=`` (slugs or ids, repeated or comma
+separated), ``?min_price=``, ``?max_price=``, ``?q=`` and ``?sort=`` off a
+request. ``facets`` counts the products per category and per price
+bucket with a single GROUP BY over (category, bucket): category counts
+leave the category filter out and bucket counts leave the price filter
+out, so each option shows what picking it would give. Both filters and
+the grouping run on the product_category_price_idx index.
+"""
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db.models import Case, Count, IntegerField, Q, Value, When
+from rest_framework.exceptions import ValidationError
+
+from product import search
+
+# Keyset orderings for ProductCursorPagination, each one ends with the id
+SORTS = {
+    'newest': ('-data_added', '-id'),
+    'price': ('price', 'id'),
+    '-price': ('-price', '-id'),
+    'popular': ('-units_sold', '-id'),
+}
+DEFAULT_SORT = 'newest'
+# Category ids are BigAutoFields, larger numbers overflow the query parameter
+MAX_CATEGORY_ID = 2 ** 63 - 1
+
+
+def price_buckets():
+    """``(low, high)`` pairs from PRODUCT_PRICE_BUCKETS, ``high`` is None for the last one"""
+    bounds = [Decimal(bound) for bound in settings.PRODUCT_PRICE_BUCKETS]
+    return list(zip(bounds, bounds[1:] + [None]))
+
+
+def parse_price(params, name):
+    value = params.get(name)
+    if not value:
+        return None
+    try:
+        price = Decimal(value)
+    except InvalidOperation:
+        price = None
+    if price is None or not price.is_finite():
+        raise ValidationError({name: ['A valid number is required.']})
+    return price
+
+
+def parse_categories(values):
+    """Split ``?category=`` values into ``(ids, slugs)``"""
+    ids, slugs = set(), set()
+    for value in values:
+        # isdigit() alone takes digits like "²" too, which int() refuses
+        if not (value.isascii() and value.isdigit()):
+            slugs.add(value)
+        elif int(value) <= MAX_CATEGORY_ID:
+            ids.add(int(value))
+        else:
+            raise ValidationError({'category': [f'{value} is not a valid category id.']})
+    return ids, slugs
+
+
+class ProductFilters:
+    def __init__(self, params):
+        self.categories = [value for param in params.getlist('category') for value in param.split(',') if value]
+        self.category_ids, self.category_slugs = parse_categories(self.categories)
+        self.min_price = parse_price(params, 'min_price')
+        self.max_price = parse_price(params, 'max_price')
+        self.query = params.get('q', '').strip()
+        self.sort = params.get('sort') or DEFAULT_SORT
+        if self.sort not in SORTS:
+            raise ValidationError({'sort': [f'Choose one of {", ".join(SORTS)}.']})
+
+    @property
+    def ordering(self):
+        return SORTS[self.sort]
+
+    def category_filter(self):
+        condition = Q(category_id__in=self.category_ids) if self.category_ids else Q()
+        if self.category_slugs:
+            condition |= Q(category__slug__in=self.category_slugs)
+        return condition
+
+    def price_filter(self):
+        condition = Q()
+        if self.min_price is not None:
+            condition &= Q(price__gte=self.min_price)
+        if self.max_price is not None:
+            condition &= Q(price__lte=self.max_price)
+        return condition
+
+    def in_categories(self, category_id, slug):
+        return not self.categories or category_id in self.category_ids or slug in self.category_slugs
+
+    def filter(self, queryset, category=True, price=True):
+        if self.query:
+            if search.is_available():
+                queryset = search.filter_matching(queryset, self.query)
+            else:
+                queryset = queryset.filter(Q(name__icontains=self.query) | Q(description__icontains=self.query))
+        if category and self.categories:
+            queryset = queryset.filter(self.category_filter())
+        if price:
+            queryset = queryset.filter(self.price_filter())
+        return queryset
+
+    def facets(self, queryset):
+        """``{'categories': [...], 'prices': [...]}`` counts, from one aggregate query"""
+        buckets = price_buckets()
+        bucket = Case(
+            *[
+                When(Q(price__gte=low) & (Q(price__lt=high) if high is not None else Q()), then=Value(i))
+                for i, (low, high) in enumerate(buckets)
+            ],
+            output_field=IntegerField(),
+        )
+        price_filter = self.price_filter()
+        rows = (
+            self.filter(queryset, category=False, price=False)
+            .order_by()
+            .values('category_id', 'category__slug', 'category__name', bucket=bucket)
+            .annotate(
+                matching=Count('pk', filter=price_filter) if price_filter else Count('pk'),
+                products=Count('pk'),
+            )
+        )
+
+        categories = {}
+        prices = [0] * len(buckets)
+        for row in rows:
+            category = categories.setdefault(row['category_id'], {
+                'id': row['category_id'],
+                'slug': row['category__slug'],
+                'name': row['category__name'],
+                'count': 0,
+            })
+            category['count'] += row['matching']
+            if row['bucket'] is not None and self.in_categories(row['category_id'], row['category__slug']):
+                prices[row['bucket']] += row['products']
+
+        return {
+            'categories': sorted(categories.values(), key=lambda category: (category['name'], category['id'])),
+            'prices': [
+                {'min': str(low), 'max': str(high) if high is not None else None, 'count': count}
+                for (low, high), count in zip(buckets, prices)
+            ],
+        }
@@ -0,0 +1,239 @@
+"""Streaming catalog import, used by the import_catalog command.
+
+Records are read one at a time from CSV or JSON lines (optionally
+gzipped) and written in batches, so memory stays flat whatever the size
+of the feed. Each record needs ``category``, ``name`` and ``price``.
+It may also have ``category_name``, ``slug``, ``description`` and
+``image``, which is a URL or a local path.
+"""
+import csv
+import gzip
+import io
+import json
+import os
+import posixpath
+from decimal import Decimal, InvalidOperation
+from urllib.parse import urlparse
+from urllib.request import urlopen
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils.text import slugify
+
+from product import search
+from product.derivatives import render_derivatives, store_derivatives
+from product.models import Category, Product
+
+# Larger downloads are refused rather than read into memory
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+
+TEXT_FIELDS = ('category', 'category_name', 'name', 'slug', 'description', 'image')
+
+_price = Product._meta.get_field('price')
+# Prices from here on don't fit the price column
+MAX_PRICE = Decimal(10) ** (_price.max_digits - _price.decimal_places)
+
+
+class RecordError(ValueError):
+    pass
+
+
+def open_feed(path):
+    if path.endswith('.gz'):
+        return io.TextIOWrapper(gzip.open(path), encoding='utf-8', newline='')
+    return open(path, encoding='utf-8', newline='')
+
+
+def feed_format(path):
+    name = path[:-3] if path.endswith('.gz') else path
+    return 'csv' if name.endswith('.csv') else 'jsonl'
+
+
+def read_records(path, fmt=None):
+    """Yield ``(line number, record)`` without loading the whole feed"""
+    fmt = fmt or feed_format(path)
+    with open_feed(path) as f:
+        if fmt == 'csv':
+            reader = csv.DictReader(f)
+            for record in reader:
+                yield reader.line_num, record
+        else:
+            for line_num, line in enumerate(f, 1):
+                if line.strip():
+                    try:
+                        yield line_num, json.loads(line)
+                    except ValueError as e:
+                        yield line_num, RecordError(f'invalid JSON: {e}')
+
+
+def clean(record):
+    """Validate a raw record into the fields of a product"""
+    if isinstance(record, Exception):
+        raise record
+    if not isinstance(record, dict):
+        raise RecordError(f'expected an object, got {type(record).__name__}')
+    for field in TEXT_FIELDS:
+        if record.get(field) is not None and not isinstance(record[field], str):
+            raise RecordError(f'{field} must be a string')
+
+    name = (record.get('name') or '').strip()
+    if not record.get('category') or not name:
+        raise RecordError('category and name are required')
+
+    # Slugs end up in URLs, which only match ASCII slugs
+    category = slugify(record['category'])
+    if not category:
+        raise RecordError(f"category {record['category']!r} has no ASCII characters to make a slug of")
+    slug = slugify(record.get('slug') or name)[:50]
+    if not slug:
+        raise RecordError(f'no slug can be made from {name!r}, give one in the slug field')
+
+    try:
+        price = Decimal(str(record.get('price'))).quantize(Decimal('0.01'))
+    except InvalidOperation:
+        raise RecordError(f"invalid price {record.get('price')!r}")
+    # NaN survives quantize(), and a price the column can't hold would fail
+    # the whole batch on every resumed run
+    if not price.is_finite():
+        raise RecordError(f"invalid price {record.get('price')!r}")
+    if price < 0:
+        raise RecordError(f"price {record.get('price')!r} is negative")
+    if price >= MAX_PRICE:
+        raise RecordError(f"price {record.get('price')!r} is not below {MAX_PRICE}")
+
+    return {
+        'category': category,
+        'category_name': (record.get('category_name') or '').strip() or category.replace('-', ' ').title(),
+        'name': name[:255],
+        'slug': slug,
+        'description': record.get('description') or '',
+        'price': price,
+        'image': (record.get('image') or '').strip(),
+    }
+
+
+class Checkpoint:
+    """How many records of a feed are imported, saved after every batch.
+
+    The feed's size and modification time are stored with the count, so
+    a checkpoint is never applied to a different file.
+    """
+
+    def __init__(self, path, feed):
+        self.path = path
+        stat = os.stat(feed)
+        self.fingerprint = [stat.st_size, stat.st_mtime_ns]
+        self.records = 0
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        if data.get('fingerprint') != self.fingerprint:
+            raise ValueError(f'{self.path} belongs to another version of the feed')
+        self.records = data['records']
+        return True
+
+    def save(self, records):
+        self.records = records
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'fingerprint': self.fingerprint, 'records': records}, f)
+        os.replace(tmp, self.path)
+
+    def delete(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class CategoryResolver:
+    """Slug to id map, creating categories it has not seen yet.
+
+    Existing categories keep their names, the name made up from a slug
+    would otherwise replace one like "TV & Audio".
+    """
+
+    def __init__(self):
+        self.ids = {}
+
+    def resolve(self, rows):
+        missing = {row['category']: row['category_name'] for row in rows if row['category'] not in self.ids}
+        if missing:
+            Category.objects.bulk_create(
+                [Category(slug=slug, name=name) for slug, name in missing.items()],
+                ignore_conflicts=True,
+            )
+            self.ids.update(Category.objects.filter(slug__in=missing).values_list('slug', 'id'))
+        return self.ids
+
+
+@transaction.atomic
+def save_batch(rows, categories):
+    """Upsert a batch of cleaned rows, return ``{(category_id, slug): product_id}``"""
+    category_ids = categories.resolve(rows)
+
+    # The last occurrence of a product in the batch wins
+    products = {}
+    for row in rows:
+        category_id = category_ids[row['category']]
+        products[(category_id, row['slug'])] = Product(
+            category_id=category_id,
+            name=row['name'],
+            slug=row['slug'],
+            description=row['description'],
+            price=row['price'],
+        )
+
+    Product.objects.bulk_create(
+        products.values(),
+        update_conflicts=True,
+        unique_fields=['category', 'slug'],
+        update_fields=['name', 'description', 'price'],
+    )
+
+    saved = Product.objects.filter(
+        category_id__in={category_id for category_id, _ in products},
+        slug__in={slug for _, slug in products},
+    ).values_list('category_id', 'slug', 'id', 'name', 'description')
+
+    ids = {}
+    index = []
+    for category_id, slug, product_id, name, description in saved:
+        if (category_id, slug) in products:
+            ids[(category_id, slug)] = product_id
+            index.append((product_id, name, description))
+
+    # bulk_create sends no signals, do what the receivers would have done
+    if search.is_available():
+        search.index_rows(index)
+    return ids
+
+
+def import_image(source, timeout=30):
+    """Download or copy an image into storage and render its derivatives.
+
+    Touches only the storage, so it runs in worker processes.
+    """
+    if urlparse(source).scheme in ('http', 'https'):
+        with urlopen(source, timeout=timeout) as response:
+            data = response.read(MAX_IMAGE_BYTES + 1)
+        basename = posixpath.basename(urlparse(source).path)
+    else:
+        with open(source, 'rb') as f:
+            data = f.read(MAX_IMAGE_BYTES + 1)
+        basename = os.path.basename(source)
+
+    if len(data) > MAX_IMAGE_BYTES:
+        raise ValueError(f'larger than {MAX_IMAGE_BYTES} bytes')
+
+    name = default_storage.save(f'uploads/{default_storage.get_valid_name(basename or "image.jpg")}', ContentFile(data))
+    return name, render_derivatives(name)
+
+
+def attach_image(product_ids, name, derivatives):
+    Product.objects.filter(pk__in=product_ids).update(image=name)
+    for product_id in product_ids:
+        store_derivatives(product_id, derivatives)
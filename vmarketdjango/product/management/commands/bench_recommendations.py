@@ -0,0 +1,50 @@
+import resource
+import time
+
+import numpy as np
+
+from django.core.management.base import BaseCommand
+
+from product import recommendations
+
+
+class Command(BaseCommand):
+    help = 'Time the recommendation job on a synthetic order history, without touching the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lines', type=int, default=3000000, help='Order lines to generate')
+        parser.add_argument('--products', type=int, default=50000)
+        parser.add_argument('--top-k', type=int, default=20)
+        parser.add_argument('--block-size', type=int, default=2000)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options['seed'])
+        lines = options['lines']
+
+        # Orders of 1 to 10 products, popularity following a long tail
+        sizes = rng.integers(1, 11, size=lines // 3)
+        sizes = sizes[:np.searchsorted(np.cumsum(sizes), lines) + 1]
+        order_ids = np.repeat(np.arange(len(sizes)), sizes)[:lines]
+        popularity = 1 / np.arange(1, options['products'] + 1) ** 0.8
+        product_ids = rng.choice(options['products'], size=len(order_ids), p=popularity / popularity.sum()) + 1
+
+        start = time.perf_counter()
+        products, related, counts = recommendations.top_neighbours(
+            order_ids, product_ids, options['top_k'], block_size=options['block_size'],
+        )
+        seconds = time.perf_counter() - start
+
+        self.stdout.write(
+            f'{len(order_ids)} lines in {len(sizes)} orders over {len(np.unique(product_ids))} products: '
+            f'{len(counts)} recommendations in {seconds:.2f}s, {len(order_ids) / seconds:,.0f} lines/s, '
+            f'peak memory {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB'
+        )
+
+        # Spot check a few products against a direct count over the raw lines
+        for product_id in np.unique(products)[:3]:
+            together = np.isin(order_ids, order_ids[product_ids == product_id])
+            _, others = np.unique(np.stack([order_ids[together], product_ids[together]]), axis=1)
+            others = others[others != product_id]
+            expected = np.bincount(others).max() if len(others) else 0
+            self.stdout.write(f'product {product_id}: top count {counts[products == product_id][0]}, direct count {expected}')
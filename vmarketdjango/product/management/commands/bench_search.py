@@ -0,0 +1,85 @@
+import random
+import statistics
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+
+from product import search
+from product.models import Category, Product
+
+WORDS = (
+    'phone laptop wireless charger cable gaming mouse keyboard monitor speaker '
+    'camera lens tripod headphones bluetooth smart watch tablet case glass '
+    'steel leather cotton black white silver pro mini max ultra compact portable'
+).split()
+
+
+class Command(BaseCommand):
+    help = 'Compare the full-text index with the old icontains search on a synthetic catalog'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100000)
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--page-size', type=int, default=24)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        if not search.is_available():
+            raise CommandError('Full-text search needs the SQLite backend')
+
+        rng = random.Random(options['seed'])
+        queries = [rng.choice(WORDS)[:rng.randint(3, 8)] for _ in range(options['queries'])]
+
+        # Everything happens in a transaction that is rolled back at the end
+        with transaction.atomic():
+            self.seed(rng, options['products'])
+
+            icontains = self.measure(queries, lambda query: list(
+                Product.objects.filter(Q(name__icontains=query) | Q(description__icontains=query))
+            ))
+            fts = self.measure(queries, lambda query: search.SearchResults(query)[0:options['page_size']])
+            fts_count = self.measure(queries, lambda query: search.SearchResults(query).count())
+
+            transaction.set_rollback(True)
+
+        self.report('icontains (all rows)', icontains)
+        self.report('fts5 first page', fts)
+        self.report('fts5 count', fts_count)
+
+    def seed(self, rng, count):
+        # A slug no real category has, the rollback removes it with its products
+        category = Category.objects.create(name='Benchmark', slug=f'benchmark-{uuid.uuid4().hex[:12]}')
+        products = [
+            Product(
+                category=category,
+                name=' '.join(rng.choices(WORDS, k=3)).title(),
+                slug=f'bench-{i}',
+                description=' '.join(rng.choices(WORDS, k=30)),
+                price=rng.randint(100, 100000) / 100,
+            )
+            for i in range(count)
+        ]
+        Product.objects.bulk_create(products, batch_size=5000)
+
+        start = time.perf_counter()
+        search.rebuild(Product.objects.order_by().values_list('id', 'name', 'description').iterator(chunk_size=5000))
+        self.stdout.write(f'Seeded and indexed {count} products (index build {time.perf_counter() - start:.2f}s)')
+
+    def measure(self, queries, run):
+        timings = []
+        for query in queries:
+            start = time.perf_counter()
+            run(query)
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings
+
+    def report(self, label, timings):
+        timings = sorted(timings)
+        p95 = timings[int(len(timings) * 0.95) - 1]
+        self.stdout.write(
+            f'{label:<22} mean {statistics.mean(timings):8.2f} ms   '
+            f'p50 {statistics.median(timings):8.2f} ms   p95 {p95:8.2f} ms'
+        )
@@ -0,0 +1,64 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from product.models import Category, Product
+from product.serializers import ProductRowSerializer, ProductSerializer
+
+
+class Command(BaseCommand):
+    help = 'Compare rows/sec of ProductSerializer and ProductRowSerializer on a synthetic catalog'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=20000)
+        parser.add_argument('--categories', type=int, default=20)
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        # Everything happens in a transaction that is rolled back at the end
+        with transaction.atomic():
+            self.seed(random.Random(options['seed']), options['products'], options['categories'])
+            queryset = Product.objects.filter(category__slug__startswith='bench-')
+
+            results = [
+                ('ProductSerializer', lambda: ProductSerializer(queryset.all(), many=True).data),
+                ('ProductRowSerializer', lambda: ProductRowSerializer(ProductRowSerializer.rows(queryset.all()), many=True).data),
+            ]
+            timings = {label: self.measure(run, options['repeat']) for label, run in results}
+
+            transaction.set_rollback(True)
+
+        for label, seconds in timings.items():
+            self.stdout.write(f'{label:<22} {options["products"] / seconds:12,.0f} rows/sec   best of {options["repeat"]}: {seconds:.3f}s')
+
+    def seed(self, rng, count, categories):
+        categories = Category.objects.bulk_create(
+            Category(name=f'Bench {i}', slug=f'bench-{i}') for i in range(categories)
+        )
+        Product.objects.bulk_create(
+            (
+                Product(
+                    category=rng.choice(categories),
+                    name=f'Product {i}',
+                    slug=f'product-{i}',
+                    description='Synthetic benchmark product',
+                    price=rng.randint(100, 100000) / 100,
+                    image=f'uploads/product-{i}.jpg',
+                    thumbnail=f'derivatives/uploads/product-{i}_card.jpg',
+                )
+                for i in range(count)
+            ),
+            batch_size=5000,
+        )
+
+    def measure(self, run, repeat):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
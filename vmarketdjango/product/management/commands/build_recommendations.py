@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from product import recommendations
+
+
+class Command(BaseCommand):
+    help = 'Recompute the "customers also bought" recommendations from the order history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-k', type=int, help='Products kept per product, defaults to RECOMMENDATIONS_TOP_K')
+        parser.add_argument('--min-orders', type=int, default=1, help='Orders two products must share to be related')
+        parser.add_argument('--block-size', type=int, default=2000, help='Products whose co-occurrence counts are computed at once')
+
+    def handle(self, *args, **options):
+        lines, pairs, timings = recommendations.build(options['top_k'], options['min_orders'], options['block_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Stored {pairs} recommendations from {lines} order lines "
+            f"(load {timings['load']:.1f}s, compute {timings['compute']:.1f}s, store {timings['store']:.1f}s)"
+        ))
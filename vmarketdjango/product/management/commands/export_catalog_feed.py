@@ -0,0 +1,26 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from product import feed
+
+
+class Command(BaseCommand):
+    help = 'Write the whole catalog as a gzipped JSON lines or CSV feed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=feed.FORMATS, default='jsonl')
+        parser.add_argument('--output', help='Defaults to standard output')
+        parser.add_argument('--base-url', default='http://localhost:8000', help='Prefix of the image URLs')
+
+    def handle(self, *args, **options):
+        chunks = feed.stream(options['format'], options['base_url'])
+
+        if options['output']:
+            with open(options['output'], 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+        else:
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
@@ -0,0 +1,47 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.management.base import BaseCommand
+
+from product.derivatives import render_derivatives, store_derivatives
+from product.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Build the image derivatives of existing products in parallel'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--force', action='store_true', help='Rebuild derivatives that are already up to date')
+
+    def handle(self, *args, **options):
+        products = Product.objects.exclude(image='').exclude(image__isnull=True).only('id', 'image', 'thumbnails')
+
+        # Several products may point at the same upload, decode each file only once
+        pending = {}
+        for product in products.iterator():
+            if options['force'] or product.needs_thumbnails():
+                pending.setdefault(product.image.name, []).append(product.id)
+
+        if not pending:
+            self.stdout.write('All product thumbnails are up to date')
+            return
+
+        built = failed = 0
+        with ProcessPoolExecutor(max_workers=options['workers'], initializer=django.setup) as executor:
+            futures = {executor.submit(render_derivatives, name): name for name in pending}
+
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f'{name}: {e}')
+                    continue
+
+                for product_id in pending[name]:
+                    built += store_derivatives(product_id, result)
+
+        self.stdout.write(self.style.SUCCESS(f'Built thumbnails for {built} products ({failed} images failed)'))
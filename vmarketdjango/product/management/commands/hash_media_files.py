@@ -0,0 +1,44 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from order.models import UserProfile
+from product.cache import bump_catalog_version
+from product.models import Product
+from vmarketdjango.storage import is_hashed
+
+
+class Command(BaseCommand):
+    help = 'Move media uploaded before content hashing to hashed names, so it can be cached as immutable'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--delete-old', action='store_true', help='Delete the files under their old names')
+
+    def handle(self, *args, **options):
+        self.renamed = {}
+
+        for product in Product.objects.only('id', 'image', 'thumbnail', 'thumbnails').iterator():
+            changes = {
+                'image': self.rehash(product.image.name),
+                'thumbnail': self.rehash(product.thumbnail.name),
+                'thumbnails': {size_name: self.rehash(name) for size_name, name in product.thumbnails.items()},
+            }
+            # update() skips the save signals, the images themselves did not change
+            Product.objects.filter(pk=product.pk).update(**changes)
+
+        for profile in UserProfile.objects.exclude(profile_picture='').exclude(profile_picture=None).only('id', 'profile_picture'):
+            UserProfile.objects.filter(pk=profile.pk).update(profile_picture=self.rehash(profile.profile_picture.name))
+
+        if options['delete_old']:
+            for old_name in self.renamed:
+                default_storage.delete(old_name)
+
+        bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(f'Moved {len(self.renamed)} files to content-hashed names'))
+
+    def rehash(self, name):
+        if not name or is_hashed(name) or not default_storage.exists(name):
+            return name
+        if name not in self.renamed:
+            with default_storage.open(name) as f:
+                self.renamed[name] = default_storage.save(name, f)
+        return self.renamed[name]
@@ -0,0 +1,108 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+
+from product import importer
+from product.cache import bump_catalog_version
+
+
+class Command(BaseCommand):
+    help = 'Stream a CSV or JSON lines catalog feed into the database, resuming where an earlier run stopped'
+
+    def add_arguments(self, parser):
+        parser.add_argument('feed', help='A .csv or .jsonl file, optionally gzipped')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help='Defaults to the file extension')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Processes fetching images and building thumbnails')
+        parser.add_argument('--no-images', action='store_true', help='Import product data only')
+        parser.add_argument('--checkpoint', help='Progress file, defaults to <feed>.checkpoint')
+        parser.add_argument('--restart', action='store_true', help='Ignore an existing checkpoint')
+
+    def handle(self, *args, **options):
+        feed = options['feed']
+        if not os.path.isfile(feed):
+            raise CommandError(f'{feed} does not exist')
+
+        checkpoint = importer.Checkpoint(options['checkpoint'] or f'{feed}.checkpoint', feed)
+        if not options['restart']:
+            try:
+                if checkpoint.load():
+                    self.stdout.write(f'Resuming after record {checkpoint.records}')
+            except ValueError as e:
+                raise CommandError(f'{e}, pass --restart to import it from the beginning')
+
+        self.imported = self.invalid = self.images = self.image_failures = 0
+        self.start = time.perf_counter()
+        executor = None
+        if not options['no_images']:
+            executor = ProcessPoolExecutor(max_workers=options['workers'], initializer=django.setup)
+
+        try:
+            self.run(feed, options, checkpoint, executor)
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+        checkpoint.delete()
+        bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {self.imported} products, skipped {self.invalid} invalid records, '
+            f'{self.images} images ({self.image_failures} failed) in {time.perf_counter() - self.start:.1f}s'
+        ))
+
+    def run(self, feed, options, checkpoint, executor):
+        categories = importer.CategoryResolver()
+        batch = []
+        position = 0
+
+        for line_num, record in importer.read_records(feed, options['format']):
+            position += 1
+            if position <= checkpoint.records:
+                continue
+
+            try:
+                batch.append(importer.clean(record))
+            except importer.RecordError as e:
+                self.invalid += 1
+                self.stderr.write(f'Line {line_num}: {e}')
+
+            if len(batch) >= options['batch_size']:
+                self.import_batch(batch, categories, executor)
+                checkpoint.save(position)
+                batch = []
+
+        if batch:
+            self.import_batch(batch, categories, executor)
+            checkpoint.save(position)
+
+    def import_batch(self, rows, categories, executor):
+        ids = importer.save_batch(rows, categories)
+        self.imported += len(ids)
+
+        if executor is not None:
+            # Products sharing an image fetch and render it once
+            sources = {}
+            for row in rows:
+                if row['image']:
+                    product_id = ids[(categories.ids[row['category']], row['slug'])]
+                    sources.setdefault(row['image'], set()).add(product_id)
+
+            futures = {executor.submit(importer.import_image, source): source for source in sources}
+            # Waiting here keeps memory bounded and the checkpoint honest
+            done, _ = wait(futures)
+            for future in done:
+                source = futures[future]
+                try:
+                    name, derivatives = future.result()
+                except Exception as e:
+                    self.image_failures += 1
+                    self.stderr.write(f'Image {source}: {e}')
+                    continue
+                importer.attach_image(sources[source], name, derivatives)
+                self.images += 1
+
+        elapsed = time.perf_counter() - self.start
+        self.stdout.write(f'{self.imported} products imported, {self.imported / elapsed:.0f}/s')
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from product import search
+from product.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text product search index from scratch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        if not search.is_available():
+            raise CommandError('Full-text search needs the SQLite backend')
+
+        rows = Product.objects.order_by().values_list('id', 'name', 'description').iterator(chunk_size=options['batch_size'])
+        with transaction.atomic():
+            indexed = search.rebuild(rows, batch_size=options['batch_size'])
+
+        self.stdout.write(self.style.SUCCESS(f'Indexed {indexed} products'))
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.6 on 2026-10-18 14:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0002_alter_product_category'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='thumbnails',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
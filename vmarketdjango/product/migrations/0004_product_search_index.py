@@ -0,0 +1,43 @@
+from django.db import migrations
+
+# Kept here rather than imported from product.search, so later changes to
+# that module cannot change what this migration does
+CREATE_TABLE = '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS product_search USING fts5(
+        name,
+        description,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    )
+'''
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+
+    Product = apps.get_model('product', 'Product')
+    rows = Product.objects.using(schema_editor.connection.alias).values_list('id', 'name', 'description')
+    schema_editor.execute(CREATE_TABLE)
+    with schema_editor.connection.cursor() as cursor:
+        cursor.executemany(
+            'INSERT INTO product_search (rowid, name, description) VALUES (%s, %s, %s)',
+            ((product_id, name, description or '') for product_id, name, description in rows.iterator()),
+        )
+        cursor.execute("INSERT INTO product_search (product_search) VALUES ('optimize')")
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS product_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0003_product_thumbnails'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.1.6 on 2026-10-18 14:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0004_product_search_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['-data_added', '-id'], name='product_added_id_idx'),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 4.1.6 on 2026-10-18 14:59
+
+import itertools
+
+from django.db import migrations, models
+
+
+def unique_slug(slug, pk, taken, max_length=50):
+    """slug-<pk>, with -2, -3... after it until no row has it yet"""
+    for n in itertools.count(1):
+        suffix = f'-{pk}' if n == 1 else f'-{pk}-{n}'
+        candidate = slug[:max_length - len(suffix)] + suffix
+        if candidate not in taken:
+            return candidate
+
+
+def deduplicate_slugs(apps, schema_editor):
+    """Keep the oldest row of every duplicate and move the others to slug-<id>"""
+    Category = apps.get_model('product', 'Category')
+    Product = apps.get_model('product', 'Product')
+
+    # A new slug must not clash with rows further on either
+    taken = set(Category.objects.values_list('slug', flat=True))
+    seen = set()
+    for category in Category.objects.order_by('id').only('id', 'slug'):
+        if category.slug in seen:
+            category.slug = unique_slug(category.slug, category.pk, taken)
+            category.save(update_fields=['slug'])
+            taken.add(category.slug)
+        seen.add(category.slug)
+
+    taken = {}
+    for category_id, slug in Product.objects.values_list('category_id', 'slug'):
+        taken.setdefault(category_id, set()).add(slug)
+    seen = set()
+    for product in Product.objects.order_by('id').only('id', 'category_id', 'slug'):
+        key = (product.category_id, product.slug)
+        if key in seen:
+            product.slug = unique_slug(product.slug, product.pk, taken[product.category_id])
+            product.save(update_fields=['slug'])
+            taken[product.category_id].add(product.slug)
+            key = (product.category_id, product.slug)
+        seen.add(key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0005_product_added_id_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(deduplicate_slugs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='category',
+            name='slug',
+            field=models.SlugField(unique=True),
+        ),
+        migrations.AddConstraint(
+            model_name='product',
+            constraint=models.UniqueConstraint(fields=('category', 'slug'), name='product_category_slug_uniq'),
+        ),
+    ]
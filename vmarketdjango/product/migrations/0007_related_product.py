@@ -0,0 +1,31 @@
+# Generated by Django 4.1.6 on 2026-10-18 15:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0006_unique_slugs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RelatedProduct',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('orders', models.IntegerField(default=0)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='related', to='product.product')),
+                ('related', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recommended_for', to='product.product')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='relatedproduct',
+            index=models.Index(fields=['product', '-orders', 'related'], name='related_product_rank_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='relatedproduct',
+            constraint=models.UniqueConstraint(fields=('product', 'related'), name='related_product_pair_uniq'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.1.6 on 2026-10-18 15:33
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def count_units_sold(apps, schema_editor):
+    Product = apps.get_model('product', 'Product')
+    ProductSales = apps.get_model('order', 'ProductSales')
+    units = ProductSales.objects.filter(product=OuterRef('pk')).order_by().values('product').annotate(units=Sum('units')).values('units')
+    Product.objects.update(units_sold=Coalesce(Subquery(units), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0007_related_product'),
+        ('order', '0007_sales_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='units_sold',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_units_sold, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['price', 'id'], name='product_price_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['-units_sold', '-id'], name='product_popular_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', '-data_added', '-id'], name='product_category_added_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', 'price'], name='product_category_price_idx'),
+        ),
+    ]
@@ -1,12 +1,14 @@
-from io import BytesIO
-from PIL import Image
+from django.core.files.storage import default_storage
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 
-from django.core.files import File
-from django.db import models
+from product import derivatives, search
+from product.cache import bump_catalog_version
 
 class Category(models.Model):
     name = models.CharField(max_length=255)
-    slug = models.SlugField()
+    slug = models.SlugField(unique=True)
 
     class Meta:
         ordering = ('name',)
@@ -25,10 +27,23 @@ class Product(models.Model):
     price = models.DecimalField(max_digits=9, decimal_places=2)
     image = models.ImageField(upload_to='uploads/', blank=True, null=True)
     thumbnail = models.ImageField(upload_to='uploads/', blank=True, null=True)
+    thumbnails = models.JSONField(default=dict, blank=True, editable=False)
     data_added = models.DateTimeField(auto_now_add=True)
+    # Units sold by non cancelled orders, kept by order.rollups for ?sort=popular
+    units_sold = models.IntegerField(default=0, editable=False)
 
     class Meta:
         ordering = ('-data_added',)
+        indexes = [
+            models.Index(fields=['-data_added', '-id'], name='product_added_id_idx'),
+            models.Index(fields=['price', 'id'], name='product_price_id_idx'),
+            models.Index(fields=['-units_sold', '-id'], name='product_popular_idx'),
+            models.Index(fields=['category', '-data_added', '-id'], name='product_category_added_idx'),
+            models.Index(fields=['category', 'price'], name='product_category_price_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['category', 'slug'], name='product_category_slug_uniq'),
+        ]
 
     def __str__(self):
         return self.name
@@ -44,24 +59,62 @@ class Product(models.Model):
     def get_thumbnail(self):
         if self.thumbnail:
             return self.thumbnail.url
-        else:
-            if self.image:
-                self.thumbnail = self.make_thumbnail(self.image)
-                self.save()
-                
-                return self.thumbnail.url
-            else:
-                return ''
+        return ''
 
-    def make_thumbnail(self, image, size=(300, 200)):
-        img = Image.open(image)
-        img.convert('RGB')
-        img.thumbnail(size)
+    def get_thumbnails(self):
+        """URLs of the precomputed derivatives, keyed by size name"""
+        return {
+            size_name: default_storage.url(self.thumbnails[size_name])
+            for size_name in derivatives.get_sizes()
+            if self.thumbnails.get(size_name)
+        }
 
-        thumb_io = BytesIO()
-        img.save(thumb_io, 'JPEG', quality=85)
+    def needs_thumbnails(self):
+        return bool(self.image) and self.thumbnails.get('source') != self.image.name
 
-        thumbnail = File(thumb_io, name=image.name)
+class RelatedProduct(models.Model):
+    """``related`` was bought together with ``product`` in ``orders`` orders, see product.recommendations"""
+    product = models.ForeignKey(Product, related_name='related', on_delete=models.CASCADE)
+    related = models.ForeignKey(Product, related_name='recommended_for', on_delete=models.CASCADE)
+    orders = models.IntegerField(default=0)
 
-        return thumbnail
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', '-orders', 'related'], name='related_product_rank_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'related'], name='related_product_pair_uniq'),
+        ]
 
+    def __str__(self):
+        return f'{self.product_id} -> {self.related_id}: {self.orders}'
+
+@receiver(post_save, sender=Product)
+def schedule_product_thumbnails(sender, instance, raw=False, **kwargs):
+    """Build image derivatives off the request path whenever a new image is uploaded"""
+    if raw:
+        return
+
+    if instance.needs_thumbnails():
+        derivatives.schedule(instance.pk)
+    elif not instance.image and instance.thumbnails:
+        Product.objects.filter(pk=instance.pk).update(thumbnail='', thumbnails={})
+
+@receiver(post_save, sender=Product)
+def index_product_for_search(sender, instance, **kwargs):
+    """Keep the full-text index in step with every saved product"""
+    if search.is_available():
+        search.index_product(instance)
+
+@receiver(post_delete, sender=Product)
+def remove_product_from_search(sender, instance, **kwargs):
+    if search.is_available():
+        search.remove_product(instance.pk)
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_catalog_cache(sender, **kwargs):
+    # Once committed, or a concurrent reader could cache the old rows under the new version
+    transaction.on_commit(bump_catalog_version)
@@ -0,0 +1,107 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+
+from django.core.exceptions import ValidationError
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+class CatalogPagination(PageNumberPagination):
+    page_size = 24
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+class ProductCursorPagination(BasePagination):
+    """Keyset pagination over ``(data_added, id)``, newest first.
+
+    Each page seeks straight to the last row of the previous one through the
+    product_added_id_idx index, so page 1000 costs the same as page 1 and
+    rows inserted meanwhile never shift or repeat items during infinite scroll.
+    A view can sort on another field by setting ``ordering`` to a
+    ``(field, id)`` pair going the same direction, with an index to match.
+    """
+    ordering = ('-data_added', '-id')
+    page_size = 24
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+
+        ordering = self.get_ordering(view)
+        self.field = ordering[0]
+        name = self.field.lstrip('-')
+        queryset = queryset.order_by(*ordering)
+        position = self.decode_cursor(request, queryset.model._meta.get_field(name))
+        if position is not None:
+            value, pk = position
+            if self.field.startswith('-'):
+                queryset = queryset.filter(**{f'{name}__lte': value}).exclude(**{name: value, 'id__gte': pk})
+            else:
+                queryset = queryset.filter(**{f'{name}__gte': value}).exclude(**{name: value, 'id__lte': pk})
+
+        rows = list(queryset[:page_size + 1])
+        page = rows[:page_size]
+
+        self.next_position = None
+        if len(rows) > page_size:
+            self.next_position = self.get_position(page[-1])
+        return page
+
+    def get_ordering(self, view):
+        return getattr(view, 'ordering', None) or self.ordering
+
+    def get_position(self, row):
+        name = self.field.lstrip('-')
+        # Pages hold either model instances or .values() rows
+        if isinstance(row, dict):
+            return row[name], row['id']
+        return getattr(row, name), row.id
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def decode_cursor(self, request, field):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+
+        try:
+            value, pk = urlsafe_b64decode(encoded.encode('ascii')).decode('ascii').split('|')
+            return field.to_python(value), int(pk)
+        except (TypeError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, position):
+        value, pk = position
+        value = value.isoformat() if hasattr(value, 'isoformat') else str(value)
+        encoded = urlsafe_b64encode(f'{value}|{pk}'.encode('ascii')).decode('ascii')
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        return self.encode_cursor(self.next_position)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True},
+                'results': schema,
+            },
+        }
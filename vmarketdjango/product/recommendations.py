@@ -0,0 +1,159 @@
+"""Customers also bought: for every product, the products most often
+found in the same orders.
+
+``build`` is the offline job behind ``manage.py build_recommendations``.
+It loads every (order, product) line into a sparse order x product
+matrix X and gets the co-occurrence counts of a block of products at a
+time as ``X[:, block].T @ X``, then keeps the RECOMMENDATIONS_TOP_K most
+frequent neighbours of each product with vectorized sorting, never
+materializing the full product x product matrix.
+
+Between builds, ``record_order`` adds the pairs of every new order to
+the stored counts with one additive upsert, once the checkout has
+committed. Pairs that were not stored yet start from that order alone,
+so the next build recomputes exact counts and trims every product back
+to its top K.
+"""
+import itertools
+import logging
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+
+from order.rollups import increment
+from product.models import RelatedProduct
+
+logger = logging.getLogger('vmarket.recommendations')
+
+CANCELLED = 'cancelled'
+# Bigger orders (bulk purchases) say little about which products go together
+MAX_ORDER_PRODUCTS = 50
+
+
+def load_lines(chunk_size=20000):
+    """``(order_ids, product_ids)`` arrays of every line of a non cancelled order"""
+    import numpy as np
+
+    from order.models import OrderItem
+
+    lines = (
+        OrderItem.objects
+        .exclude(order__status=CANCELLED)
+        .order_by()
+        .values_list('order_id', 'product_id')
+        .iterator(chunk_size=chunk_size)
+    )
+    flat = np.fromiter(itertools.chain.from_iterable(lines), dtype=np.int64)
+    return flat[0::2], flat[1::2]
+
+
+def top_neighbours(order_ids, product_ids, top_k, min_orders=1, block_size=2000):
+    """Return ``(product, related, orders)`` arrays with the ``top_k`` most
+    co-ordered products of every product, highest counts first"""
+    # Only the offline job needs these, web workers never import them
+    import numpy as np
+    from scipy import sparse
+
+    products, columns = np.unique(product_ids, return_inverse=True)
+    _, rows = np.unique(order_ids, return_inverse=True)
+    orders = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.int32), (rows, columns)),
+        shape=(rows.max() + 1 if len(rows) else 0, len(products)),
+    )
+    # A product listed twice in one order still counts once
+    orders.sum_duplicates()
+    orders.data[:] = 1
+    by_product = orders.T.tocsr()
+
+    results = ([], [], [])
+    for start in range(0, len(products), block_size):
+        counts = (by_product[start:start + block_size] @ orders).tocsr()
+        source = np.repeat(np.arange(start, start + counts.shape[0]), np.diff(counts.indptr))
+        target, count = counts.indices, counts.data
+
+        keep = (source != target) & (count >= min_orders)
+        source, target, count = source[keep], target[keep], count[keep]
+
+        # Highest counts first within each product, ties by product id
+        order = np.lexsort((target, -count, source))
+        source, target, count = source[order], target[order], count[order]
+        rank = np.arange(len(source)) - np.searchsorted(source, source)
+        keep = rank < top_k
+
+        results[0].append(products[source[keep]])
+        results[1].append(products[target[keep]])
+        results[2].append(count[keep])
+
+    if not results[0]:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, empty
+    return tuple(np.concatenate(parts) for parts in results)
+
+
+@transaction.atomic
+def store(product_ids, related_ids, counts, batch_size=5000):
+    """Replace every stored recommendation"""
+    RelatedProduct.objects.all().delete()
+    rows = zip(product_ids.tolist(), related_ids.tolist(), counts.tolist())
+    while True:
+        batch = [
+            RelatedProduct(product_id=product_id, related_id=related_id, orders=count)
+            for product_id, related_id, count in itertools.islice(rows, batch_size)
+        ]
+        if not batch:
+            break
+        # Checkouts may have upserted a pair since the delete above
+        RelatedProduct.objects.bulk_create(
+            batch,
+            update_conflicts=True,
+            unique_fields=['product', 'related'],
+            update_fields=['orders'],
+        )
+
+
+def build(top_k=None, min_orders=1, block_size=2000):
+    """Recompute the recommendations from the order history, return timings in seconds"""
+    top_k = top_k or settings.RECOMMENDATIONS_TOP_K
+    timings = {}
+
+    start = time.perf_counter()
+    order_ids, product_ids = load_lines()
+    timings['load'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    product_ids, related_ids, counts = top_neighbours(order_ids, product_ids, top_k, min_orders, block_size)
+    timings['compute'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    store(product_ids, related_ids, counts)
+    timings['store'] = time.perf_counter() - start
+
+    return len(order_ids), len(counts), timings
+
+
+def record_order(product_ids):
+    """Count the products of a new order as bought together.
+
+    An order of n products makes n * (n - 1) pairs, so they are added in a
+    transaction of their own after the checkout commits rather than keep
+    the checkout's locks held meanwhile.
+    """
+    product_ids = sorted(set(product_ids))
+    if len(product_ids) < 2 or len(product_ids) > MAX_ORDER_PRODUCTS:
+        return
+    transaction.on_commit(lambda: add_pairs(product_ids))
+
+
+def add_pairs(product_ids):
+    try:
+        with transaction.atomic():
+            increment(RelatedProduct, ['product', 'related'], [
+                {'product': product_id, 'related': related_id, 'orders': 1}
+                for product_id in product_ids
+                for related_id in product_ids
+                if product_id != related_id
+            ])
+    except DatabaseError:
+        # The order is saved already, the next build counts its pairs
+        logger.exception('Recording the pairs of products %s failed', product_ids)
@@ -0,0 +1,157 @@
+import re
+from html import escape
+
+from django.db import connection, connections, router
+from django.db.models.expressions import RawSQL
+
+# FTS5 table over the product names and descriptions, created by migration 0004
+TABLE = 'product_search'
+
+# Matches in the name count ten times more than matches in the description
+RANK = f'bm25({TABLE}, 10.0, 1.0)'
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# FTS5 wraps matches in these, they become <mark> tags once the text around them is escaped
+MARK_START = '\x02'
+MARK_END = '\x03'
+
+
+def is_available():
+    """The inverted index lives in an SQLite FTS5 table, other backends fall back to LIKE"""
+    return connection.vendor == 'sqlite'
+
+
+def mark(text):
+    """HTML-escape a highlight or snippet, keeping its matches as <mark> tags"""
+    return escape(text or '').replace(MARK_START, '<mark>').replace(MARK_END, '</mark>')
+
+
+def build_match(query):
+    """Turn free text typed by a user into a safe FTS5 expression.
+
+    Every word must match, the last one as a prefix so results show up
+    while the user is still typing.
+    """
+    tokens = TOKEN_RE.findall(query.lower())
+    if not tokens:
+        return ''
+
+    terms = [f'"{token}"' for token in tokens]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def filter_matching(queryset, query):
+    """Narrow a Product queryset to the matches of ``query`` with a subquery on the index"""
+    match = build_match(query)
+    if not match:
+        return queryset.none()
+    return queryset.filter(pk__in=RawSQL(f'SELECT rowid FROM {TABLE} WHERE {TABLE} MATCH %s', [match]))
+
+
+def index_product(product):
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABLE} WHERE rowid = %s', [product.pk])
+        cursor.execute(
+            f'INSERT INTO {TABLE} (rowid, name, description) VALUES (%s, %s, %s)',
+            [product.pk, product.name, product.description or ''],
+        )
+
+
+def index_rows(rows):
+    """Add or refresh (id, name, description) rows, for products saved in bulk"""
+    rows = [(row[0], row[1], row[2] or '') for row in rows]
+    with connection.cursor() as cursor:
+        cursor.executemany(f'DELETE FROM {TABLE} WHERE rowid = %s', [(row[0],) for row in rows])
+        cursor.executemany(f'INSERT INTO {TABLE} (rowid, name, description) VALUES (%s, %s, %s)', rows)
+
+
+def remove_product(product_id):
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABLE} WHERE rowid = %s', [product_id])
+
+
+def rebuild(rows, batch_size=2000):
+    """Replace the whole index with ``rows`` of (id, name, description)"""
+    indexed = 0
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABLE}')
+
+        batch = []
+        for row in rows:
+            batch.append((row[0], row[1], row[2] or ''))
+            if len(batch) >= batch_size:
+                cursor.executemany(f'INSERT INTO {TABLE} (rowid, name, description) VALUES (%s, %s, %s)', batch)
+                indexed += len(batch)
+                batch = []
+        if batch:
+            cursor.executemany(f'INSERT INTO {TABLE} (rowid, name, description) VALUES (%s, %s, %s)', batch)
+            indexed += len(batch)
+
+        # Merge the b-tree segments written by the inserts above
+        cursor.execute(f"INSERT INTO {TABLE} ({TABLE}) VALUES ('optimize')")
+    return indexed
+
+
+class SearchResults:
+    """Lazy, sliceable view over the ranked matches of a query.
+
+    It only implements what ``django.core.paginator.Paginator`` needs, so
+    a page costs one COUNT and one ranked LIMIT/OFFSET query on the index.
+    """
+
+    def __init__(self, query):
+        from product.models import Product
+
+        self.match = build_match(query)
+        # Reads follow the router, so searches can be served by the replica
+        self.connection = connections[router.db_for_read(Product)]
+
+    def count(self):
+        if not self.match:
+            return 0
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'SELECT count(*) FROM {TABLE} WHERE {TABLE} MATCH %s', [self.match])
+            return cursor.fetchone()[0]
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            raise TypeError('SearchResults only supports slicing')
+        if not self.match:
+            return []
+
+        start = index.start or 0
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f'''
+                SELECT rowid,
+                       highlight({TABLE}, 0, %s, %s),
+                       snippet({TABLE}, 1, %s, %s, '…', 16)
+                FROM {TABLE}
+                WHERE {TABLE} MATCH %s
+                ORDER BY {RANK}
+                LIMIT %s OFFSET %s
+                ''',
+                [MARK_START, MARK_END, MARK_START, MARK_END, self.match, index.stop - start, start],
+            )
+            return self._attach_products(cursor.fetchall())
+
+    def _attach_products(self, rows):
+        from product.models import Product
+
+        products = Product.objects.using(self.connection.alias).select_related('category').in_bulk([row[0] for row in rows])
+
+        results = []
+        for product_id, name_highlight, snippet in rows:
+            product = products.get(product_id)
+            # The index can briefly lag behind a delete, skip rows that are gone
+            if product is None:
+                continue
+            product.name_highlight = mark(name_highlight)
+            product.description_snippet = mark(snippet)
+            results.append(product)
+        return results
@@ -1,7 +1,11 @@
+from django.core.files.storage import default_storage
 from rest_framework import serializers
+
+from product.derivatives import get_sizes
 from product.models import Category, Product
+from vmarketdjango.metrics import TimedSerializerMixin
 
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Product
         fields = (
@@ -12,15 +16,79 @@ class ProductSerializer(serializers.ModelSerializer):
             "price",
             "get_image",
             "get_thumbnail",
+            "get_thumbnails",
+        )
+
+class ProductRowSerializer(TimedSerializerMixin, serializers.BaseSerializer):
+    """Read-only twin of ProductSerializer for list payloads.
+
+    Works on plain ``.values()`` rows from ``rows()`` with the category slug
+    joined in, so no model instances are built and no lazy category fetch
+    happens per product. The output is identical to ProductSerializer.
+    """
+    FIELDS = (
+        "id",
+        "name",
+        "slug",
+        "category__slug",
+        "description",
+        "price",
+        "image",
+        "thumbnail",
+        "thumbnails",
+        "data_added",
+        "units_sold",
+    )
+
+    @classmethod
+    def rows(cls, queryset):
+        return queryset.values(*cls.FIELDS)
+
+    def to_representation(self, row):
+        thumbnails = row["thumbnails"] or {}
+        return {
+            "id": row["id"],
+            "name": row["name"],
+            "get_absolute_url": f'/{row["category__slug"]}/{row["slug"]}/',
+            "description": row["description"],
+            "price": str(row["price"]),
+            "get_image": default_storage.url(row["image"]) if row["image"] else "",
+            "get_thumbnail": default_storage.url(row["thumbnail"]) if row["thumbnail"] else "",
+            "get_thumbnails": {
+                size_name: default_storage.url(thumbnails[size_name])
+                for size_name in get_sizes()
+                if thumbnails.get(size_name)
+            },
+        }
+
+class ProductSearchSerializer(ProductSerializer):
+    name_highlight = serializers.CharField(read_only=True)
+    description_snippet = serializers.CharField(read_only=True)
+
+    class Meta(ProductSerializer.Meta):
+        fields = ProductSerializer.Meta.fields + (
+            "name_highlight",
+            "description_snippet",
+        )
+
+class CategorySerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    """Just the category, its products are paged by /categories/<slug>/products/"""
+    class Meta:
+        model = Category
+        fields = (
+            'id',
+            'name',
+            'get_absolute_url',
         )
 
-class CategorySerializer(serializers.ModelSerializer):
-    products = ProductSerializer(many=True)
+class CategoryIndexSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    product_count = serializers.IntegerField(read_only=True)
+
     class Meta:
         model = Category
         fields = (
             'id',
             'name',
             'get_absolute_url',
-            'products',
-        )
\ No newline at end of file
+            'product_count',
+        )
@@ -1,3 +1,804 @@
-from django.test import TestCase
+import csv
+import gzip
+import importlib
+import json
+import os
+import random
+import shutil
+import tempfile
+import zlib
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from PIL import Image
+
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from order.models import Order, OrderItem
+from product import derivatives, feed, importer, recommendations, search
+from product.cache import get_catalog_version
+from product.models import Category, Product, RelatedProduct
+from product.serializers import ProductRowSerializer, ProductSerializer
+from vmarketdjango import media, storage
+
+
+@skipUnless(connection.vendor == 'sqlite', 'Query plans are checked against SQLite')
+class SlugLookupTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for c in range(20):
+            category = Category.objects.create(name=f'Category {c}', slug=f'category-{c}')
+            Product.objects.bulk_create(
+                Product(category=category, name=f'Product {p}', slug=f'product-{p}', price=p)
+                for p in range(50)
+            )
+
+    def query_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertNoFullScan(self, plan):
+        for step in plan:
+            self.assertNotRegex(step, r'^SCAN', plan)
+
+    def test_category_lookup_uses_unique_index(self):
+        plan = self.query_plan(Category.objects.filter(slug='category-7'))
+
+        self.assertNoFullScan(plan)
+        self.assertIn('SEARCH product_category USING INDEX', plan[0])
+        self.assertIn('(slug=?)', plan[0])
+
+    def test_product_lookup_uses_composite_index(self):
+        queryset = Product.objects.select_related('category').filter(category__slug='category-7', slug='product-3')
+        plan = self.query_plan(queryset)
+
+        self.assertNoFullScan(plan)
+        self.assertTrue(any(
+            step.startswith('SEARCH product_product USING INDEX') and '(category_id=? AND slug=?)' in step
+            for step in plan
+        ), plan)
+        self.assertEqual(queryset.get().name, 'Product 3')
+
+    def test_slugs_are_unique(self):
+        category = Category.objects.get(slug='category-1')
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Category.objects.create(name='Duplicate', slug='category-1')
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Product.objects.create(category=category, name='Duplicate', slug='product-1', price=1)
+
+        # The same product slug is fine in another category
+        other = Category.objects.create(name='Other', slug='other')
+        Product.objects.create(category=other, name='Product 1', slug='product-1', price=1)
+
+    def test_renamed_duplicates_skip_slugs_in_use(self):
+        migration = importlib.import_module('product.migrations.0006_unique_slugs')
+
+        self.assertEqual(migration.unique_slug('case', 3, {'case'}), 'case-3')
+        # Another row already is case-3, maybe one that comes later
+        self.assertEqual(migration.unique_slug('case', 3, {'case', 'case-3', 'case-3-2'}), 'case-3-3')
+        self.assertEqual(migration.unique_slug('c' * 50, 3, {'c' * 50}), 'c' * 48 + '-3')
+
+
+class CategoryPageTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('customer')
+        category = Category.objects.create(name='Category', slug='category')
+        for p in range(30):
+            Product.objects.create(category=category, name=f'Product {p}', slug=f'product-{p}', price=1)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_detail_has_no_products(self):
+        response = self.client.get('/api/v1/products/category/')
+        self.assertEqual(response.data, {'id': response.data['id'], 'name': 'Category', 'get_absolute_url': '/category/'})
+
+    def test_products_come_in_cursor_pages(self):
+        page = self.client.get('/api/v1/categories/category/products/').data
+        self.assertEqual(len(page['results']), 24)
+
+        rest = self.client.get(page['next']).data
+        self.assertIsNone(rest['next'])
+        names = [row['name'] for row in page['results'] + rest['results']]
+        self.assertEqual(names, [f'Product {p}' for p in reversed(range(30))])
+
+        self.assertEqual(self.client.get('/api/v1/categories/missing/products/').status_code, 404)
+
+
+class CatalogCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('customer')
+        cls.category = Category.objects.create(name='Category', slug='category')
+        cls.product = Product.objects.create(category=cls.category, name='Product', slug='product', price=1)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_responses_are_cached_per_version_and_url(self):
+        first = self.client.get('/api/v1/latest-products/')
+        self.assertEqual(first.status_code, 200)
+        entry = cache.get(f'catalog:{get_catalog_version()}:json:http://testserver/api/v1/latest-products/')
+        self.assertEqual(entry['etag'], first['ETag'])
+
+        with self.assertNumQueries(0):
+            second = self.client.get('/api/v1/latest-products/')
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second['ETag'], first['ETag'])
+
+        # Another URL is another entry
+        with self.assertNumQueries(1):
+            self.client.get('/api/v1/categories/')
+
+    def test_matching_etag_gets_not_modified(self):
+        etag = self.client.get('/api/v1/categories/')['ETag']
+
+        response = self.client.get('/api/v1/categories/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], etag)
+
+        self.assertEqual(self.client.get('/api/v1/categories/', HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_product_save_invalidates_once_committed(self):
+        etag = self.client.get('/api/v1/latest-products/')['ETag']
+        version = get_catalog_version()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.name = 'Renamed'
+            self.product.save()
+            # Readers keep the old version until the write is visible
+            self.assertEqual(get_catalog_version(), version)
+        self.assertEqual(get_catalog_version(), version + 1)
+
+        response = self.client.get('/api/v1/latest-products/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data[0]['name'], 'Renamed')
+
+    def test_rolled_back_save_keeps_the_cache(self):
+        version = get_catalog_version()
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                self.product.save()
+                Product.objects.create(category=self.category, name='Duplicate', slug='product', price=1)
+        self.assertEqual(callbacks, [])
+        self.assertEqual(get_catalog_version(), version)
+
+
+class ProductPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('customer')
+        category = Category.objects.create(name='Category', slug='category')
+        Product.objects.bulk_create(
+            Product(category=category, name=f'Product {p}', slug=f'product-{p}', price=p) for p in range(30)
+        )
+        # Ties on data_added are broken by the id
+        Product.objects.filter(price__lt=10).update(data_added=timezone.now() - timedelta(days=1))
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def page(self, url='/api/v1/products/', **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_pages_follow_the_product_ordering(self):
+        page = self.page(page_size=7)
+        names = [row['name'] for row in page['results']]
+        while page['next']:
+            page = self.page(page['next'])
+            names += [row['name'] for row in page['results']]
+
+        self.assertEqual(names, list(Product.objects.order_by('-data_added', '-id').values_list('name', flat=True)))
+
+    def test_new_products_do_not_shift_later_pages(self):
+        first = self.page(page_size=10)
+        Product.objects.create(category=Category.objects.get(), name='Newer', slug='newer', price=1)
+        second = self.page(first['next'])
+
+        self.assertEqual(second['results'][0]['name'], 'Product 19')
+        self.assertNotIn('Newer', [row['name'] for row in first['results'] + second['results']])
+
+    def test_deep_pages_cost_the_same(self):
+        page = self.page(page_size=5)
+        for _ in range(5):
+            with self.assertNumQueries(1):
+                page = self.client.get(page['next']).data
+        self.assertIsNone(page['next'])
+
+    def test_invalid_cursor(self):
+        for cursor in ('garbage', 'bm90LWEtZGF0ZXwx'):
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.client.get('/api/v1/products/', {'cursor': cursor}).status_code, 404)
+
+    @skipUnless(connection.vendor == 'sqlite', 'Query plans are checked against SQLite')
+    def test_seek_uses_the_index(self):
+        last = Product.objects.order_by('-data_added', '-id')[10]
+        queryset = (
+            Product.objects.order_by('-data_added', '-id')
+            .filter(data_added__lte=last.data_added)
+            .exclude(data_added=last.data_added, id__gte=last.id)[:25]
+        )
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            plan = [row[-1] for row in cursor.fetchall()]
+
+        self.assertIn('product_added_id_idx', plan[0])
+        self.assertFalse(any('TEMP B-TREE' in step for step in plan), plan)
+
+
+class ProductRowSerializerTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for c in range(3):
+            category = Category.objects.create(name=f'Category {c}', slug=f'category-{c}')
+            Product.objects.bulk_create([
+                Product(category=category, name='Plain', slug='plain', price='9.90'),
+                Product(
+                    category=category,
+                    name='Pictured',
+                    slug='pictured',
+                    description='With an image',
+                    price=100,
+                    image='uploads/pictured.jpg',
+                    thumbnail='derivatives/uploads/pictured_card.jpg',
+                    thumbnails={'source': 'uploads/pictured.jpg', 'card': 'derivatives/uploads/pictured_card.jpg'},
+                ),
+            ])
+
+    def test_output_matches_the_model_serializer(self):
+        products = Product.objects.order_by('pk')
+
+        self.assertEqual(
+            ProductRowSerializer(ProductRowSerializer.rows(products), many=True).data,
+            ProductSerializer(products, many=True).data,
+        )
+
+    def test_categories_are_joined(self):
+        with self.assertNumQueries(1):
+            data = ProductRowSerializer(ProductRowSerializer.rows(Product.objects.all()), many=True).data
+
+        self.assertEqual(len(data), 6)
+        self.assertIn('/category-2/pictured/', [row['get_absolute_url'] for row in data])
+
+    def test_benchmark_leaves_no_rows_behind(self):
+        stdout = StringIO()
+        call_command('bench_serializers', products=50, categories=2, repeat=1, stdout=stdout)
+
+        self.assertRegex(stdout.getvalue(), r'ProductRowSerializer +[\d,]+ rows/sec')
+        self.assertEqual(Product.objects.count(), 6)
+
+
+class RecommendationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('customer')
+        category = Category.objects.create(name='Category', slug='category')
+        cls.phone, cls.case, cls.charger, cls.cable = Product.objects.bulk_create(
+            Product(category=category, name=name, slug=name.lower(), price=1) for name in ['Phone', 'Case', 'Charger', 'Cable']
+        )
+        baskets = [
+            [cls.phone, cls.case, cls.charger],
+            [cls.phone, cls.case],
+            [cls.phone, cls.case, cls.case],
+            [cls.phone, cls.cable],
+            [cls.charger, cls.cable],
+        ]
+        for basket in baskets:
+            order = Order.objects.create(user=cls.user, stripe_token='tok')
+            OrderItem.objects.bulk_create(OrderItem(order=order, product=product, price=1) for product in basket)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def related(self, product):
+        response = self.client.get(f'/api/v1/products/{product.pk}/related/')
+        self.assertEqual(response.status_code, 200)
+        return [row['name'] for row in response.data]
+
+    def test_build_keeps_top_neighbours(self):
+        recommendations.build(top_k=2)
+
+        # Ties go to the lower product id
+        self.assertEqual(self.related(self.phone), ['Case', 'Charger'])
+        self.assertEqual(
+            list(RelatedProduct.objects.filter(product=self.phone).order_by('-orders').values_list('related__name', 'orders')),
+            [('Case', 3), ('Charger', 1)],
+        )
+        self.assertEqual(RelatedProduct.objects.filter(product=self.cable).count(), 2)
+
+    def test_new_orders_update_recommendations(self):
+        recommendations.build(top_k=2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            for _ in range(4):
+                recommendations.record_order([self.cable.pk, self.phone.pk, self.cable.pk])
+
+        # Cable was not stored for the phone and counts from 0, the next build trims the list back to 2
+        self.assertEqual(self.related(self.phone), ['Cable', 'Case', 'Charger'])
+
+    def test_pairs_are_added_after_the_order_commits(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            with self.assertNumQueries(0):
+                recommendations.record_order([self.cable.pk, self.case.pk])
+        self.assertFalse(RelatedProduct.objects.exists())
+
+        with mock.patch('product.recommendations.increment', side_effect=DatabaseError), \
+                self.assertLogs('vmarket.recommendations', 'ERROR'):
+            callbacks[0]()
+        callbacks[0]()
+        self.assertEqual(RelatedProduct.objects.filter(product=self.cable, related=self.case).get().orders, 1)
+
+    def test_related_is_a_single_query(self):
+        recommendations.build()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.related(self.charger), ['Phone', 'Case', 'Cable'])
+
+
+class ProductFilterTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('customer')
+        phones = Category.objects.create(name='Phones', slug='phones')
+        cases = Category.objects.create(name='Cases', slug='cases')
+        # Saved one by one so they get into the search index
+        for product in [
+            Product(category=phones, name='Basic phone', slug='basic', price=90, units_sold=5),
+            Product(category=phones, name='Smart phone', slug='smart', price=600, units_sold=2),
+            Product(category=phones, name='Folding phone', slug='folding', price=1500),
+            Product(category=cases, name='Leather case', slug='leather', price=30, units_sold=9),
+            Product(category=cases, name='Phone case', slug='plastic', price=10, units_sold=2),
+        ]:
+            product.save()
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def products(self, **params):
+        response = self.client.get('/api/v1/products/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def names(self, **params):
+        return [row['name'] for row in self.products(**params)['results']]
+
+    def test_filters_and_sorts(self):
+        self.assertEqual(self.names(category='phones', sort='price'), ['Basic phone', 'Smart phone', 'Folding phone'])
+        self.assertEqual(self.names(min_price='20', max_price='600', sort='-price'), ['Smart phone', 'Basic phone', 'Leather case'])
+        self.assertEqual(self.names(sort='popular'), ['Leather case', 'Basic phone', 'Phone case', 'Smart phone', 'Folding phone'])
+        self.assertEqual(self.names(q='case', category='cases,phones', sort='price'), ['Phone case', 'Leather case'])
+
+        response = self.client.get('/api/v1/products/', {'sort': 'cheapest'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_category_ids_must_fit_the_id_column(self):
+        phones = Category.objects.get(slug='phones')
+        self.assertEqual(len(self.names(category=f'{phones.pk}')), 3)
+        # Not ASCII digits, so a slug that matches nothing
+        self.assertEqual(self.names(category='²'), [])
+
+        response = self.client.get('/api/v1/products/', {'category': str(2 ** 63)})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {'category': [f'{2 ** 63} is not a valid category id.']})
+
+    def test_cursor_follows_the_sort(self):
+        page = self.products(sort='popular', page_size=2)
+        names = [row['name'] for row in page['results']]
+        while page['next']:
+            page = self.client.get(page['next']).data
+            self.assertNotIn('facets', page)
+            names += [row['name'] for row in page['results']]
+        self.assertEqual(names, self.names(sort='popular'))
+
+    def test_facets_leave_out_their_own_filter(self):
+        with self.assertNumQueries(2):
+            facets = self.products(category='phones', max_price='100')['facets']
+
+        self.assertEqual([(row['slug'], row['count']) for row in facets['categories']], [('cases', 2), ('phones', 1)])
+        self.assertEqual(
+            [(row['min'], row['max'], row['count']) for row in facets['prices']],
+            [('0', '25', 0), ('25', '50', 0), ('50', '100', 1), ('100', '250', 0), ('250', '500', 0), ('500', '1000', 1), ('1000', None, 1)],
+        )
+
+
+class SearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('customer')
+        category = Category.objects.create(name='Cables', slug='cables')
+        for name, slug, description in [
+            ('Charger', 'charger', 'Charges a phone or a tablet'),
+            ('Phone cable', 'phone-cable', 'A cable for your phone, and your phone only'),
+            ('<b>Tablet</b> & phone stand', 'stand', 'Holds <script>alert(1)</script> anything'),
+        ]:
+            Product.objects.create(category=category, name=name, slug=slug, description=description, price=10)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def matches(self, query):
+        response = self.client.get('/api/v1/products/search/', {'query': query})
+        self.assertEqual(response.status_code, 200)
+        return response.data['results']
+
+    def names(self, query):
+        return [row['name'] for row in self.matches(query)]
+
+    @skipUnless(search.is_available(), 'The FTS5 index is SQLite only')
+    def test_name_matches_rank_first(self):
+        self.assertEqual(self.names('phone'), ['Phone cable', '<b>Tablet</b> & phone stand', 'Charger'])
+        self.assertEqual(self.names('tab'), ['<b>Tablet</b> & phone stand', 'Charger'])
+
+    @skipUnless(search.is_available(), 'The FTS5 index is SQLite only')
+    def test_highlights_are_escaped(self):
+        stand, charger = self.matches('tablet')
+
+        self.assertEqual(stand['name_highlight'], '&lt;b&gt;<mark>Tablet</mark>&lt;/b&gt; &amp; phone stand')
+        self.assertEqual(stand['description_snippet'], 'Holds &lt;script&gt;alert(1)&lt;/script&gt; anything')
+        self.assertEqual(charger['description_snippet'], 'Charges a phone or a <mark>tablet</mark>')
+
+    @skipUnless(search.is_available(), 'The FTS5 index is SQLite only')
+    def test_benchmark_leaves_the_catalog_alone(self):
+        Category.objects.create(name='Benchmark', slug='benchmark')
+
+        call_command('bench_search', products=50, queries=5, stdout=StringIO())
+        self.assertEqual(sorted(Category.objects.values_list('slug', flat=True)), ['benchmark', 'cables'])
+        self.assertEqual(Product.objects.count(), 3)
+
+    def test_like_fallback_without_the_index(self):
+        with mock.patch('product.search.is_available', return_value=False):
+            self.assertEqual(sorted(self.names('PHONE')), ['<b>Tablet</b> & phone stand', 'Charger', 'Phone cable'])
+            self.assertEqual(self.matches(''), [])
+            response = self.client.get('/api/v1/products/', {'q': 'cable'})
+            self.assertEqual([row['name'] for row in response.data['results']], ['Phone cable'])
+
+
+class FeedTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('customer')
+        category = Category.objects.create(name='Lamps & lights', slug='lamps')
+        Product.objects.bulk_create([
+            Product(category=category, name='Desk lamp', slug='desk', price=20, image='uploads/desk.jpg'),
+            Product(category=category, name='Lampe "Übel", 2m', slug='floor', price='99.50', description='Tall\nand bright'),
+        ])
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def download(self, feed_format):
+        response = self.client.get(f'/api/v1/products/feed.{feed_format}.gz')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        with self.assertNumQueries(1):
+            return gzip.decompress(b''.join(response.streaming_content)).decode()
+
+    def test_jsonl(self):
+        rows = [json.loads(line) for line in self.download('jsonl').splitlines()]
+
+        self.assertEqual([row['slug'] for row in rows], ['desk', 'floor'])
+        self.assertEqual(rows[0]['image'], 'http://testserver/media/uploads/desk.jpg')
+        self.assertEqual(rows[0]['url'], f'{settings.FRONTEND_URL}/lamps/desk/')
+        self.assertEqual((rows[1]['name'], rows[1]['price'], rows[1]['image']), ('Lampe "Übel", 2m', '99.50', ''))
+
+    def test_csv(self):
+        rows = list(csv.DictReader(StringIO(self.download('csv'))))
+
+        self.assertEqual(list(rows[0]), feed.FIELDS)
+        self.assertEqual((rows[1]['name'], rows[1]['description']), ('Lampe "Übel", 2m', 'Tall\nand bright'))
+        self.assertEqual(rows[1]['category_name'], 'Lamps & lights')
+
+    def test_unknown_format(self):
+        self.assertEqual(self.client.get('/api/v1/products/feed.xml.gz').status_code, 404)
+
+    def test_first_chunk_can_be_read_on_its_own(self):
+        chunks = feed.gzip_stream(f'line {i}\n' for i in range(10000))
+
+        first = zlib.decompressobj(zlib.MAX_WBITS | 16).decompress(next(chunks))
+        self.assertEqual(first, b'line 0\n')
+
+    def test_command_matches_the_endpoint(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        output = os.path.join(directory, 'feed.jsonl.gz')
+
+        call_command('export_catalog_feed', output=output, base_url='http://testserver/')
+        with gzip.open(output, 'rt', encoding='utf-8') as f:
+            self.assertEqual(f.read(), self.download('jsonl'))
+
+
+class ImporterTests(TestCase):
+    def assertRejected(self, record, message):
+        with self.assertRaisesMessage(importer.RecordError, message):
+            importer.clean(record)
+
+    def test_clean(self):
+        row = importer.clean({'category': 'Phone Cases', 'name': ' Leather case ', 'price': 12.5})
+
+        self.assertEqual(row['category'], 'phone-cases')
+        self.assertEqual(row['category_name'], 'Phone Cases')
+        self.assertEqual((row['name'], row['slug'], str(row['price'])), ('Leather case', 'leather-case', '12.50'))
+
+    def test_records_must_be_objects_of_strings(self):
+        self.assertRejected(['cases', 'Case', 10], 'expected an object, got list')
+        self.assertRejected('Case', 'expected an object, got str')
+        self.assertRejected({'category': 'cases', 'name': 42, 'price': 10}, 'name must be a string')
+        self.assertRejected({'category': ['cases'], 'name': 'Case', 'price': 10}, 'category must be a string')
+        self.assertRejected({'category': 'cases', 'name': 'Case', 'price': 'free'}, "invalid price 'free'")
+
+    def test_prices_must_fit_the_column(self):
+        self.assertRejected({'category': 'cases', 'name': 'Case', 'price': 'NaN'}, "invalid price 'NaN'")
+        self.assertRejected({'category': 'cases', 'name': 'Case', 'price': 'Infinity'}, "invalid price 'Infinity'")
+        self.assertRejected({'category': 'cases', 'name': 'Case', 'price': -1}, 'price -1 is negative')
+        self.assertRejected({'category': 'cases', 'name': 'Case', 'price': 1e20}, 'price 1e+20 is not below 10000000')
+
+        row = importer.clean({'category': 'cases', 'name': 'Case', 'price': '9999999.99'})
+        self.assertEqual(str(row['price']), '9999999.99')
+
+    def test_existing_categories_keep_their_names(self):
+        Category.objects.create(name='TV & Audio', slug='tv-audio')
+        row = importer.clean({'category': 'tv-audio', 'name': 'Speaker', 'price': 10})
+
+        importer.save_batch([row], importer.CategoryResolver())
+        self.assertEqual(Category.objects.get(slug='tv-audio').name, 'TV & Audio')
+        self.assertEqual(Product.objects.get().category.slug, 'tv-audio')
+
+    def test_names_without_ascii_need_a_slug(self):
+        self.assertRejected({'category': 'cases', 'name': 'Чехол', 'price': 10}, 'no slug can be made')
+        self.assertRejected({'category': 'Чехлы', 'name': 'Case', 'price': 10}, 'has no ASCII characters')
+
+        row = importer.clean({'category': 'cases', 'name': 'Чехол', 'slug': 'leather-case', 'price': 10})
+        self.assertEqual((row['name'], row['slug']), ('Чехол', 'leather-case'))
+
+    def test_import_skips_invalid_records(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        feed = os.path.join(directory, 'feed.jsonl')
+        with open(feed, 'w', encoding='utf-8') as f:
+            for record in [
+                {'category': 'cases', 'name': 'Leather case', 'price': '10'},
+                ['not', 'an', 'object'],
+                {'category': 'cases', 'name': 'Чехол', 'price': '5'},
+                {'category': 'cases', 'name': 'Leather case', 'price': '12'},
+            ]:
+                f.write(json.dumps(record) + '\n')
+            f.write('{broken\n')
+
+        stdout, stderr = StringIO(), StringIO()
+        call_command('import_catalog', feed, '--no-images', stdout=stdout, stderr=stderr)
+
+        self.assertEqual(list(Product.objects.values_list('category__slug', 'slug', 'price')), [('cases', 'leather-case', 12)])
+        self.assertEqual(stderr.getvalue().count('Line '), 3)
+        self.assertIn('skipped 3 invalid records', stdout.getvalue())
+        self.assertFalse(os.path.exists(f'{feed}.checkpoint'))
+
+
+def image_bytes(fmt='PNG', size=(200, 120)):
+    """Noise, which compresses far better as a lossy WebP than as a PNG"""
+    rng = random.Random(1)
+    img = Image.new('RGB', size)
+    img.putdata([(rng.randrange(256), rng.randrange(256), rng.randrange(256)) for _ in range(size[0] * size[1])])
+    output = BytesIO()
+    img.save(output, fmt)
+    return output.getvalue()
+
+
+def use_temp_media(test):
+    """Point MEDIA_ROOT at a directory removed after ``test``, derivatives render inline"""
+    media_root = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, media_root)
+    media_settings = override_settings(MEDIA_ROOT=media_root, MEDIA_IMAGE_VARIANTS=['webp'], PRODUCT_THUMBNAIL_WORKERS=0)
+    media_settings.enable()
+    test.addCleanup(media_settings.disable)
+
+
+class DerivativeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Category', slug='category')
+
+    def setUp(self):
+        use_temp_media(self)
+
+    def upload(self, name='photo.jpg', size=(1600, 1000)):
+        output = BytesIO()
+        Image.new('RGB', size, 'teal').save(output, 'JPEG')
+        return default_storage.save(f'uploads/{name}', ContentFile(output.getvalue()))
+
+    def test_sizes_are_built_once_the_upload_commits(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            product = Product.objects.create(category=self.category, name='Lamp', slug='lamp', price=10, image=self.upload())
+            self.assertEqual(Product.objects.get(pk=product.pk).thumbnails, {})
+        for callback in callbacks:
+            callback()
+
+        product.refresh_from_db()
+        self.assertEqual(product.thumbnails['source'], product.image.name)
+        self.assertEqual(product.thumbnail.name, product.thumbnails['card'])
+        self.assertFalse(product.needs_thumbnails())
+        for size_name, size in derivatives.get_sizes().items():
+            with default_storage.open(product.thumbnails[size_name]) as f:
+                self.assertEqual(Image.open(f).size, (size[0], round(size[0] / 1.6)))
+        self.assertEqual(set(product.get_thumbnails()), set(derivatives.get_sizes()))
+
+    def test_rolled_back_upload_builds_nothing(self):
+        with self.captureOnCommitCallbacks() as callbacks, transaction.atomic():
+            Product.objects.create(category=self.category, name='Lamp', slug='lamp', price=10, image=self.upload())
+            transaction.set_rollback(True)
+        self.assertEqual(callbacks, [])
+
+    def test_derivatives_of_a_replaced_image_are_dropped(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            product = Product.objects.create(category=self.category, name='Lamp', slug='lamp', price=10, image=self.upload())
+        stale = derivatives.render_derivatives(self.upload('old.jpg'))
+
+        self.assertEqual(derivatives.store_derivatives(product.pk, stale), 0)
+        product.refresh_from_db()
+        self.assertNotEqual(product.thumbnails['source'], stale['source'])
+
+        product.image = None
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        product.refresh_from_db()
+        self.assertEqual((product.thumbnail.name, product.thumbnails), ('', {}))
+
+    def test_serializers_only_read_derivatives(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.create(category=self.category, name='Lamp', slug='lamp', price=10, image=self.upload())
+        Product.objects.create(category=self.category, name='Chair', slug='chair', price=10)
+        user = User.objects.create_user('customer')
+        self.client.force_login(user)
+
+        with mock.patch('product.derivatives.render_derivatives') as render:
+            response = self.client.get('/api/v1/products/')
+        render.assert_not_called()
+        rows = {row['name']: row for row in response.json()['results']}
+        self.assertEqual(set(rows['Lamp']['get_thumbnails']), set(derivatives.get_sizes()))
+        self.assertEqual((rows['Chair']['get_thumbnail'], rows['Chair']['get_thumbnails']), ('', {}))
+
+
+class MediaTests(TestCase):
+    def setUp(self):
+        use_temp_media(self)
+
+        self.content = image_bytes()
+        self.name = default_storage.save('uploads/noise.png', ContentFile(self.content))
+        self.url = f'/media/{self.name}'
+
+    def test_parse_range(self):
+        self.assertEqual(media.parse_range('bytes=0-9', 100), (0, 9))
+        self.assertEqual(media.parse_range('bytes=90-', 100), (90, 99))
+        self.assertEqual(media.parse_range('bytes=-10', 100), (90, 99))
+        self.assertEqual(media.parse_range('bytes=95-200', 100), (95, 99))
+        self.assertEqual(media.parse_range('bytes=-200', 100), (0, 99))
+        self.assertIs(media.parse_range('bytes=100-', 100), False)
+        self.assertIs(media.parse_range('bytes=5-4', 100), False)
+        self.assertIs(media.parse_range('bytes=-0', 100), False)
+        # Multiple ranges and other units fall back to the whole file
+        self.assertIsNone(media.parse_range('bytes=0-1,5-6', 100))
+        self.assertIsNone(media.parse_range('items=0-1', 100))
+        self.assertIsNone(media.parse_range('bytes=-', 100))
+
+    def test_range_requests(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 0-9/{len(self.content)}')
+        self.assertEqual(b''.join(response.streaming_content), self.content[:10])
+
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={len(self.content)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.content)}')
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-1,5-6')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+        # A range of an older version of the file gets the whole new one
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_conditional_requests(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], media.IMMUTABLE)
+
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_variants_are_built_off_the_request_path(self):
+        response = self.client.get(self.url, HTTP_ACCEPT='image/webp,*/*')
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertIn('Accept', response['Vary'])
+        self.assertFalse(media.variant_path(self.name, 'webp').exists())
+
+        thumbnails = derivatives.render_derivatives(self.name)
+        for name in [self.name, thumbnails['card']]:
+            self.assertTrue(media.variant_path(name, 'webp').exists())
+
+        response = self.client.get(self.url, HTTP_ACCEPT='image/webp,*/*')
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        response = self.client.get(self.url, HTTP_ACCEPT='image/webp;q=0,*/*')
+        self.assertEqual(response['Content-Type'], 'image/png')
+
+
+class HashedStorageTests(TestCase):
+    def setUp(self):
+        use_temp_media(self)
+
+    def test_names_follow_the_content(self):
+        first = default_storage.save('uploads/photo.jpg', ContentFile(b'first'))
+        again = default_storage.save('uploads/photo.jpg', ContentFile(b'first'))
+        second = default_storage.save('uploads/photo.jpg', ContentFile(b'second'))
+
+        self.assertRegex(first, r'^uploads/photo\.[0-9a-f]{12}\.jpg$')
+        self.assertEqual(again, first)
+        self.assertNotEqual(second, first)
+        self.assertEqual(sorted(os.listdir(os.path.join(settings.MEDIA_ROOT, 'uploads'))), sorted([first[8:], second[8:]]))
+        # Saving under a hashed name rehashes instead of stacking digests
+        self.assertEqual(default_storage.save(first, ContentFile(b'second')), second)
+
+    def test_long_names_are_shortened_to_fit(self):
+        name = storage.hashed_name(f'uploads/{"x" * 120}.jpg', 'a' * storage.HASH_LENGTH, max_length=100)
+
+        self.assertEqual(len(name), 100)
+        self.assertTrue(name.startswith('uploads/xxx'))
+        self.assertTrue(storage.is_hashed(name))
+        self.assertFalse(storage.is_hashed('uploads/photo.jpg'))
+
+    def test_hash_media_files_renames_legacy_uploads(self):
+        os.makedirs(os.path.join(settings.MEDIA_ROOT, 'uploads'))
+        for legacy in ('uploads/lamp.jpg', 'uploads/lamp_card.jpg'):
+            with open(os.path.join(settings.MEDIA_ROOT, legacy), 'wb') as f:
+                f.write(legacy.encode())
+        category = Category.objects.create(name='Lamps', slug='lamps')
+        Product.objects.bulk_create([
+            Product(
+                category=category, name='Lamp', slug='lamp', price=10,
+                image='uploads/lamp.jpg', thumbnail='uploads/lamp_card.jpg',
+                thumbnails={'source': 'uploads/lamp.jpg', 'card': 'uploads/lamp_card.jpg'},
+            ),
+            Product(category=category, name='Twin', slug='twin', price=10, image='uploads/lamp.jpg'),
+        ])
+        version = get_catalog_version()
+
+        stdout = StringIO()
+        call_command('hash_media_files', '--delete-old', stdout=stdout)
+
+        lamp, twin = Product.objects.order_by('pk')
+        self.assertTrue(storage.is_hashed(lamp.image.name))
+        self.assertEqual(twin.image.name, lamp.image.name)
+        self.assertEqual(lamp.thumbnails, {'source': lamp.image.name, 'card': lamp.thumbnail.name})
+        self.assertFalse(default_storage.exists('uploads/lamp.jpg'))
+        with default_storage.open(lamp.image.name) as f:
+            self.assertEqual(f.read(), b'uploads/lamp.jpg')
+        self.assertIn('Moved 2 files', stdout.getvalue())
+        self.assertNotEqual(get_catalog_version(), version)
@@ -6,8 +6,12 @@ urlpatterns = [
     path('latest-products/', views.LatestProductsList.as_view()),
     path('products/', views.ProductList.as_view()),  # New endpoint for all products
     path('products/<int:pk>/', views.ProductDetailById.as_view()),  # New endpoint for product by ID
+    path('products/<int:pk>/related/', views.RelatedProductsList.as_view()),
     path('categories/', views.CategoryList.as_view()),
+    path('categories/<int:pk>/products/', views.CategoryProductsList.as_view()),
+    path('categories/<slug:category_slug>/products/', views.CategorySlugProductsList.as_view()),
     path('products/search/', views.search),
+    path('products/feed.<str:feed_format>.gz', views.ProductFeed.as_view()),
     path('products/<slug:category_slug>/<slug:product_slug>/', views.ProductDetail.as_view()),
     path('products/<slug:category_slug>/', views.CategoryDetail.as_view()),
 ]
@@ -1,68 +1,170 @@
-from django.db.models import Q
-from django.http import Http404
+from django.conf import settings
+from django.db.models import Count, Q
+from django.http import Http404, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
 
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.decorators import api_view
 from rest_framework import generics
 
+from product import feed, search as product_search
+from product.filters import ProductFilters
+from product.cache import cache_catalog_response
 from product.models import Product, Category
-from product.serializers import ProductSerializer, CategorySerializer
+from product.pagination import CatalogPagination, ProductCursorPagination
+from product.serializers import (
+    ProductSerializer,
+    ProductRowSerializer,
+    ProductSearchSerializer,
+    CategorySerializer,
+    CategoryIndexSerializer,
+)
+from vmarketdjango.routers import ReplicaReadMixin, replica_reads, request_scopes
 
-class LatestProductsList(APIView):
+class CatalogReadMixin(ReplicaReadMixin):
+    # Catalog changes pin catalog reads to the primary, see bump_catalog_version
+    replica_scopes = ('catalog',)
+
+class LatestProductsList(CatalogReadMixin, APIView):
+    @cache_catalog_response
     def get(self, request, format=None):
-        product = Product.objects.all()[0:4]
-        seralizer = ProductSerializer(product, many=True)
-        return Response(seralizer.data)
+        products = ProductRowSerializer.rows(Product.objects.all())[0:4]
+        serializer = ProductRowSerializer(products, many=True)
+        return Response(serializer.data)
 
-class CategoryList(APIView):
+class CategoryList(CatalogReadMixin, APIView):
+    @cache_catalog_response
     def get(self, request, format=None):
-        categories = Category.objects.all()
-        serializer = CategorySerializer(categories, many=True)
+        categories = Category.objects.annotate(product_count=Count('products'))
+        serializer = CategoryIndexSerializer(categories, many=True)
         return Response(serializer.data)
 
+class CategoryProductsList(CatalogReadMixin, generics.ListAPIView):
+    serializer_class = ProductRowSerializer
+    pagination_class = CatalogPagination
+
+    def get_queryset(self):
+        category = get_object_or_404(Category, pk=self.kwargs['pk'])
+        return ProductRowSerializer.rows(category.products.all())
+
+class CategorySlugProductsList(CatalogReadMixin, generics.ListAPIView):
+    """Products of a category, newest first, in keyset pages for infinite scroll"""
+    serializer_class = ProductRowSerializer
+    pagination_class = ProductCursorPagination
+
+    def get_queryset(self):
+        category = get_object_or_404(Category, slug=self.kwargs['category_slug'])
+        return ProductRowSerializer.rows(category.products.all())
+
 
-class ProductDetail(APIView):
+class ProductDetail(CatalogReadMixin, APIView):
     def get_object(self, category_slug, product_slug):
         try:
-            return Product.objects.filter(category__slug=category_slug).get(slug=product_slug)
+            return Product.objects.select_related('category').get(category__slug=category_slug, slug=product_slug)
         except Product.DoesNotExist:
             raise Http404
 
+    @cache_catalog_response
     def get(self, request, category_slug, product_slug, format=None):
         product = self.get_object(category_slug, product_slug)
         serializer = ProductSerializer(product)
         return Response(serializer.data)
 
-class CategoryDetail(APIView):
+class CategoryDetail(CatalogReadMixin, APIView):
     def get_object(self, category_slug):
         try:
             return Category.objects.get(slug=category_slug)
-        except Product.DoesNotExist:
+        except Category.DoesNotExist:
             raise Http404
     
+    @cache_catalog_response
     def get(self, request, category_slug, format=None):
         category = self.get_object(category_slug)
         serializer = CategorySerializer(category)
         return Response(serializer.data)
 
-class ProductList(generics.ListAPIView):
-    queryset = Product.objects.all()
-    serializer_class = ProductSerializer
+class ProductList(CatalogReadMixin, generics.ListAPIView):
+    """Products filtered by ``?category=``, ``?min_price=``, ``?max_price=`` and
+    ``?q=``, sorted by ``?sort=newest|price|-price|popular``, see product.filters.
+
+    The first page also has the category and price bucket ``facets`` of the
+    matching products, pages after it (with a ``cursor``) leave them out.
+    """
+    serializer_class = ProductRowSerializer
+    pagination_class = ProductCursorPagination
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self.filters = ProductFilters(request.query_params)
+        self.ordering = self.filters.ordering
+
+    def get_queryset(self):
+        return ProductRowSerializer.rows(self.filters.filter(Product.objects.all()))
 
-class ProductDetailById(generics.RetrieveAPIView):
+    def list(self, request, *args, **kwargs):
+        response = super().list(request, *args, **kwargs)
+        if not request.query_params.get(self.paginator.cursor_query_param):
+            response.data['facets'] = self.filters.facets(Product.objects.all())
+        return response
+
+class ProductDetailById(CatalogReadMixin, generics.RetrieveAPIView):
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
 
-@api_view(['POST'])
-def search(request):
-    query = request.data.get('query', '')
+    @cache_catalog_response
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
+class RelatedProductsList(CatalogReadMixin, APIView):
+    """Products most often bought together with this one, see product.recommendations.
+
+    One query on the related_product_rank_idx index. ``?limit=`` defaults
+    to 8 and can go up to RECOMMENDATIONS_TOP_K.
+    """
+    def get(self, request, pk, format=None):
+        try:
+            limit = min(max(int(request.query_params.get('limit', 8)), 1), settings.RECOMMENDATIONS_TOP_K)
+        except ValueError:
+            limit = 8
+
+        products = ProductRowSerializer.rows(
+            Product.objects.filter(recommended_for__product_id=pk).order_by('-recommended_for__orders', 'recommended_for__related_id')
+        )[:limit]
+        serializer = ProductRowSerializer(products, many=True)
+        return Response(serializer.data)
+
+class ProductFeed(APIView):
+    """The whole catalog as a gzipped JSON lines or CSV download, for partners
+    and marketplaces. Streamed, so it starts at once and never builds the
+    full list in memory."""
+
+    def get(self, request, feed_format, format=None):
+        if feed_format not in feed.FORMATS:
+            raise Http404
+
+        response = StreamingHttpResponse(
+            feed.stream(feed_format, request.build_absolute_uri('/')),
+            content_type='application/gzip',
+        )
+        response['Content-Disposition'] = f'attachment; filename="products.{feed_format}.gz"'
+        return response
 
-    if query:
-        products = Product.objects.filter(Q(name__icontains=query) | Q(description__icontains=query))
+@api_view(['GET', 'POST'])
+def search(request):
+    query = request.data.get('query') or request.query_params.get('query', '')
+    paginator = CatalogPagination()
 
-        seializer = ProductSerializer(products, many=True)
-        return Response(seializer.data)
+    with replica_reads(request_scopes(request, CatalogReadMixin.replica_scopes)):
+        if product_search.is_available():
+            results = product_search.SearchResults(query)
+            serializer_class = ProductSearchSerializer
+        else:
+            results = Product.objects.select_related('category').filter(
+                Q(name__icontains=query) | Q(description__icontains=query)
+            ) if query else Product.objects.none()
+            serializer_class = ProductSerializer
 
-    else:
-        return Response({"products": []})
\ No newline at end of file
+        page = paginator.paginate_queryset(results, request)
+        serializer = serializer_class(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
@@ -0,0 +1,193 @@
+"""Media delivery for deployments where Django serves MEDIA_URL itself.
+
+Content-hashed files (see vmarketdjango.storage) are cached for a year as
+immutable, other files are revalidated with their ETag. Conditional and
+single range requests are supported. JPEG and PNG images are also offered
+as WebP and AVIF to clients that list those types in ``Accept``. Those
+variants are encoded off the request path by ``build_variants``, which the
+product.derivatives pipeline runs for every image it renders; requests
+only choose among the files that exist.
+"""
+import mimetypes
+import os
+import re
+import threading
+from pathlib import Path
+
+from PIL import Image, features
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from vmarketdjango.storage import is_hashed
+
+VARIANT_TYPES = {
+    'avif': 'image/avif',
+    'webp': 'image/webp',
+}
+VARIANT_SOURCES = ('image/jpeg', 'image/png')
+VARIANT_QUALITY = {
+    'avif': 60,
+    'webp': 80,
+}
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'public, no-cache'
+CHUNK_SIZE = 64 * 1024
+
+
+def variant_formats():
+    """Configured formats this Pillow build can encode, in order of preference"""
+    return [fmt for fmt in settings.MEDIA_IMAGE_VARIANTS if features.check(fmt)]
+
+
+def variant_path(name, fmt):
+    return Path(settings.MEDIA_ROOT) / 'variants' / f'{name}.{fmt}'
+
+
+def build_variant(source, name, fmt):
+    """Encode ``source`` as ``fmt`` unless that was done already"""
+    target = variant_path(name, fmt)
+    if target.exists():
+        return target
+
+    target.parent.mkdir(parents=True, exist_ok=True)
+    with Image.open(source) as img:
+        img = img.convert('RGBA' if img.mode in ('RGBA', 'LA', 'P') else 'RGB')
+        # Concurrent requests may encode the same variant, the last rename wins
+        tmp = target.with_name(f'{target.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        img.save(tmp, fmt.upper(), quality=VARIANT_QUALITY[fmt])
+    os.replace(tmp, target)
+    return target
+
+
+def build_variants(name):
+    """Encode the media file ``name`` in every variant format, return their paths"""
+    content_type, _ = mimetypes.guess_type(name)
+    if content_type not in VARIANT_SOURCES:
+        return []
+    source = Path(settings.MEDIA_ROOT) / name
+    return [build_variant(source, name, fmt) for fmt in variant_formats()]
+
+
+def accepted_types(request):
+    """Media types listed in ``Accept``, except those refused with q=0"""
+    accepted = set()
+    for part in request.headers.get('Accept', '').split(','):
+        media_type, *params = [piece.strip() for piece in part.split(';')]
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    pass
+        if quality > 0:
+            accepted.add(media_type.lower())
+    return accepted
+
+
+def negotiate(request, source, name, content_type):
+    """Pick the smallest representation the client accepts among those
+    already built, never encoding anything on the request path"""
+    accepted = accepted_types(request)
+    candidates = [(source, content_type)]
+    for fmt in variant_formats():
+        target = variant_path(name, fmt)
+        if VARIANT_TYPES[fmt] in accepted and target.is_file():
+            candidates.append((target, VARIANT_TYPES[fmt]))
+    return min(candidates, key=lambda candidate: candidate[0].stat().st_size)
+
+
+def parse_range(header, size):
+    """Return ``(start, end)`` of a single byte range, None to ignore the header,
+    or ``False`` when the range can't be satisfied"""
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+
+    start, end = match.groups()
+    if start == '':
+        length = int(end)
+        if length == 0:
+            return False
+        return max(0, size - length), size - 1
+
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def read_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def serve_media(request, path):
+    try:
+        source = Path(safe_join(settings.MEDIA_ROOT, path))
+    except SuspiciousFileOperation:
+        raise Http404
+    if not source.is_file():
+        raise Http404
+
+    content_type, encoding = mimetypes.guess_type(source.name)
+    content_type = content_type or 'application/octet-stream'
+    negotiated = content_type in VARIANT_SOURCES and variant_formats()
+
+    filepath = source
+    if negotiated:
+        filepath, content_type = negotiate(request, source, path, content_type)
+
+    stat = filepath.stat()
+    etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(stat.st_mtime),
+        'Cache-Control': IMMUTABLE if is_hashed(path) else REVALIDATE,
+        'Accept-Ranges': 'bytes',
+    }
+    if negotiated:
+        headers['Vary'] = 'Accept'
+
+    response = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    if response is None:
+        response = respond(request, filepath, content_type, stat.st_size, etag)
+
+    for header, value in headers.items():
+        response[header] = value
+    if encoding:
+        response['Content-Encoding'] = encoding
+    return response
+
+
+def respond(request, filepath, content_type, size, etag):
+    byte_range = None
+    if 'Range' in request.headers and request.headers.get('If-Range', etag) == etag:
+        byte_range = parse_range(request.headers['Range'], size)
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    if byte_range is None:
+        return FileResponse(open(filepath, 'rb'), content_type=content_type)
+
+    start, end = byte_range
+    response = StreamingHttpResponse(read_range(filepath, start, end - start + 1), status=206, content_type=content_type)
+    response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Content-Length'] = str(end - start + 1)
+    return response
@@ -0,0 +1,280 @@
+"""Per-route request metrics, Server-Timing headers and a slow request log.
+
+``MetricsMiddleware`` times every request and the SQL it runs, serializers
+using ``TimedSerializerMixin`` add their time, and ``metrics_view`` serves
+the totals in the Prometheus text format. Metrics are kept per process:
+with several workers, scrape each of them or run one worker per metrics
+target.
+"""
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import hmac
+import logging
+import threading
+import time
+
+from asgiref.sync import markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+from rest_framework.serializers import ListSerializer
+
+from order.authentication import stats as token_cache_stats
+
+logger = logging.getLogger('vmarket.slow_requests')
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# The slowest statements of a slow request that get logged
+SLOW_SQL_LOGGED = 5
+
+_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+class RouteStats:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.duration = 0.0
+        self.queries = 0
+        self.db_duration = 0.0
+        self.serializer_duration = 0.0
+        self.slow = 0
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+
+    def observe(self, method, route, status, duration, timings, slow):
+        key = (method, route, f'{status // 100}xx')
+        with self.lock:
+            stats = self.routes.get(key)
+            if stats is None:
+                stats = self.routes[key] = RouteStats()
+            stats.buckets[bisect.bisect_left(BUCKETS, duration)] += 1
+            stats.count += 1
+            stats.duration += duration
+            stats.queries += len(timings.queries)
+            stats.db_duration += timings.db
+            stats.serializer_duration += timings.serialize
+            stats.slow += slow
+
+    def snapshot(self):
+        with self.lock:
+            return {key: vars(stats).copy() for key, stats in self.routes.items()}
+
+
+registry = Registry()
+
+
+class RequestTimings:
+    def __init__(self):
+        self.queries = []
+        self.db = 0.0
+        self.serialize = 0.0
+        self.serializing = False
+
+    def record_query(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.db += duration
+            self.queries.append((duration, sql))
+
+
+@contextlib.contextmanager
+def serializer_timer():
+    timings = _timings.get()
+    # A serializer building its .data inside another one is already timed
+    if timings is None or timings.serializing:
+        yield
+        return
+
+    timings.serializing = True
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.serialize += time.perf_counter() - start
+        timings.serializing = False
+
+
+class TimedListSerializer(ListSerializer):
+    @property
+    def data(self):
+        with serializer_timer():
+            return super().data
+
+
+class TimedSerializerMixin:
+    """Count the time spent building ``serializer.data`` as serializer time.
+
+    ``.data`` runs ``to_representation`` for the whole tree, so the mixin
+    only goes on the serializers views return, nested ones are covered.
+    """
+
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        serializer = super().many_init(*args, **kwargs)
+        if type(serializer) is ListSerializer:
+            serializer.__class__ = TimedListSerializer
+        return serializer
+
+    @property
+    def data(self):
+        with serializer_timer():
+            return super().data
+
+
+def route_of(request):
+    match = getattr(request, 'resolver_match', None)
+    # Unmatched paths share one label, so scanners can't blow up the label set
+    return f'/{match.route}' if match is not None else 'unmatched'
+
+
+def server_timing(duration, timings):
+    return ', '.join([
+        f'db;dur={timings.db * 1000:.1f};desc="{len(timings.queries)} queries"',
+        f'serialize;dur={timings.serialize * 1000:.1f}',
+        f'total;dur={duration * 1000:.1f}',
+    ])
+
+
+class MetricsMiddleware:
+    """Record latency, SQL and serializer time per route and report them in a
+    Server-Timing header. Requests slower than SLOW_REQUEST_THRESHOLD seconds
+    are logged to ``vmarket.slow_requests`` with their slowest statements."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        # Under ASGI the async checkout would otherwise be pushed through
+        # async_to_sync onto a thread for this middleware alone
+        self.async_mode = asyncio.iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        timings = RequestTimings()
+        token = _timings.set(timings)
+        start = time.perf_counter()
+        try:
+            with self.record_queries(timings):
+                response = self.get_response(request)
+        finally:
+            _timings.reset(token)
+        return self.finish(request, response, time.perf_counter() - start, timings)
+
+    async def __acall__(self, request):
+        timings = RequestTimings()
+        token = _timings.set(timings)
+        start = time.perf_counter()
+        # Connections belong to the thread that runs the sync code, so the
+        # wrappers are installed and removed there
+        queries = self.record_queries(timings)
+        await sync_to_async(queries.__enter__)()
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(queries.__exit__)(None, None, None)
+            _timings.reset(token)
+        return self.finish(request, response, time.perf_counter() - start, timings)
+
+    @contextlib.contextmanager
+    def record_queries(self, timings):
+        with contextlib.ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(timings.record_query))
+            yield
+
+    def finish(self, request, response, duration, timings):
+        slow = duration >= settings.SLOW_REQUEST_THRESHOLD
+        registry.observe(request.method, route_of(request), response.status_code, duration, timings, slow)
+        response['Server-Timing'] = server_timing(duration, timings)
+
+        if slow:
+            self.log_slow_request(request, response, duration, timings)
+        return response
+
+    def log_slow_request(self, request, response, duration, timings):
+        slowest = sorted(timings.queries, key=lambda query: query[0], reverse=True)[:SLOW_SQL_LOGGED]
+        logger.warning(
+            'Slow request %s %s: %d in %.0f ms, %d queries in %.0f ms, serializers %.0f ms%s',
+            request.method,
+            request.get_full_path(),
+            response.status_code,
+            duration * 1000,
+            len(timings.queries),
+            timings.db * 1000,
+            timings.serialize * 1000,
+            ''.join(f'\n  {query_duration * 1000:8.1f} ms  {sql}' for query_duration, sql in slowest),
+        )
+
+
+def label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_metrics():
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for suffix, labels, value in samples:
+            labels = ','.join(f'{key}="{label(val)}"' for key, val in labels.items())
+            lines.append(f'{name}{suffix}{{{labels}}} {value}' if labels else f'{name}{suffix} {value}')
+
+    routes = sorted(registry.snapshot().items())
+
+    histogram = []
+    for (method, route, status), stats in routes:
+        labels = {'method': method, 'route': route, 'status': status}
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), stats['buckets']):
+            cumulative += count
+            histogram.append(('_bucket', {**labels, 'le': bound}, cumulative))
+        histogram.append(('_sum', labels, round(stats['duration'], 6)))
+        histogram.append(('_count', labels, stats['count']))
+    metric('vmarket_request_duration_seconds', 'histogram', 'Request latency by route', histogram)
+
+    for name, field, help_text in (
+        ('vmarket_db_queries_total', 'queries', 'SQL queries run by requests'),
+        ('vmarket_db_duration_seconds_total', 'db_duration', 'Time requests spent in SQL'),
+        ('vmarket_serializer_duration_seconds_total', 'serializer_duration', 'Time requests spent in serializers'),
+        ('vmarket_slow_requests_total', 'slow', 'Requests slower than SLOW_REQUEST_THRESHOLD'),
+    ):
+        metric(name, 'counter', help_text, [
+            ('', {'method': method, 'route': route, 'status': status}, round(stats[field], 6))
+            for (method, route, status), stats in routes
+        ])
+
+    tokens = token_cache_stats()
+    metric('vmarket_token_cache_hits_total', 'counter', 'API tokens resolved from the cache', [('', {}, tokens['hits'])])
+    metric('vmarket_token_cache_misses_total', 'counter', 'API tokens looked up in the database', [('', {}, tokens['misses'])])
+
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    """Prometheus scrape target. Needs ``Authorization: Bearer <METRICS_TOKEN>``
+    or a request from one of METRICS_ALLOWED_IPS, both are unset by default."""
+    token = settings.METRICS_TOKEN
+    authorization = request.headers.get('Authorization', '')
+    allowed = (
+        bool(token) and hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode())
+    ) or request.META.get('REMOTE_ADDR') in settings.METRICS_ALLOWED_IPS
+    if not allowed:
+        return HttpResponseForbidden()
+
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,53 @@
+"""Admin pagination without ``COUNT(*)`` over big tables.
+
+An unfiltered changelist takes its row count from the statistics the
+database keeps for the planner instead of counting every row. Filtered
+lists and small tables are still counted exactly.
+"""
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+# Below this many rows estimates are too rough to be worth it, and counting is cheap
+EXACT_COUNT_BELOW = 10000
+
+
+def estimated_count(queryset):
+    """Planner estimate of the rows of an unfiltered queryset, None when unknown"""
+    if queryset.query.where or queryset.query.distinct:
+        return None
+
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)', [table])
+        elif connection.vendor == 'mysql':
+            cursor.execute(
+                'SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s',
+                [table],
+            )
+        elif connection.vendor == 'sqlite':
+            # Filled in by ANALYZE, the first number of a row is the row count of the table
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+            if cursor.fetchone() is None:
+                return None
+            cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1', [table])
+        else:
+            return None
+        row = cursor.fetchone()
+
+    if row is None or row[0] is None:
+        return None
+    estimate = int(str(row[0]).split()[0])
+    # PostgreSQL reports -1 for tables that were never analyzed
+    return estimate if estimate >= 0 else None
+
+
+class EstimatedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        estimate = estimated_count(self.object_list)
+        if estimate is None or estimate < EXACT_COUNT_BELOW:
+            return super().count
+        return estimate
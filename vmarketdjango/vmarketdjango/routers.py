@@ -0,0 +1,172 @@
+"""Read replica routing.
+
+Only reads that opt in go to the ``replica`` alias: the catalog views and
+the order history, through ``ReplicaReadMixin`` or ``replica_reads()``.
+Writes, authentication and every other read stay on ``default``.
+
+Replication lags, so whoever just wrote reads from the primary for
+DATABASE_REPLICA_LAG seconds: a user after any successful unsafe request,
+and every catalog reader after a catalog change. Those pins are kept in
+the cache and have to be seen by every worker, so the replica is only
+used when the cache is shared.
+"""
+import asyncio
+import contextlib
+import contextvars
+import time
+
+from asgiref.sync import markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections
+from rest_framework.permissions import SAFE_METHODS
+
+REPLICA = 'replica'
+# Seconds the replica is skipped after it failed to connect
+RETRY_AFTER = 30
+
+_use_replica = contextvars.ContextVar('use_replica', default=False)
+_replica_down_until = 0
+
+
+def replica_configured():
+    # With a per-process cache a worker would miss the pins set by the others
+    return REPLICA in settings.DATABASES and settings.SHARED_CACHE
+
+
+def replica_is_up():
+    global _replica_down_until
+    if time.monotonic() < _replica_down_until:
+        return False
+    try:
+        connections[REPLICA].ensure_connection()
+    except OperationalError:
+        _replica_down_until = time.monotonic() + RETRY_AFTER
+        return False
+    return True
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if _use_replica.get() and replica_configured() and replica_is_up():
+            return REPLICA
+        return None
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both aliases hold the same data
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        # The replica gets its schema through replication
+        return db == DEFAULT_DB_ALIAS
+
+
+def pin_key(scope):
+    return f'db:pin:{scope}'
+
+
+def user_scope(user):
+    return f'user:{user.pk}'
+
+
+def pin_to_primary(scope):
+    """Read ``scope`` from the primary until the replica has caught up"""
+    if replica_configured():
+        cache.set(pin_key(scope), True, settings.DATABASE_REPLICA_LAG)
+
+
+def request_scopes(request, scopes=()):
+    """The pins a request has to respect: ``scopes`` plus the user's own"""
+    scopes = list(scopes)
+    if request.user.is_authenticated:
+        scopes.append(user_scope(request.user))
+    return scopes
+
+
+def is_pinned(scopes):
+    return bool(cache.get_many([pin_key(scope) for scope in scopes]))
+
+
+@contextlib.contextmanager
+def replica_reads(scopes=()):
+    """Route the reads inside the block to the replica, unless one of ``scopes`` is pinned"""
+    if not replica_configured() or is_pinned(scopes):
+        yield
+        return
+
+    token = _use_replica.set(True)
+    try:
+        yield
+    finally:
+        _use_replica.reset(token)
+
+
+class ReplicaReadMixin:
+    """Serve the safe requests of an APIView from the replica.
+
+    Authentication and permissions still run against the primary, so a token
+    created a moment ago is always found. ``replica_scopes`` names extra pins
+    to respect besides the user's own.
+    """
+    replica_scopes = ()
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method in SAFE_METHODS:
+            self.replica_context = replica_reads(request_scopes(request, self.replica_scopes))
+            self.replica_context.__enter__()
+
+    def dispatch(self, request, *args, **kwargs):
+        # DRF skips finalize_response when an exception goes unhandled, and
+        # the worker thread would then keep reading from the replica
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            self.end_replica_reads()
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        self.end_replica_reads()
+        return super().finalize_response(request, response, *args, **kwargs)
+
+    def end_replica_reads(self):
+        context = getattr(self, 'replica_context', None)
+        if context is not None:
+            self.replica_context = None
+            context.__exit__(None, None, None)
+
+
+class PrimaryAfterWriteMiddleware:
+    """Pin a user to the primary after a successful unsafe request, so the
+    order they just placed shows up in their order history"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        # Under ASGI the async checkout would otherwise be pushed through
+        # async_to_sync onto a thread for this middleware alone
+        self.async_mode = asyncio.iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        response = self.get_response(request)
+        self.pin_writer(request, response)
+        return response
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        # The user is loaded lazily and the pin goes to the cache, both sync
+        await sync_to_async(self.pin_writer)(request, response)
+        return response
+
+    def pin_writer(self, request, response):
+        if request.method not in SAFE_METHODS and response.status_code < 400 and replica_configured():
+            user = getattr(request, 'user', None)
+            if user is not None and user.is_authenticated:
+                pin_to_primary(user_scope(user))
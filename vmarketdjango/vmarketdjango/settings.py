@@ -34,6 +34,14 @@ ALLOWED_HOSTS = ["10.0.2.2", "localhost", "127.0.0.1", "*"]
 
 STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY', '')
 
+# Async payment client used by checkout/async/, point STRIPE_API_BASE at
+# order.fake_payments (manage.py fake_payment_server) for tests and load runs
+STRIPE_API_BASE = os.getenv('STRIPE_API_BASE', 'https://api.stripe.com')
+PAYMENT_TIMEOUT = float(os.getenv('PAYMENT_TIMEOUT', '20'))
+PAYMENT_CONNECT_TIMEOUT = float(os.getenv('PAYMENT_CONNECT_TIMEOUT', '5'))
+PAYMENT_MAX_CONNECTIONS = int(os.getenv('PAYMENT_MAX_CONNECTIONS', '100'))
+PAYMENT_MAX_RETRIES = int(os.getenv('PAYMENT_MAX_RETRIES', '2'))
+
 # Application definition
 
 INSTALLED_APPS = [
@@ -66,18 +74,28 @@ CORS_ALLOWED_ORIGINS = [
 CORS_ALLOW_ALL_ORIGINS = True
 
 MIDDLEWARE = [
+    'vmarketdjango.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'vmarketdjango.routers.PrimaryAfterWriteMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
 ROOT_URLCONF = 'vmarketdjango.urls'
 
+# Requests slower than this many seconds are logged with their slowest SQL
+SLOW_REQUEST_THRESHOLD = float(os.getenv('SLOW_REQUEST_THRESHOLD', '0.5'))
+# Bearer token for /api/v1/metrics/, the endpoint refuses every scrape without one
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+# Addresses allowed to scrape without the token. Behind a proxy REMOTE_ADDR is
+# the proxy's address, so only list addresses that reach the app directly.
+METRICS_ALLOWED_IPS = [ip for ip in os.getenv('METRICS_ALLOWED_IPS', '').split(',') if ip]
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -95,6 +113,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'vmarketdjango.wsgi.application'
+ASGI_APPLICATION = 'vmarketdjango.asgi.application'
 
 
 # Database
@@ -104,8 +123,76 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Keep connections open between requests, checked before each reuse
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', '60')),
+        'CONN_HEALTH_CHECKS': True,
+    }
+}
+
+# Optional read replica for catalog and order history reads, see
+# vmarketdjango.routers. It needs a shared cache (SHARED_CACHE below) and is
+# ignored without one. A copy of db.sqlite3 is enough to try it locally
+if os.getenv('DB_REPLICA_NAME'):
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'NAME': os.getenv('DB_REPLICA_NAME'),
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['vmarketdjango.routers.ReplicaRouter']
+# Seconds writers keep reading from the primary, longer than the replica's lag
+DATABASE_REPLICA_LAG = int(os.getenv('DB_REPLICA_LAG', '5'))
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+# The local-memory cache is per process, point CACHE_BACKEND at
+# django.core.cache.backends.filebased.FileBasedCache to share catalog
+# invalidation between several workers without an external service
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'vmarket'),
     }
 }
+# Whether every worker sees the same cache entries. Per-user state that has
+# to be invalidated everywhere at once (tokens, carts, primary pins) is only
+# kept in the cache when it is shared
+SHARED_CACHE = CACHES['default']['BACKEND'] not in (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+# Seconds a rendered catalog response stays cached, writes invalidate it sooner
+CATALOG_CACHE_TIMEOUT = 60 * 15
+
+# Whether cache.incr() and cache.add() are atomic across workers.
+# FileBasedCache is shared but reads and rewrites the file, so two workers
+# can both read the old value and one update is lost
+ATOMIC_CACHE = CACHES['default']['BACKEND'] in (
+    'django.core.cache.backends.redis.RedisCache',
+    'django.core.cache.backends.memcached.PyMemcacheCache',
+    'django.core.cache.backends.memcached.PyLibMCCache',
+)
+
+# Carts live in the cache until checkout when its counters are atomic, and in
+# the database otherwise, where concurrent updates can't lose quantities
+CART_STORE = os.getenv('CART_STORE', 'order.cart.CacheCartStore' if ATOMIC_CACHE else 'order.cart.DatabaseCartStore')
+# Seconds an untouched cart is kept
+CART_TTL = 60 * 60 * 24 * 30
+# Seconds checkout holds reserved stock before release_expired_reservations puts
+# it back, keep it well above the worst case of PAYMENT_TIMEOUT and its retries
+STOCK_RESERVATION_TTL = int(os.getenv('STOCK_RESERVATION_TTL', 60 * 15))
+
+# Products kept per product by build_recommendations for /products/<id>/related/
+RECOMMENDATIONS_TOP_K = int(os.getenv('RECOMMENDATIONS_TOP_K', '20'))
+# Lower bounds of the price buckets counted in the /products/ facets, the last one is open ended
+PRODUCT_PRICE_BUCKETS = [0, 25, 50, 100, 250, 500, 1000]
+
+# Seconds an API token stays resolved in the cache, logout and password changes drop it sooner.
+# Tokens are looked up in the database on every request without SHARED_CACHE
+TOKEN_CACHE_TIMEOUT = 60 * 5
 
 
 # Password validation
@@ -145,6 +232,18 @@ USE_TZ = True
 STATIC_URL = 'static/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media/'
+# Uploads are stored under content-hashed names and served as immutable
+DEFAULT_FILE_STORAGE = 'vmarketdjango.storage.HashedFileSystemStorage'
+# Formats JPEG and PNG media are also offered in, by order of preference
+MEDIA_IMAGE_VARIANTS = ['avif', 'webp']
+
+# Product image derivatives, built off the request path when an image is uploaded
+PRODUCT_THUMBNAIL_SIZES = {
+    'card': (300, 200),
+    'detail': (600, 400),
+    'retina': (1200, 800),
+}
+PRODUCT_THUMBNAIL_WORKERS = int(os.getenv('PRODUCT_THUMBNAIL_WORKERS', '2'))
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
@@ -154,7 +253,7 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # Django REST Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'order.authentication.CachedTokenAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
@@ -184,4 +283,13 @@ DJOSER = {
 }
 
 # Email settings (for password reset and activation)
-EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+# Emails are written to the outbox and delivered by `manage.py send_queued_mail`
+# through OUTBOX_DELIVERY_BACKEND, so requests never wait on the mail server
+EMAIL_BACKEND = 'order.mail.OutboxBackend'
+OUTBOX_DELIVERY_BACKEND = os.getenv('OUTBOX_DELIVERY_BACKEND', 'django.core.mail.backends.console.EmailBackend')
+OUTBOX_MAX_ATTEMPTS = 5
+# Seconds before the first retry, doubled after every failed attempt
+OUTBOX_RETRY_DELAY = 60
+
+# Used to build the links sent in verification emails
+FRONTEND_URL = os.getenv('FRONTEND_URL', 'http://localhost:8080')
@@ -0,0 +1,52 @@
+import hashlib
+import os
+import re
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+
+HASH_LENGTH = 12
+HASHED_NAME = re.compile(r'\.[0-9a-f]{%d}(\.[^./]+)?$' % HASH_LENGTH)
+
+
+def content_hash(content):
+    digest = hashlib.sha256()
+    content.seek(0)
+    for chunk in content.chunks():
+        digest.update(chunk)
+    content.seek(0)
+    return digest.hexdigest()[:HASH_LENGTH]
+
+
+def is_hashed(name):
+    return HASHED_NAME.search(name) is not None
+
+
+def hashed_name(name, digest, max_length=None):
+    """``uploads/apple.jpg`` becomes ``uploads/apple.<digest>.jpg``"""
+    root, ext = os.path.splitext(HASHED_NAME.sub(r'\1', name))
+    suffix = f'.{digest}{ext}'
+    if max_length and len(root) + len(suffix) > max_length:
+        directory, stem = os.path.split(root)
+        stem = stem[:max(1, max_length - len(suffix) - len(directory) - 1)]
+        root = os.path.join(directory, stem)
+    return root + suffix
+
+
+class HashedFileSystemStorage(FileSystemStorage):
+    """Stores every file under a name containing a hash of its content.
+
+    A name is never reused for different bytes, so media can be served
+    with ``Cache-Control: immutable``, and identical uploads share a file.
+    """
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+
+        name = hashed_name(name, content_hash(content), max_length)
+        if self.exists(name):
+            return name
+        return super().save(name, content, max_length)
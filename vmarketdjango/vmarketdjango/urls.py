@@ -1,18 +1,26 @@
 from django.conf import settings
-from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include
 from django.http import JsonResponse
 
+from order.account_views import UserSettingsView
+from vmarketdjango.media import serve_media
+from vmarketdjango.metrics import metrics_view
+
 # Simple ping endpoint to test connectivity from mobile app
 def ping_view(request):
     return JsonResponse({'status': 'ok', 'message': 'API server is running'})
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    # Ahead of djoser, whose users/<id>/ route would answer it with a 404
+    path('api/v1/users/settings/', UserSettingsView.as_view()),
     path('api/v1/', include('djoser.urls')),
     path('api/v1/', include('djoser.urls.authtoken')),
     path('api/v1/', include('product.urls')),
     path('api/v1/', include('order.urls')),
     path('api/v1/ping/', ping_view, name='ping'),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    path('api/v1/metrics/', metrics_view, name='metrics'),
+    # Hashed names, range requests and WebP/AVIF variants, see vmarketdjango.media
+    path(f"{settings.MEDIA_URL.lstrip('/')}<path:path>", serve_media, name='media'),
+]